@@ -0,0 +1,108 @@
+import time
+
+import gemmi
+import numpy as np
+import yaml
+
+from ligand_neighbourhood_alignment import cli, dt
+from ligand_neighbourhood_alignment.get_alignability import _match_cas
+from ligand_neighbourhood_alignment.matching import _match_atom
+
+DATA_PATHS = {
+    "Mpro-i0130": "data/Mpro-i0130.pdb",
+    "Mpro-IBM0078": "data/refine_6.split.bound-state.pdb",
+    "Mpro-IBM0058": "data/refine_7.split.bound-state.pdb",
+    "Mpro-x0107": "data/refine_8.split.bound-state.pdb",
+    "Mpro-IBM0045": "data/refine_16.split.bound-state.pdb",
+}
+
+
+def _legacy_match_cas(ligand_1_neighbourhood, ligand_2_neighbourhood, min_alignable_atoms=9, max_alignable_rmsd=1.0):
+    # The nested loop matcher that _match_cas replaced
+    alignable_cas = []
+    for ligand_1_atom_id, ligand_1_atom in ligand_1_neighbourhood.atoms.items():
+        for ligand_2_atom_id, ligand_2_atom in ligand_2_neighbourhood.atoms.items():
+            if ligand_1_atom_id[2] == "CA":
+                if _match_atom(ligand_1_atom_id, ligand_2_atom_id, ignore_chain=True):
+                    alignable_cas.append(
+                        (
+                            gemmi.Position(ligand_1_atom.x, ligand_1_atom.y, ligand_1_atom.z),
+                            gemmi.Position(ligand_2_atom.x, ligand_2_atom.y, ligand_2_atom.z),
+                        )
+                    )
+
+    if len(alignable_cas) >= min(
+        [min_alignable_atoms, len(ligand_1_neighbourhood.atoms), len(ligand_2_neighbourhood.atoms)]
+    ):
+        sup = gemmi.superpose_positions([x[0] for x in alignable_cas], [x[1] for x in alignable_cas])
+        transform = sup.transform
+        inverse_transform = sup.transform.inverse()
+        if sup.rmsd < max_alignable_rmsd:
+            return (
+                True,
+                dt.Transform(vec=transform.vec.tolist(), mat=transform.mat.tolist()),
+                dt.Transform(vec=inverse_transform.vec.tolist(), mat=inverse_transform.mat.tolist()),
+            )
+    return False, None, None
+
+
+def _get_ligand_neighbourhoods():
+    with open("data/assemblies.yaml", "r") as f:
+        dic = yaml.safe_load(f)
+    assemblies = {key: dt.Assembly.from_dict(value) for key, value in dic["assemblies"].items()}
+    xtalforms = {key: dt.XtalForm.from_dict(value) for key, value in dic["crystalforms"].items()}
+
+    ligand_neighbourhoods = {}
+    for dtag, path in DATA_PATHS.items():
+        st = gemmi.read_structure(path)
+        ligand_binding_events = {}
+        for chain in st[0]:
+            for residue in chain:
+                if residue.name in ["LIG", "DMS"]:
+                    lbe_id = (dtag, chain.name, str(residue.seqid.num))
+                    ligand_binding_events[lbe_id] = dt.LigandBindingEvent(
+                        "1", dtag, chain.name, str(residue.seqid.num), None
+                    )
+        dataset = dt.Dataset(dtag, path, None, None, ligand_binding_events)
+        ligand_neighbourhoods.update(cli._get_neighbourhoods(dataset, xtalforms["xtalform1"], assemblies, "1"))
+
+    return ligand_neighbourhoods
+
+
+def _time_pairs(match, neighbourhoods, repeats):
+    results = []
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        results = [match(n1, n2) for n1 in neighbourhoods for n2 in neighbourhoods]
+    return (time.perf_counter() - begin) / (repeats * len(neighbourhoods) ** 2), results
+
+
+def main(repeats: int = 5):
+    neighbourhoods = list(_get_ligand_neighbourhoods().values())
+    print(f"Benchmarking {len(neighbourhoods) ** 2} neighbourhood pairs, {repeats} repeats")
+
+    legacy_time, legacy_results = _time_pairs(_legacy_match_cas, neighbourhoods, repeats)
+    for neighbourhood in neighbourhoods:
+        neighbourhood.ca_array
+    time_per_pair, results = _time_pairs(_match_cas, neighbourhoods, repeats)
+
+    max_difference = 0.0
+    for legacy_result, result in zip(legacy_results, results):
+        assert legacy_result[0] == result[0]
+        if result[0]:
+            for legacy_transform, transform in zip(legacy_result[1:], result[1:]):
+                max_difference = max(
+                    max_difference,
+                    np.max(np.abs(np.array(legacy_transform.mat) - np.array(transform.mat))),
+                    np.max(np.abs(np.array(legacy_transform.vec) - np.array(transform.vec))),
+                )
+
+    print(f"Matches: {sum(result[0] for result in results)}")
+    print(f"Nested loop matching: {legacy_time * 1e6:.1f} us per pair")
+    print(f"Vectorized matching: {time_per_pair * 1e6:.1f} us per pair")
+    print(f"Speedup: {legacy_time / time_per_pair:.1f}x")
+    print(f"Largest transform difference: {max_difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
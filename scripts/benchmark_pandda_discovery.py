@@ -0,0 +1,107 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import gemmi
+import numpy as np
+import pandas as pd
+
+from ligand_neighbourhood_alignment import constants, discovery_cache, dt, make_data_json
+
+
+def _get_ligand_binding_events_by_rows(pandda_event_csvs, pdb_path, dtag):
+    # The previous implementation, scanning every row of every table for each dataset
+    structure = gemmi.read_structure(str(pdb_path))
+    ligand_binding_events = {}
+    for pandda_path, event_table in pandda_event_csvs.items():
+        processed_datasets_dir = Path(pandda_path) / constants.PANDDA_PROCESSED_DATASETS_DIR
+        for idx, row in event_table.iterrows():
+            if row["Ligand Confidence"] not in ["High", "Medium"]:
+                continue
+            if dtag != row["dtag"]:
+                continue
+            chain, residue_num = make_data_json.get_closest_lig(structure, (row["x"], row["y"], row["z"]))
+            if not residue_num:
+                continue
+            xmap_path = processed_datasets_dir / dtag / constants.PANDDA_EVENT_MAP_TEMPLATE.format(
+                dtag=dtag, event_id=row["event_idx"], bdc=row["1-BDC"]
+            )
+            ligand_binding_events[(str(dtag), str(chain), str(residue_num))] = dt.LigandBindingEvent(
+                str(row["event_idx"]), str(dtag), str(chain), str(residue_num), str(xmap_path)
+            )
+    return ligand_binding_events
+
+
+def _get_pdb(pdb_path):
+    # The ligands and a few residues of a bundled structure
+    structure = gemmi.read_structure(pdb_path)
+    for model in structure:
+        for chain in model:
+            for j in reversed(range(len(chain))):
+                if (j >= 10) and (chain[j].het_flag != "H"):
+                    del chain[j]
+    return structure.make_pdb_string()
+
+
+def main(num_datasets=2_000, num_events=50_000, num_timed_by_rows=20):
+    rng = np.random.default_rng(0)
+    source_dir = Path(tempfile.mkdtemp())
+    model_building_dir = source_dir / "model_building"
+    pdb = _get_pdb("data/Mpro-i0130.pdb")
+    dtags = [f"x{j:05}" for j in range(num_datasets)]
+    for dtag in dtags:
+        (model_building_dir / dtag).mkdir(parents=True)
+        (model_building_dir / dtag / constants.MODEL_DIR_PDB).write_text(pdb)
+
+    pandda_dir = source_dir / "pandda"
+    (pandda_dir / constants.PANDDA_ANALYSES_DIR).mkdir(parents=True)
+    event_table = pd.DataFrame(
+        {
+            "dtag": rng.choice(dtags + [f"y{j:05}" for j in range(num_datasets)], size=num_events),
+            "event_idx": np.arange(num_events) % 5 + 1,
+            "x": rng.normal(9.0, 2.0, size=num_events),
+            "y": rng.normal(0.0, 2.0, size=num_events),
+            "z": rng.normal(21.0, 2.0, size=num_events),
+            "1-BDC": rng.choice([0.25, 0.3, 0.35], size=num_events),
+            "Ligand Confidence": rng.choice(["High", "Medium", "Low"], size=num_events),
+            "Comment": "",
+        }
+    )
+    event_table_path = pandda_dir / constants.PANDDA_ANALYSES_DIR / constants.PANDDA_EVENTS_INSPECT_TABLE_PATH
+    event_table.to_csv(event_table_path, index=False)
+
+    source_data_model = dt.SourceDataModel.from_fs_model(
+        dt.FSModel.from_dir(source_dir), [str(model_building_dir)], ["model_building"], [str(pandda_dir)]
+    )
+    start = time.perf_counter()
+    datasets, _, _ = source_data_model.get_datasets()
+    print(f"{num_datasets} datasets, {num_events} events: discovery {time.perf_counter() - start:.2f} s")
+
+    # With the discovery cache, first filling it and then with nothing changed
+    cache_path = source_dir / constants.DISCOVERY_CACHE_YAML_FILE_NAME
+    for run in ["cold", "warm"]:
+        cache = discovery_cache.DiscoveryCache(cache_path)
+        start = time.perf_counter()
+        source_data_model.get_datasets(cache)
+        print(f"Discovery with {run} cache: {time.perf_counter() - start:.2f} s")
+        cache.save()
+
+    # The previous scan on a few datasets, scaled up since it is linear in the number of datasets
+    pandda_event_tables = {pandda_dir: pd.read_csv(event_table_path)}
+    start = time.perf_counter()
+    for dtag in dtags[:num_timed_by_rows]:
+        ligand_binding_events = _get_ligand_binding_events_by_rows(
+            pandda_event_tables, model_building_dir / dtag / constants.MODEL_DIR_PDB, dtag
+        )
+        expected = {key: vars(lbe) for key, lbe in ligand_binding_events.items()}
+        if dtag in datasets:
+            assert {key: vars(lbe) for key, lbe in datasets[dtag].ligand_binding_events.items()} == expected
+        else:
+            assert len(expected) == 0
+    by_rows = (time.perf_counter() - start) * num_datasets / num_timed_by_rows
+    print(f"Row scan, scaled from {num_timed_by_rows} datasets: {by_rows:.0f} s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,82 @@
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from ligand_neighbourhood_alignment import cli, dt
+
+
+def _get_store(num_pairs, num_ligands, rng):
+    ligand_ids = [(f"x{j:05}", "A", "1101", "1") for j in range(num_ligands)]
+    pairs = rng.integers(0, num_ligands, size=(num_pairs, 2))
+    rotations = np.linalg.qr(rng.normal(size=(num_pairs, 3, 3)))[0]
+    transforms = np.concatenate([rng.normal(size=(num_pairs, 3)), rotations.reshape((-1, 9))], axis=1)
+    return dt.TransformStore(ligand_ids, pairs, transforms)
+
+
+def _time(name, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{name}: {time.perf_counter() - start:.2f} s")
+    return result
+
+
+def main(num_pairs=10_000_000, num_yaml_pairs=2_000):
+    rng = np.random.default_rng(0)
+    output_dir = Path(tempfile.mkdtemp())
+
+    # The previous YAML format, on fewer pairs since it scales linearly and is slow
+    yaml_store = _get_store(num_yaml_pairs, 1000, rng)
+    transforms = {key: yaml_store[key] for key in yaml_store}
+    fs_model = dt.FSModel.from_dir(output_dir)
+    fs_model.ligand_neighbourhood_transforms = output_dir / "neighbourhood_transforms.yaml"
+    start = time.perf_counter()
+    with open(fs_model.ligand_neighbourhood_transforms, "w") as f:
+        yaml.safe_dump(
+            {
+                "~".join(["/".join(to_id), "/".join(from_id)]): transform.to_dict()
+                for (to_id, from_id), transform in transforms.items()
+            },
+            f,
+        )
+    yaml_save = time.perf_counter() - start
+    start = time.perf_counter()
+    cli._load_ligand_neighbourhood_transforms(fs_model.ligand_neighbourhood_transforms)
+    yaml_load = time.perf_counter() - start
+    scale = num_pairs / len(yaml_store.pairs)
+    print(
+        f"YAML, {len(transforms)} entries: save {yaml_save:.2f} s, load {yaml_load:.2f} s, "
+        f"{fs_model.ligand_neighbourhood_transforms.stat().st_size / 1e6:.1f} MB. "
+        f"Scaled to {num_pairs} pairs: save {yaml_save * scale:.0f} s, load {yaml_load * scale:.0f} s"
+    )
+
+    store = _get_store(num_pairs, 5000, rng)
+    path = output_dir / "neighbourhood_transforms.bin"
+    _time(f"Array store, {num_pairs} pairs: save", lambda _store=store: _store.save(path))
+    print(f"Array store size: {path.stat().st_size / 1e6:.1f} MB")
+    del store
+    loaded = _time("Array store: load", lambda: dt.TransformStore.from_file(path))
+
+    keys = [
+        (loaded.ligand_ids[to_index], loaded.ligand_ids[from_index])
+        for to_index, from_index in rng.integers(0, len(loaded.ligand_ids), size=(100_000, 2)).tolist()
+    ]
+    _time("Array store: 100000 lookups", lambda: [loaded.get(key) for key in keys])
+
+    # Incremental update of 1% of the pairs, appended to the file
+    transform = dt.Transform([0.0, 0.0, 0.0], np.eye(3).tolist())
+    new_keys = [((f"y{j:05}", "A", "1101", "1"), key[1]) for j, key in enumerate(keys[: num_pairs // 100])]
+
+    def _append():
+        for key in new_keys:
+            loaded[key] = transform
+
+    _time(f"Array store: add {len(new_keys)} pairs", _append)
+    _time("Array store: append save", lambda: loaded.save(path))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,97 @@
+import time
+
+import yaml
+
+from ligand_neighbourhood_alignment import cli, dt, get_ligand_neighbourhoods
+
+DATA_PATHS = {
+    "Mpro-i0130": "data/Mpro-i0130.pdb",
+    "Mpro-IBM0078": "data/refine_6.split.bound-state.pdb",
+    "Mpro-IBM0058": "data/refine_7.split.bound-state.pdb",
+    "Mpro-x0107": "data/refine_8.split.bound-state.pdb",
+    "Mpro-IBM0045": "data/refine_16.split.bound-state.pdb",
+}
+
+
+def _get_model_and_artefact_atoms_pairwise(residue_neighbours, structure, fragment):
+    # The previous implementation, checking each candidate against every accepted atom
+    model_atoms = []
+    artefact_atoms = []
+    possible_artefact_atoms = []
+    for pos, cra in residue_neighbours:
+        if cra.atom.pos.dist(pos) > 0.1:
+            possible_artefact_atoms.append((pos, cra))
+        else:
+            if all([model_atom[0].dist(pos) > 0.1 for model_atom in model_atoms]):
+                model_atoms.append((pos, cra))
+    for pos, cra in possible_artefact_atoms:
+        if all([model_atom[0].dist(pos) > 0.1 for model_atom in model_atoms]):
+            if all([model_atom[0].dist(pos) > 0.1 for model_atom in artefact_atoms]):
+                artefact_atoms.append((pos, cra))
+    updated_model_atoms = [
+        atom for atom in model_atoms if all([fragment_atom.pos.dist(atom[0]) > 0.1 for fragment_atom in fragment])
+    ]
+    updated_artefact_atoms = [
+        atom for atom in artefact_atoms if all([fragment_atom.pos.dist(atom[0]) > 0.1 for fragment_atom in fragment])
+    ]
+    return updated_model_atoms, updated_artefact_atoms
+
+
+def _get_calls(datasets, xtalform, assemblies):
+    # Record the arguments of every call made while getting the datasets' neighbourhoods
+    calls = []
+    get_model_and_artefact_atoms = get_ligand_neighbourhoods.get_model_and_artefact_atoms
+
+    def _record(residue_neighbours, structure, fragment):
+        calls.append((residue_neighbours, structure, fragment))
+        return get_model_and_artefact_atoms(residue_neighbours, structure, fragment)
+
+    get_ligand_neighbourhoods.get_model_and_artefact_atoms = _record
+    try:
+        for dataset in datasets.values():
+            cli._get_dataset_neighbourhoods(dataset, xtalform, assemblies, "1")
+    finally:
+        get_ligand_neighbourhoods.get_model_and_artefact_atoms = get_model_and_artefact_atoms
+    return calls
+
+
+def _time(func, calls):
+    start = time.perf_counter()
+    results = [func(*call) for call in calls]
+    return time.perf_counter() - start, results
+
+
+def main():
+    with open("data/assemblies.yaml", "r") as f:
+        dic = yaml.safe_load(f)
+    assemblies = {key: dt.Assembly.from_dict(value) for key, value in dic["assemblies"].items()}
+    xtalform = dt.XtalForm.from_dict(dic["crystalforms"]["xtalform1"])
+
+    datasets = {}
+    for dtag, pdb in DATA_PATHS.items():
+        structure = cli._read_structure(pdb)
+        ligand_binding_events = {
+            (dtag, chain.name, str(residue.seqid.num)): dt.LigandBindingEvent(
+                "1", dtag, chain.name, str(residue.seqid.num), None
+            )
+            for chain in structure[0]
+            for residue in chain
+            if residue.name in ["LIG", "DMS"]
+        }
+        datasets[dtag] = dt.Dataset(dtag, pdb, None, None, ligand_binding_events)
+
+    calls = _get_calls(datasets, xtalform, assemblies)
+    num_candidates = sum(len(call[0]) for call in calls)
+    print(f"{len(calls)} neighbourhoods, {num_candidates} candidate atoms")
+
+    pairwise_time, pairwise_results = _time(_get_model_and_artefact_atoms_pairwise, calls)
+    hashed_time, hashed_results = _time(get_ligand_neighbourhoods.get_model_and_artefact_atoms, calls)
+    for pairwise_result, hashed_result in zip(pairwise_results, hashed_results):
+        for pairwise_atoms, hashed_atoms in zip(pairwise_result, hashed_result):
+            assert [atom[0].tolist() for atom in pairwise_atoms] == [atom[0].tolist() for atom in hashed_atoms]
+    print(f"Pairwise: {pairwise_time:.2f} s")
+    print(f"Position hash: {hashed_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import itertools
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil, floor
 from pathlib import Path
 
@@ -7,7 +10,7 @@ import networkx as nx
 import numpy as np
 from loguru import logger
 
-from ligand_neighbourhood_alignment import alignment_heirarchy
+from ligand_neighbourhood_alignment import alignment_heirarchy, constants
 from ligand_neighbourhood_alignment.data import (
     Block,
     CanonicalSites,
@@ -397,7 +400,7 @@ def _get_box(neighbourhood: dt.Neighbourhood, xmap, transform):
 def _write_xmap_from_ccp4(ccp4, path):
     ccp4.write_ccp4_map(str(path))
 
-def _write_cut_xmap(new_xmap, aligned_res, crystallographic_output_path):
+def _get_cut_box(aligned_res, unit_cell, margin=7.5):
     new_st = gemmi.Structure()
     new_model = gemmi.Model("0")
     new_st.add_model(new_model)
@@ -407,15 +410,18 @@ def _write_cut_xmap(new_xmap, aligned_res, crystallographic_output_path):
     new_st[0].add_chain(chain)
     new_st[0][0].add_residue(aligned_res)
 
-    new_st.cell = new_xmap.unit_cell
+    new_st.cell = unit_cell
     new_st.spacegroup_hm = gemmi.find_spacegroup_by_name('P 1').hm
 
+    return new_st.calculate_fractional_box(margin=margin)
+
 
+def _write_cut_xmap(new_xmap, aligned_res, crystallographic_output_path):
     ccp4 = gemmi.Ccp4Map()
     ccp4.grid = new_xmap
     ccp4.grid.spacegroup = gemmi.SpaceGroup("P1")
     ccp4.update_ccp4_header()
-    ccp4.set_extent(new_st.calculate_fractional_box(margin=7.5))
+    ccp4.set_extent(_get_cut_box(aligned_res, new_xmap.unit_cell))
     ccp4.write_ccp4_map(str(crystallographic_output_path))
 
 
@@ -537,29 +543,14 @@ def resample_xmap(new_xmap, aligned_res):
     return new_map
 
 
-def __align_xmap(
-    neighbourhood: dt.Neighbourhood,
+def _get_ligand_to_site_transform(
     g,
     ligand_neighbourhood_transforms: dict[tuple[tuple[str, str, str], tuple[str, str, str]], dt.Transform],
-    reference_xmap,
-    subsite_reference_id: tuple[str, str, str],
     lid: tuple[str, str, str],
-    xmap,
-    conformer_site_transforms,
-    conformer_site_id,
-    # canonical_site_transforms,
-    canonical_site_id,
-    output_path: Path,
-crystallographic_output_path,
-    aligned_res,
-chain_to_assembly_transform,
-assembly_transform
+    subsite_reference_id: tuple[str, str, str],
+    chain_to_assembly_transform,
+    assembly_transform,
 ):
-    # Get the ligand neighbourhood
-    # neighbourhood: LigandNeighbourhood = neighbourhoods.get_neighbourhood(lid)
-
-    # Get the xmap
-
     # Get the Transform to reference
     running_transform = gemmi.Transform()
     shortest_path = nx.shortest_path(g, lid, subsite_reference_id)
@@ -580,15 +571,6 @@ assembly_transform
         # Apply the translation to the new frame
         previous_ligand_id = next_ligand_id
 
-    # Get the subsite transform
-    # print(conformer_site_transforms)
-    # conformer_site_transform = transform_to_gemmi(conformer_site_transforms[(canonical_site_id, conformer_site_id)])
-    # running_transform = conformer_site_transform.combine(running_transform)
-
-    # Get the site transform
-    # canonical_site_transform = transform_to_gemmi(canonical_site_transforms[canonical_site_id])
-    # running_transform = canonical_site_transform.combine()
-
     # Update the transform with the assembly alignment
     # # Get the xtalform to assembly transform
     running_transform = alignment_heirarchy._transform_to_gemmi(chain_to_assembly_transform).combine(running_transform)
@@ -600,36 +582,417 @@ assembly_transform
         f"Transform from native frame to subsite frame to site frame is: {gemmi_to_transform(running_transform)}"
     )
 
-    # Define the interpolation range
-    interpolation_range = _get_interpolation_range(neighbourhood, running_transform, reference_xmap)
+    return running_transform
+
+
+class LigandSiteTransforms:
+    # Resolves the transforms of ligand neighbourhoods to their site frames. A single search of the alignability
+    # graph is made from each conformer site reference, composing every member's transform to the reference on the
+    # way, and the composed transforms to each site frame are cached
+    def __init__(
+        self,
+        alignability_graph,
+        ligand_neighbourhood_transforms: dict[tuple[tuple[str, str, str], tuple[str, str, str]], dt.Transform],
+        chain_to_assembly_transforms,
+        assembly_transforms,
+        xtalforms: dict[str, dt.XtalForm],
+        dataset_assignments: dict[str, str],
+    ):
+        self.alignability_graph = alignability_graph
+        self.ligand_neighbourhood_transforms = ligand_neighbourhood_transforms
+        self.chain_to_assembly_transforms = chain_to_assembly_transforms
+        self.assembly_transforms = assembly_transforms
+        self.xtalforms = xtalforms
+        self.dataset_assignments = dataset_assignments
+        self._reference_transforms = {}
+        self._site_transforms = {}
+        self._ligand_site_transforms = {}
+
+    def get_reference_transform(self, lid, reference_ligand_id):
+        if reference_ligand_id not in self._reference_transforms:
+            self._reference_transforms[reference_ligand_id] = self._get_reference_transforms(reference_ligand_id)
+
+        reference_transforms = self._reference_transforms[reference_ligand_id]
+        if lid not in reference_transforms:
+            raise nx.NetworkXNoPath(f"No path between {lid} and {reference_ligand_id}")
+        return reference_transforms[lid]
+
+    def get(self, lid, reference_ligand_id, site_chain: str):
+        # Aligns to conformer site, then to the corresponding assembly, then from that assembly to the global frame
+        key = (lid, reference_ligand_id, site_chain)
+        if key not in self._ligand_site_transforms:
+            self._ligand_site_transforms[key] = self._get_site_transform(reference_ligand_id, site_chain).combine(
+                self.get_reference_transform(lid, reference_ligand_id)
+            )
+            logger.debug(
+                f"Transform from native frame to subsite frame to site frame is: "
+                f"{gemmi_to_transform(self._ligand_site_transforms[key])}"
+            )
+        return self._ligand_site_transforms[key]
+
+    def _get_reference_transforms(self, reference_ligand_id):
+        # Transforms are 2 onto 1, so each node's transform to the reference is its parent's after the edge to it
+        reference_transforms = {reference_ligand_id: gemmi.Transform()}
+        for parent, child in nx.bfs_edges(self.alignability_graph, reference_ligand_id):
+            reference_transforms[child] = reference_transforms[parent].combine(
+                transform_to_gemmi(self.ligand_neighbourhood_transforms[(parent, child)])
+            )
+        return reference_transforms
+
+    def _get_site_transform(self, reference_ligand_id, site_chain: str):
+        key = (reference_ligand_id, site_chain)
+        if key not in self._site_transforms:
+            xtalform = self.xtalforms[self.dataset_assignments[reference_ligand_id[0]]]
+            assembly = xtalform.assemblies[alignment_heirarchy._chain_to_xtalform_assembly(site_chain, xtalform)]
+            self._site_transforms[key] = alignment_heirarchy._transform_to_gemmi(
+                self.assembly_transforms[assembly.assembly]
+            ).combine(
+                alignment_heirarchy._transform_to_gemmi(
+                    self.chain_to_assembly_transforms[(reference_ligand_id[0], site_chain)]
+                )
+            )
+        return self._site_transforms[key]
 
-    # Interpolate
-    new_xmap = interpolate_range(
+
+def _get_range_coverage(interpolation_range: list[Block], reference_xmap):
+    # The grid points of the reference cell, per axis and modulo the cell, that the interpolation range samples
+    coverage = [np.zeros(n, dtype=bool) for n in (reference_xmap.nu, reference_xmap.nv, reference_xmap.nw)]
+    for block in interpolation_range:
+        coverage[0][block.xmi : block.xmi + block.dx] = True
+        coverage[1][block.ymi : block.ymi + block.dy] = True
+        coverage[2][block.zmi : block.zmi + block.dz] = True
+
+    return coverage
+
+
+def _sample_ligand_frame(
+    reference_xmap,
+    xmap,
+    interpolation_range: list[Block],
+    running_transform,
+    aligned_res,
+    step=0.5,
+    border=7.5,
+):
+    # Sample the moving map straight into the box about the aligned ligand in one interpolation. Points whose
+    # interpolation would touch the reference cell outside the interpolation range are zero, as they are when
+    # resampling the interpolated reference cell map
+    ligand_lower_bound, ligand_upper_bound = get_ligand_bounds(aligned_res, border)
+    frame_lower_bound, frame_upper_bound = get_frame_bounds(ligand_lower_bound, ligand_upper_bound, border, step)
+    frame_array = get_frame_array(frame_lower_bound, frame_upper_bound, step)
+    frame_transform = get_frame_transform(frame_lower_bound, frame_array, step)
+    xmap.interpolate_values(frame_array, running_transform.inverse().combine(frame_transform))
+
+    # Mask the points outside the interpolation range
+    frame_positions = frame_lower_bound + step * np.stack(np.indices(frame_array.shape), axis=-1)
+    frame_fractional = frame_positions @ np.array(reference_xmap.unit_cell.frac.mat.tolist()).T
+    mask = np.ones(frame_array.shape, dtype=bool)
+    for axis, (n, coverage) in enumerate(
+        zip(
+            (reference_xmap.nu, reference_xmap.nv, reference_xmap.nw),
+            _get_range_coverage(interpolation_range, reference_xmap),
+        )
+    ):
+        lower = np.floor(frame_fractional[..., axis] * n).astype(int)
+        mask &= coverage[np.mod(lower, n)] & coverage[np.mod(lower + 1, n)]
+    frame_array[~mask] = 0.0
+
+    return get_new_map(get_cell(frame_array, step), frame_array, frame_lower_bound, step)
+
+
+def _get_cut_xmap(
+    reference_xmap,
+    xmap,
+    interpolation_range: list[Block],
+    running_transform,
+    aligned_res,
+):
+    # The reference cell map of the interpolation range, cut to the box about the aligned ligand. Blocks are
+    # interpolated as for the full cell map but only their overlap with the box is kept
+    box = _get_cut_box(aligned_res, reference_xmap.unit_cell)
+    grid_sizes = (reference_xmap.nu, reference_xmap.nv, reference_xmap.nw)
+    starts = [ceil(lower * n) for lower, n in zip(box.minimum.tolist(), grid_sizes)]
+    stops = [floor(upper * n) for upper, n in zip(box.maximum.tolist(), grid_sizes)]
+    cut_indexes = [np.mod(np.arange(start, stop + 1), n) for start, stop, n in zip(starts, stops, grid_sizes)]
+
+    cut_array = np.zeros([len(indexes) for indexes in cut_indexes], dtype=np.float32)
+    transform = running_transform.inverse()
+    for block in interpolation_range:
+        selections, offsets = [], []
+        for indexes, block_start, block_size in zip(
+            cut_indexes, (block.xmi, block.ymi, block.zmi), (block.dx, block.dy, block.dz)
+        ):
+            selection = np.nonzero((indexes >= block_start) & (indexes < block_start + block_size))[0]
+            selections.append(selection)
+            offsets.append(indexes[selection] - block_start)
+        if any(len(selection) == 0 for selection in selections):
+            continue
+
+        arr = np.zeros((block.dx, block.dy, block.dz), dtype=np.float32)
+        xmap.interpolate_values(arr, transform.combine(transform_to_gemmi(block.transform)))
+        cut_array[np.ix_(*selections)] = arr[np.ix_(*offsets)]
+
+    grid = gemmi.FloatGrid(*cut_array.shape)
+    grid.set_unit_cell(reference_xmap.unit_cell)
+    grid.spacegroup = gemmi.SpaceGroup("P1")
+    np.array(grid, copy=False)[:, :, :] = cut_array
+
+    ccp4 = gemmi.Ccp4Map()
+    ccp4.grid = grid
+    ccp4.update_ccp4_header()
+
+    # Place the box in the reference cell
+    for axis, (start, n) in enumerate(zip(starts, grid_sizes)):
+        ccp4.set_header_i32(5 + axis, start)
+        ccp4.set_header_i32(8 + axis, n)
+
+    return ccp4
+
+
+def _write_aligned_xmap(
+    reference_xmap,
+    xmap,
+    interpolation_range: list[Block],
+    running_transform,
+    output_path: Path,
+    crystallographic_output_path,
+    aligned_res,
+):
+    # Sample the xmap into the aligned structure frame
+    resampled_xmap = _sample_ligand_frame(
         reference_xmap,
         xmap,
         interpolation_range,
-        running_transform.inverse(),
+        running_transform,
+        aligned_res,
     )
 
-    # Resample the xmap to the aligned structure frame
-    resampled_xmap = resample_xmap(new_xmap, aligned_res)
-
     # Output the xmap
-    # _write_xmap(
-    #     new_xmap,
-    #     output_path,
-    #     neighbourhood,
-    #     running_transform,
-    # )
-
     _write_xmap_from_ccp4(
         resampled_xmap,
         output_path,
     )
 
     # Write a restricted crystallographic map
-    _write_cut_xmap(new_xmap, aligned_res, crystallographic_output_path)
+    _write_xmap_from_ccp4(
+        _get_cut_xmap(reference_xmap, xmap, interpolation_range, running_transform, aligned_res),
+        crystallographic_output_path,
+    )
+
+
+def __align_xmap(
+    neighbourhood: dt.Neighbourhood,
+    g,
+    ligand_neighbourhood_transforms: dict[tuple[tuple[str, str, str], tuple[str, str, str]], dt.Transform],
+    reference_xmap,
+    subsite_reference_id: tuple[str, str, str],
+    lid: tuple[str, str, str],
+    xmap,
+    conformer_site_transforms,
+    conformer_site_id,
+    # canonical_site_transforms,
+    canonical_site_id,
+    output_path: Path,
+crystallographic_output_path,
+    aligned_res,
+chain_to_assembly_transform,
+assembly_transform
+):
+    # Get the Transform from the native frame to the site frame
+    running_transform = _get_ligand_to_site_transform(
+        g,
+        ligand_neighbourhood_transforms,
+        lid,
+        subsite_reference_id,
+        chain_to_assembly_transform,
+        assembly_transform,
+    )
+
+    # Define the interpolation range
+    interpolation_range = _get_interpolation_range(neighbourhood, running_transform, reference_xmap)
+
+    # Interpolate, resample and write the maps
+    _write_aligned_xmap(
+        reference_xmap,
+        xmap,
+        interpolation_range,
+        running_transform,
+        output_path,
+        crystallographic_output_path,
+        aligned_res,
+    )
+
 
+class GridTemplate:
+    # The shape and cell of the reference map, which is all interpolation needs of it
+    def __init__(self, nu: int, nv: int, nw: int, unit_cell_parameters: tuple[float, ...]):
+        self.nu = nu
+        self.nv = nv
+        self.nw = nw
+        self.unit_cell_parameters = unit_cell_parameters
+
+    @property
+    def unit_cell(self):
+        return gemmi.UnitCell(*self.unit_cell_parameters)
+
+    @staticmethod
+    def from_grid(grid):
+        return GridTemplate(grid.nu, grid.nv, grid.nw, tuple(grid.unit_cell.parameters))
+
+
+class AlignedXmapJob:
+    # A map of a dataset to align to a site: the map to read, its precomputed transform to the site frame and
+    # interpolation blocks, and where to write it
+    def __init__(
+        self,
+        map_type: str,
+        xmap_path: str,
+        transform: dt.Transform,
+        interpolation_range: list[Block],
+        aligned_structure_path: str,
+        chain: str,
+        residue: str,
+        output_path: str,
+        crystallographic_output_path: str,
+    ):
+        self.map_type = map_type
+        self.xmap_path = xmap_path
+        self.transform = transform
+        self.interpolation_range = interpolation_range
+        self.aligned_structure_path = aligned_structure_path
+        self.chain = chain
+        self.residue = residue
+        self.output_path = output_path
+        self.crystallographic_output_path = crystallographic_output_path
+
+
+MTZ_MAP_TYPES = ("2Fo-Fc", "Fo-Fc")
+
+
+class XmapProvider:
+    # Reads the maps of aligned map jobs, keeping the most recently used grids in memory up to a budget in
+    # bytes. Each MTZ is read and transformed once for both its 2Fo-Fc and Fo-Fc maps
+    def __init__(self, max_bytes: int = constants.XMAP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._grids = OrderedDict()
+
+    def get(self, xmap_path, map_type: str):
+        key = (str(xmap_path), map_type)
+        if key in self._grids:
+            self._grids.move_to_end(key)
+            return self._grids[key]
+
+        if map_type == "event":
+            grid = read_xmap(xmap_path)
+        else:
+            mtz = gemmi.read_mtz_file(str(xmap_path))
+            grid = _get_xmap_from_mtz(mtz, xmap_path, map_type)
+
+            # The other map comes from the same reflections, so transform it now rather than rereading. A
+            # missing map is not an error until it is asked for
+            for other_map_type in MTZ_MAP_TYPES:
+                if other_map_type != map_type:
+                    try:
+                        other_grid = _get_xmap_from_mtz(mtz, xmap_path, other_map_type)
+                        self._insert((str(xmap_path), other_map_type), other_grid)
+                    except Exception:
+                        logger.info(f"No {other_map_type} map in {xmap_path}")
+
+        self._insert(key, grid)
+        return grid
+
+    def _insert(self, key, grid):
+        if key in self._grids:
+            self.num_bytes -= _get_grid_bytes(self._grids.pop(key))
+        self._grids[key] = grid
+        self.num_bytes += _get_grid_bytes(grid)
+
+        # Evict the least recently used grids, always keeping the newest
+        while self.num_bytes > self.max_bytes and len(self._grids) > 1:
+            _key, evicted = self._grids.popitem(last=False)
+            self.num_bytes -= _get_grid_bytes(evicted)
+
+
+def _get_grid_bytes(grid):
+    return grid.nu * grid.nv * grid.nw * np.dtype(np.float32).itemsize
+
+
+def _read_job_xmap(job: AlignedXmapJob, xmap_provider: XmapProvider | None = None):
+    if xmap_provider is not None:
+        return xmap_provider.get(job.xmap_path, job.map_type)
+    if job.map_type == "event":
+        return read_xmap(job.xmap_path)
+    else:
+        return read_xmap_from_mtz(job.xmap_path, job.map_type)
+
+
+def _write_dataset_aligned_xmaps(
+    reference_grid: GridTemplate,
+    jobs: list[AlignedXmapJob],
+    xmap_cache_bytes: int = constants.XMAP_CACHE_BYTES,
+):
+    # Write all the aligned maps of one dataset, returning the error for any that could not be written rather
+    # than stopping at the first
+    errors = []
+    xmap_provider = XmapProvider(xmap_cache_bytes)
+    aligned_structures = {}
+    for job in jobs:
+        try:
+            if job.aligned_structure_path not in aligned_structures:
+                aligned_structures[job.aligned_structure_path] = gemmi.read_structure(str(job.aligned_structure_path))
+            aligned_res = aligned_structures[job.aligned_structure_path][0][job.chain][str(job.residue)][0]
+
+            _write_aligned_xmap(
+                reference_grid,
+                _read_job_xmap(job, xmap_provider),
+                job.interpolation_range,
+                transform_to_gemmi(job.transform),
+                job.output_path,
+                job.crystallographic_output_path,
+                aligned_res,
+            )
+            errors.append(None)
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    return errors
+
+
+def _write_aligned_xmaps(
+    dataset_jobs: dict[str, list[AlignedXmapJob]],
+    reference_grid: GridTemplate,
+    num_workers: int = 1,
+    xmap_cache_bytes: int = constants.XMAP_CACHE_BYTES,
+):
+    # Write the aligned maps with one task per dataset, returning the written and failed output paths. Only
+    # num_workers datasets have maps in memory at once
+    results = {}
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                dtag: executor.submit(_write_dataset_aligned_xmaps, reference_grid, jobs, xmap_cache_bytes)
+                for dtag, jobs in dataset_jobs.items()
+            }
+            for dtag, future in futures.items():
+                try:
+                    results[dtag] = future.result()
+                except Exception:
+                    results[dtag] = [traceback.format_exc() for _job in dataset_jobs[dtag]]
+    else:
+        for dtag, jobs in dataset_jobs.items():
+            results[dtag] = _write_dataset_aligned_xmaps(reference_grid, jobs, xmap_cache_bytes)
+
+    summary = {"written": [], "failed": {}}
+    for dtag, jobs in dataset_jobs.items():
+        for job, error in zip(jobs, results[dtag]):
+            if error is None:
+                summary["written"].append(job.output_path)
+            else:
+                logger.error(f"Failed to write aligned map {job.output_path} for dataset {dtag}:\n{error}")
+                summary["failed"][job.output_path] = error
+
+    return summary
 
 
 def read_xmap_from_mtz(
@@ -638,6 +1001,10 @@ def read_xmap_from_mtz(
 ):
     mtz = gemmi.read_mtz_file(str(mtz_path))
 
+    return _get_xmap_from_mtz(mtz, mtz_path, map_type)
+
+
+def _get_xmap_from_mtz(mtz, mtz_path, map_type="2Fo-Fc"):
     if map_type == "2Fo-Fc":
         try:
             grid = mtz.transform_f_phi_to_map("2FOFCWT", "PH2FOFCWT", sample_rate=4)
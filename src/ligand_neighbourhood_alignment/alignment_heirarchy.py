@@ -1,3 +1,5 @@
+import functools
+
 from rich import print as rprint
 import gemmi
 import numpy as np
@@ -95,6 +97,21 @@ def structure_to_landmarks(st):
     return landmarks
 
 
+@functools.lru_cache(maxsize=None)
+def _get_op(triplet):
+    # The same few operators are parsed for every chain of every dataset, so keep them
+    return gemmi.Op(triplet)
+
+
+def _get_transformed_chain(chain, cell, op):
+    # Apply a symmetry operator to a copy of the chain as one orthogonal transform over all of its atoms, rather than
+    # converting each atom to and from fractional coordinates
+    model = gemmi.Model("0")
+    model.add_chain(chain)
+    model.transform_pos_and_adp(cell.op_as_transform(op))
+    return model[0]
+
+
 def _get_assembly_st(as1, as1_ref):
     # Setup new structure to add biochains to
     new_st = gemmi.Structure()
@@ -104,18 +121,10 @@ def _get_assembly_st(as1, as1_ref):
     # Iterate over chain, biochain, transform tuples in the assembly
     for generator in as1.generators:
         # Generate the symmetry operation
-        op = gemmi.Op(generator.triplet)
-
-        # Create a clone of base chain to transform
-        new_chain = as1_ref[0][generator.chain].clone()
-
-        # Transform the residues
-        for residue in new_chain:
-            for atom in residue:
-                atom_frac = as1_ref.cell.fractionalize(atom.pos)
-                new_pos_frac = op.apply_to_xyz([atom_frac.x, atom_frac.y, atom_frac.z])
-                new_pos_orth = as1_ref.cell.orthogonalize(gemmi.Fractional(*new_pos_frac))
-                atom.pos = gemmi.Position(*new_pos_orth)
+        op = _get_op(generator.triplet)
+
+        # Create a transformed copy of the base chain
+        new_chain = _get_transformed_chain(as1_ref[0][generator.chain], as1_ref.cell, op)
         new_chain.name = generator.biomol
         new_st[0].add_chain(new_chain)
 
@@ -295,18 +304,10 @@ def _generate_assembly_from_xtalform(
             xtalform_assembly.transforms,
     ):
         # Generate the symmetry operation
-        op = gemmi.Op(transform)
-
-        # Create a clone of base chain to transform
-        new_chain = st[0][chain].clone()
-
-        # Transform the residues
-        for residue in new_chain:
-            for atom in residue:
-                atom_frac = st.cell.fractionalize(atom.pos)
-                new_pos_frac = op.apply_to_xyz([atom_frac.x, atom_frac.y, atom_frac.z])
-                new_pos_orth = st.cell.orthogonalize(gemmi.Fractional(*new_pos_frac))
-                atom.pos = gemmi.Position(*new_pos_orth)
+        op = _get_op(transform)
+
+        # Create a transformed copy of the base chain
+        new_chain = _get_transformed_chain(st[0][chain], st.cell, op)
         new_chain.name = biomol
         new_st[0].add_chain(new_chain)
 
@@ -404,8 +405,11 @@ def chain_to_assembly_transforms_to_dict(chain_to_assembly_transforms: dict[tupl
 
 def dict_to_chain_to_assembly_transforms(dic):
     obj = {}
+    if not dic:
+        return obj
     for k, v in dic.items():
-        obj[(x for x in '~'.split(k))] = v
+        dtag, chain = k.split('~')
+        obj[(dtag, chain)] = v
 
     return obj
 
@@ -1,6 +1,9 @@
 import json
 import os
 import sys
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 # import os
 import subprocess
@@ -20,6 +23,8 @@ logger.add(sys.stdout, level="WARNING")
 from rich import print
 
 from ligand_neighbourhood_alignment import constants
+from ligand_neighbourhood_alignment.discovery_cache import DiscoveryCache
+from ligand_neighbourhood_alignment.structure_cache import StructureCache, StructureRegistry
 from ligand_neighbourhood_alignment.align_xmaps import _align_xmaps
 
 # from ligand_neighbourhood_alignment.get_system_sites import get_system_sites
@@ -71,8 +76,13 @@ from ligand_neighbourhood_alignment.generate_sites_from_components import (  # g
     _update_conformer_site_transforms,
     _update_canonical_site_transforms,
     _update_reference_structure_transforms,
+    _get_xtalform_site_index,
+    _get_xtalform_site,
+)
+from ligand_neighbourhood_alignment.get_alignability import (
+    get_alignability,
+    _update_ligand_neighbourhood_transforms_incremental,
 )
-from ligand_neighbourhood_alignment.get_alignability import get_alignability, _update_ligand_neighbourhood_transforms
 from ligand_neighbourhood_alignment.get_graph import get_graph
 from ligand_neighbourhood_alignment.get_ligand_neighbourhoods import get_ligand_neighbourhoods
 from ligand_neighbourhood_alignment.make_data_json import (
@@ -80,8 +90,19 @@ from ligand_neighbourhood_alignment.make_data_json import (
     get_ligand_binding_events_from_structure,
     make_data_json_from_pandda_dir,
 )
-from ligand_neighbourhood_alignment.generate_aligned_structures import _align_structure, _align_reference_structure
-from ligand_neighbourhood_alignment.align_xmaps import read_xmap, read_xmap_from_mtz, __align_xmap
+from ligand_neighbourhood_alignment.generate_aligned_structures import (
+    _align_reference_structure,
+    _write_dataset_aligned_structures,
+    AlignedStructureJob,
+)
+from ligand_neighbourhood_alignment.align_xmaps import (
+    read_xmap_from_mtz,
+    _get_interpolation_range,
+    LigandSiteTransforms,
+    _write_aligned_xmaps,
+    AlignedXmapJob,
+    GridTemplate,
+)
 from ligand_neighbourhood_alignment import alignment_heirarchy
 
 
@@ -421,28 +442,18 @@ def _assign_xtalforms(
     return assigned_xtalforms
 
 
-def _get_structures(datasets):
+def _read_structure(pdb, structure_cache: StructureCache | None = None, correct_cell: bool = True):
+    # Every stage reads dataset structures through here. Structures without a real cell get a box around their atoms,
+    # which the cache works out once per file
+    if structure_cache is None:
+        structure_cache = StructureCache()
+    return structure_cache.read(pdb, correct_cell=correct_cell)
+
+
+def _get_structures(datasets, structure_cache: StructureCache | None = None):
     structures = {}
     for dtag, dataset in datasets.items():
-        structure: gemmi.Structure = gemmi.read_structure(dataset.pdb)
-        # if structure.cell.a == 0.0:
-        cell = structure.cell
-
-        if cell.a == 1.0:
-            poss = []
-            for model in structure:
-                for chain in model:
-                    for residue in chain:
-                        for atom in residue:
-                            pos = atom.pos
-                            poss.append((pos.x, pos.y, pos.z))
-            pos_array = np.array(poss)
-
-            cell_lengths = np.max(pos_array, axis=0) - np.min(pos_array, axis=0)
-
-            structure.cell = gemmi.UnitCell(cell_lengths[0], cell_lengths[1], cell_lengths[2], 90.0, 90.0, 90.0)
-        # print(structure.cell.a)
-        structures[dataset.dtag] = structure
+        structures[dataset.dtag] = _read_structure(dataset.pdb, structure_cache)
 
     return structures
 
@@ -562,10 +573,10 @@ def _generate_assembly(xtalform: dt.XtalForm, structure, assemblies: dict[str, d
 
             # for generator in assembly.generators:
             #     op = gemmi.Op(generator.triplet)
-            op = gemmi.Op(_transform)
+            op = alignment_heirarchy._get_op(_transform)
             # chain_clone = structure[0][generator.chain].clone()
             try:
-                chain_clone = structure[0][_chain].clone()
+                chain = structure[0][_chain]
             except Exception as e:
                 raise Exception(
                     f"An Exception occurred in generating the biological assemblies for\n"
@@ -576,12 +587,7 @@ def _generate_assembly(xtalform: dt.XtalForm, structure, assemblies: dict[str, d
                     "You should ensure that the chain names are consistent with the reference dataset for the xtalforms."
                 )
 
-            for residue in chain_clone:
-                for atom in residue:
-                    atom_frac = structure.cell.fractionalize(atom.pos)
-                    new_pos_frac = op.apply_to_xyz([atom_frac.x, atom_frac.y, atom_frac.z])
-                    new_pos_orth = structure.cell.orthogonalize(gemmi.Fractional(*new_pos_frac))
-                    atom.pos = gemmi.Position(*new_pos_orth)
+            chain_clone = alignment_heirarchy._get_transformed_chain(chain, structure.cell, op)
             chain_clone.name = f"{_chain}~{_biogen.biomol}~{_transform}"
             full_st[0].add_chain(chain_clone)
 
@@ -589,14 +595,8 @@ def _generate_assembly(xtalform: dt.XtalForm, structure, assemblies: dict[str, d
     for lbe in dataset.ligand_binding_events:
         _chain = lbe[1]
         if _chain not in cloned_chains:
-            op = gemmi.Op("x,y,z")
-            chain_clone = structure[0][_chain].clone()
-            for residue in chain_clone:
-                for atom in residue:
-                    atom_frac = structure.cell.fractionalize(atom.pos)
-                    new_pos_frac = op.apply_to_xyz([atom_frac.x, atom_frac.y, atom_frac.z])
-                    new_pos_orth = structure.cell.orthogonalize(gemmi.Fractional(*new_pos_frac))
-                    atom.pos = gemmi.Position(*new_pos_orth)
+            op = alignment_heirarchy._get_op("x,y,z")
+            chain_clone = alignment_heirarchy._get_transformed_chain(structure[0][_chain], structure.cell, op)
             chain_clone.name = f"{_chain}~{_chain}~x,y,z"
             full_st[0].add_chain(chain_clone)
             cloned_chains.append(_chain)
@@ -646,11 +646,16 @@ from ligand_neighbourhood_alignment.get_ligand_neighbourhoods import _get_ligand
 
 
 def _get_dataset_neighbourhoods(
-        dataset: dt.Dataset, xtalform: dt.XtalForm, assemblies: dict[str, dt.Assembly], version, max_radius: float = 9.0
+        dataset: dt.Dataset,
+        xtalform: dt.XtalForm,
+        assemblies: dict[str, dt.Assembly],
+        version,
+        max_radius: float = 9.0,
+        structure_cache: StructureCache | None = None,
 ) -> dict[tuple[str, str, str, str], dt.Neighbourhood]:
-    # Load the structure
+    # Load the structure, keeping its own cell
     logger.debug(dataset.pdb)
-    structure = gemmi.read_structure(dataset.pdb)
+    structure = _read_structure(dataset.pdb, structure_cache, correct_cell=False)
     logger.debug(f"{structure.cell}")
 
     # Get the rest of the assembly
@@ -687,31 +692,164 @@ def _get_neighbourhoods(
         xtalform: dt.XtalForm,
         assemblies: dict[str, dt.Assembly],
         version,
+        structure_cache: StructureCache | None = None,
 ):
     dataset_ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood] = _get_dataset_neighbourhoods(
-        dataset, xtalform, assemblies, version
+        dataset, xtalform, assemblies, version, structure_cache=structure_cache
     )
     return dataset_ligand_neighbourhoods
 
 
+def _get_neighbourhoods_or_error(
+        dataset: dt.Dataset,
+        xtalform: dt.XtalForm,
+        assemblies: dict[str, dt.Assembly],
+        version,
+        structure_cache: StructureCache | None = None,
+):
+    # Return any error instead of raising it so that one bad dataset does not stop the others
+    try:
+        return _get_neighbourhoods(dataset, xtalform, assemblies, version, structure_cache), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _get_neighbourhoods_or_error_in_worker(
+        dataset: dt.Dataset,
+        xtalform: dt.XtalForm,
+        assemblies: dict[str, dt.Assembly],
+        version,
+        structure_cache: StructureCache,
+):
+    # Also return the worker's structure cache, so what it found can be merged back
+    return (*_get_neighbourhoods_or_error(dataset, xtalform, assemblies, version, structure_cache), structure_cache)
+
+
+def _get_new_neighbourhoods(
+        new_datasets: dict[str, dt.Dataset],
+        xtalforms: dict[str, dt.XtalForm],
+        dataset_assignments: dict[str, str],
+        assemblies: dict[str, dt.Assembly],
+        version,
+        num_workers: int = 1,
+        structure_cache: StructureCache | None = None,
+):
+    # Get the neighbourhoods of each new dataset, in the order of new_datasets, along with the errors of any
+    # datasets that failed
+    if structure_cache is None:
+        structure_cache = StructureCache()
+    dataset_neighbourhoods = {}
+    failures = {}
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Each worker is only sent the cache entry of its own dataset
+            futures = {
+                dtag: executor.submit(
+                    _get_neighbourhoods_or_error_in_worker,
+                    dataset,
+                    xtalforms[dataset_assignments[dtag]],
+                    assemblies,
+                    version,
+                    structure_cache.get_subset([dataset.pdb]),
+                )
+                for dtag, dataset in new_datasets.items()
+            }
+            for dtag, future in futures.items():
+                try:
+                    dataset_neighbourhoods[dtag], failures[dtag], worker_structure_cache = future.result()
+                    structure_cache.update(worker_structure_cache)
+                except Exception:
+                    dataset_neighbourhoods[dtag], failures[dtag] = None, traceback.format_exc()
+    else:
+        for dtag, dataset in new_datasets.items():
+            dataset_neighbourhoods[dtag], failures[dtag] = _get_neighbourhoods_or_error(
+                dataset,
+                xtalforms[dataset_assignments[dtag]],
+                assemblies,
+                version,
+                structure_cache,
+            )
+
+    failures = {dtag: error for dtag, error in failures.items() if error is not None}
+    for dtag, error in failures.items():
+        logger.error(f"Failed to get ligand neighbourhoods for dataset {dtag}:\n{error}")
+        del dataset_neighbourhoods[dtag]
+
+    return dataset_neighbourhoods, failures
+
+
+def _write_dataset_aligned_structures_from_pdb(
+        pdb,
+        jobs: list[AlignedStructureJob],
+        structure_cache: StructureCache | None = None,
+):
+    # Load the dataset's structure once for all of its outputs. The worker's structure cache is returned along with the
+    # errors, so what it found can be merged back
+    try:
+        structure = _read_structure(pdb, structure_cache)
+    except Exception:
+        return [traceback.format_exc() for _job in jobs], structure_cache
+    return _write_dataset_aligned_structures(structure, jobs), structure_cache
+
+
+def _write_aligned_structures(
+        dataset_jobs: dict[str, list[AlignedStructureJob]],
+        datasets: dict[str, dt.Dataset],
+        structures,
+        num_workers: int = 1,
+        structure_cache: StructureCache | None = None,
+):
+    # Write the aligned structures with one task per dataset, returning the written and failed output paths
+    if structure_cache is None:
+        structure_cache = StructureCache()
+    results = {}
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Each worker is only sent the cache entry of its own dataset
+            futures = {
+                dtag: executor.submit(
+                    _write_dataset_aligned_structures_from_pdb,
+                    datasets[dtag].pdb,
+                    jobs,
+                    structure_cache.get_subset([datasets[dtag].pdb]),
+                )
+                for dtag, jobs in dataset_jobs.items()
+            }
+            for dtag, future in futures.items():
+                try:
+                    results[dtag], worker_structure_cache = future.result()
+                    structure_cache.update(worker_structure_cache)
+                except Exception:
+                    results[dtag] = [traceback.format_exc() for _job in dataset_jobs[dtag]]
+    else:
+        for dtag, jobs in dataset_jobs.items():
+            results[dtag] = _write_dataset_aligned_structures(structures[dtag], jobs)
+
+    summary = {"written": [], "failed": {}}
+    for dtag, jobs in dataset_jobs.items():
+        for job, error in zip(jobs, results[dtag]):
+            if error is None:
+                summary["written"].append(job.out_path)
+            else:
+                logger.error(f"Failed to generate aligned structure {job.out_path} for dataset {dtag}:\n{error}")
+                summary["failed"][job.out_path] = error
+
+    return summary
+
+
 def _save_neighbourhoods(
         fs_model: dt.FSModel,
         ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
 ):
-    with open(fs_model.ligand_neighbourhoods, "w") as f:
-        dic = {}
-        for ligand_id, neighbourhood in ligand_neighbourhoods.items():
-            dic["/".join(ligand_id)] = neighbourhood.to_dict()
-        yaml.safe_dump(dic, f)
+    if not isinstance(ligand_neighbourhoods, dt.NeighbourhoodStore):
+        ligand_neighbourhoods = dt.NeighbourhoodStore.from_neighbourhoods(ligand_neighbourhoods)
+    ligand_neighbourhoods.to_npz(fs_model.ligand_neighbourhoods)
 
 
 def _save_ligand_neighbourhood_transforms(fs_model, ligand_neighbourhood_transforms):
-    with open(fs_model.ligand_neighbourhood_transforms, "w") as f:
-        dic = {}
-        for (to_ligand_id, from_ligand_id), transform in ligand_neighbourhood_transforms.items():
-            key = "~".join(["/".join(to_ligand_id), "/".join(from_ligand_id)])
-            dic[key] = transform.to_dict()
-        yaml.safe_dump(dic, f)
+    if not isinstance(ligand_neighbourhood_transforms, dt.TransformStore):
+        ligand_neighbourhood_transforms = dt.TransformStore.from_transforms(ligand_neighbourhood_transforms)
+    ligand_neighbourhood_transforms.save(fs_model.ligand_neighbourhood_transforms)
 
 
 def _update_graph(
@@ -758,53 +896,56 @@ def _get_connected_components(alignability_graph, clusters, max_path_length=2):
 
 
     """
+    # Path lengths count nodes, so a path length of 2 is a single edge. Nodes are visited in graph order
+    node_order = {node: j for j, node in enumerate(alignability_graph.nodes)}
+
+    def _get_near_nodes(source, path_length):
+        if (source not in node_order) or (path_length < 1):
+            return []
+        near = nx.single_source_shortest_path_length(alignability_graph, source, cutoff=path_length - 1)
+        return sorted(near, key=lambda _x: node_order[_x])
+
+    # The number of nodes within the max path length of each node, counting itself twice as a self loop
+    degrees = {}
+    for node in alignability_graph.nodes:
+        if max_path_length < 1:
+            degrees[node] = 0
+        else:
+            degrees[node] = len(_get_near_nodes(node, max_path_length)) + 1
 
-    # Get the graph of short paths
-    path = dict(nx.all_pairs_shortest_path(alignability_graph))
-    path_lengths = {(source, target): len(path[source][target]) for source in path for target in path[source]}
-    H = nx.Graph()
-    for node in path:
-        H.add_node(node)
-    for source, target in path_lengths:
-        if path_lengths[(source, target)] <= max_path_length:
-            H.add_edge(source, target)
-
-    #
-    degrees = dict(nx.degree(H))
-
-    # Replay cluster cores
-    used = [member for cluster in clusters for member in cluster]
+    # Replay cluster cores. Only nodes claimed during this call count as used, so each core recollects its
+    # neighbours
+    used = set()
     for x in clusters:
-        for target in H.nodes:
+        for target in _get_near_nodes(x, 2):
             if target in used:
                 continue
-            if (x, target) not in path_lengths:
-                continue
-            if path_lengths[(x, target)] <= 2:
-                used.append(target)
-                clusters[x].append(target)
+            used.add(target)
+            clusters[x].append(target)
 
     # Now go through any new ligands that are not yet connected, constructing clusters for them
     for x in sorted(degrees, key=lambda _x: degrees[_x], reverse=True):
         if x in used:
             continue
         clusters[x] = []
-        # print(f"f{x} : {degrees[x]}")
-
-        # for n in G.neighbors(x):
-        # used.append(n)
-        for target in H.nodes:
+        for target in _get_near_nodes(x, 2):
             if target in used:
                 continue
-            if (x, target) not in path_lengths:
-                continue
-            if path_lengths[(x, target)] <= 2:
-                used.append(target)
-                clusters[x].append(target)
+            used.add(target)
+            clusters[x].append(target)
 
     return clusters
 
 
+def _get_conformer_site_index(conformer_sites: dict[str, dt.ConformerSite]):
+    # The IDs of the conformer sites each ligand is a member of
+    conformer_site_index = {}
+    for conformer_site_id, conformer_site in conformer_sites.items():
+        for lid in conformer_site.member_set:
+            conformer_site_index.setdefault(lid, set()).add(conformer_site_id)
+    return conformer_site_index
+
+
 def _update_conformer_sites(
         conformer_sites: dict[str, dt.ConformerSite],
         connected_component_id: tuple[str, str, str, str],
@@ -814,17 +955,24 @@ def _update_conformer_sites(
         assemblies,
         xtalforms,
         xtalform_assignments,
+        conformer_site_index=None,
 ):
-    matched = False
+    if conformer_site_index is None:
+        conformer_site_index = _get_conformer_site_index(conformer_sites)
+
     # Check each old conformer site for overlap in membership, and if so update its members
-    for conformer_site_id, conformer_site in conformer_sites.items():
-        num_overlaps = set(connected_component).intersection(set(conformer_site.members))
-        if len(num_overlaps) > 0:
-            matched = True
-            # Match, add each new ligand id to the conformer site's members
-            for lid in connected_component:
-                if lid not in conformer_site.members:
-                    conformer_site.members.append(lid)
+    matched_conformer_site_ids = {
+        conformer_site_id
+        for lid in connected_component
+        for conformer_site_id in conformer_site_index.get(lid, ())
+    }
+    matched = len(matched_conformer_site_ids) > 0
+    for conformer_site_id in matched_conformer_site_ids:
+        conformer_site = conformer_sites[conformer_site_id]
+        # Match, add each new ligand id to the conformer site's members
+        for lid in connected_component:
+            if conformer_site.add_member(lid):
+                conformer_site_index.setdefault(lid, set()).add(conformer_site_id)
 
     # Otherwise create a new conformer site
     if not matched:
@@ -856,7 +1004,12 @@ def _update_conformer_sites(
             connected_component_id,
         )
         conformer_site_id = "+".join(conformer_site.reference_ligand_id)
+        if conformer_site_id in conformer_sites:
+            for lid in conformer_sites[conformer_site_id].member_set:
+                conformer_site_index[lid].discard(conformer_site_id)
         conformer_sites[conformer_site_id] = conformer_site
+        for lid in conformer_site.member_set:
+            conformer_site_index.setdefault(lid, set()).add(conformer_site_id)
 
 
 def _save_connected_components(fs_model, connected_components):
@@ -893,38 +1046,87 @@ def _get_centroid_res(
     return (closest_atom_id[0], closest_atom_id[1])
 
 
+def _get_observation_centroid(neighbourhood: dt.Neighbourhood):
+    # The centroid residue of an observation's neighbourhood and the position of its CA
+    centroid_res = _get_centroid_res(
+        [_x for _x in set([(aid[0], aid[1]) for aid in neighbourhood.atoms])],
+        neighbourhood
+    )
+    atom = neighbourhood.atoms[(centroid_res[0], centroid_res[1], 'CA')]
+    return (centroid_res[0], centroid_res[1], atom.x, atom.y, atom.z)
+
+
+class _CanonicalSiteIndex:
+    # The canonical sites each residue (number and name) is in and the canonical site each conformer site is in, so
+    # matching a conformer site does not need to go through every canonical site's residues
+    def __init__(self, canonical_sites: dict[str, dt.CanonicalSite]):
+        self.residue_canonical_site_ids = {}
+        self.conformer_canonical_site_ids = {}
+        self.num_residues = {}
+        self.order = {}
+        self.empty_canonical_site_ids = []
+        for canonical_site_id, canonical_site in canonical_sites.items():
+            self.add_canonical_site(canonical_site_id, canonical_site)
+
+    def add_canonical_site(self, canonical_site_id, canonical_site: dt.CanonicalSite):
+        self.order[canonical_site_id] = len(self.order)
+        self.num_residues[canonical_site_id] = len(canonical_site.residues)
+        if len(canonical_site.residues) == 0:
+            self.empty_canonical_site_ids.append(canonical_site_id)
+        for residue in set([(residue[1], residue[2]) for residue in canonical_site.residues]):
+            self.residue_canonical_site_ids.setdefault(residue, set()).add(canonical_site_id)
+        for conformer_site_id in canonical_site.conformer_site_ids:
+            self.add_conformer_site(conformer_site_id, canonical_site_id)
+
+    def add_conformer_site(self, conformer_site_id, canonical_site_id):
+        self.conformer_canonical_site_ids.setdefault(conformer_site_id, canonical_site_id)
+
+    def get_match(self, residues):
+        # The first canonical site sharing at least 3/4 of its residues (counted with repeats) with those given
+        num_shared = Counter(
+            canonical_site_id
+            for residue in set([(residue[1], residue[2]) for residue in residues])
+            for canonical_site_id in self.residue_canonical_site_ids.get(residue, ())
+        )
+        # Canonical sites without residues are matched by anything
+        matches = self.empty_canonical_site_ids + [
+            canonical_site_id
+            for canonical_site_id, num in num_shared.items()
+            if num >= 0.75 * self.num_residues[canonical_site_id]
+        ]
+        if len(matches) == 0:
+            return None
+        return min(matches, key=lambda _x: self.order[_x])
+
+
 def _update_canonical_sites(
         canonical_sites: dict[str, dt.CanonicalSite],
         conformer_site: dt.ConformerSite,
         conformer_site_id,
         neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
         min_shared_residues=6,
+        canonical_site_index=None,
 ):
+    if canonical_site_index is None:
+        canonical_site_index = _CanonicalSiteIndex(canonical_sites)
+
     if len(canonical_sites) != 0:
         global_reference_dtag = [x for x in canonical_sites.values()][0].global_reference_dtag
     else:
         global_reference_dtag = conformer_site.reference_ligand_id[0]
 
     # If conformer site already in a canonical site skip
-    for canonical_site_id, canonical_site in canonical_sites.items():
-        if conformer_site_id in canonical_site.conformer_site_ids:
-            return
+    if conformer_site_id in canonical_site_index.conformer_canonical_site_ids:
+        return
 
-            # Check each canonical site to see if conformer site already in it and if not
-    # whether it shares enough residues to now be added
+    # Check whether the conformer site shares enough residues with a canonical site to now be added to it
     matched = False
-    conformer_site_residues = [(residue[1], residue[2]) for residue in conformer_site.residues]
-    for canonical_site_id, canonical_site in canonical_sites.items():
-        if matched:
-            continue
-        canonical_site_residues = [(residue[1], residue[2]) for residue in canonical_site.residues]
-        if conformer_site_id not in canonical_site.conformer_site_ids:
-            v = set(canonical_site_residues).intersection(set(conformer_site_residues))
-            # if len(v) >= min(min_shared_residues, int((3/4)*len(canonical_site_residues))):
-            if len(v) >= 0.75 * len(canonical_site_residues):
-                # Matched!
-                matched = True
-                canonical_site.conformer_site_ids.append(conformer_site_id)
+    canonical_site_id = canonical_site_index.get_match(conformer_site.residues)
+    if canonical_site_id is not None:
+        # Matched!
+        matched = True
+        canonical_sites[canonical_site_id].conformer_site_ids.append(conformer_site_id)
+        canonical_site_index.add_conformer_site(conformer_site_id, canonical_site_id)
 
     # If not matched to any existing canonical site create a new one
     if not matched:
@@ -949,6 +1151,7 @@ def _update_canonical_sites(
 
         canonical_site_id = conformer_site_id
         canonical_sites[canonical_site_id] = canonical_site
+        canonical_site_index.add_canonical_site(canonical_site_id, canonical_site)
 
 
 def _save_canonical_sites(fs_model, canonical_sites: dict[str, dt.CanonicalSite]):
@@ -965,70 +1168,74 @@ def _get_dist(pos_1, pos_2):
     )
 
 
+def _get_near_matrix(positions, cutoff, block_size=256):
+    # Whether each pair of positions is within the cutoff, computed in blocks of rows to bound memory
+    near = np.zeros((len(positions), len(positions)), dtype=bool)
+    for start in range(0, len(positions), block_size):
+        differences = positions[start:start + block_size, np.newaxis, :] - positions[np.newaxis, :, :]
+        near[start:start + block_size] = np.sqrt(np.sum(np.square(differences), axis=2)) < cutoff
+    return near
+
+
 def _crystalform_incremental_cluster(
         observation_centroid_residues,
         xtalform_sites,
         neighbourhoods,
-        cutoff=10.0
+        cutoff=10.0,
+        centroid_ca_positions=None,
 ):
     # Check if each observation centroid is within 10A of an xtalform site centroid, and if so assign that dataset to it
     # If not, select the remainer with the most members within 10A and form a new "site" from it
     # Continue until all observations are assigned
 
-    # Get CA positions
-    centroid_ca_positions = {
-        observation_id: neighbourhoods[observation_id].atoms[(centroid_res[0], centroid_res[1], 'CA')]
-        for observation_id, centroid_res
-        in observation_centroid_residues.items()
-    }
+    # Get CA positions, unless they are given in the order of the observations
+    observation_ids = [observation_id for observation_id in observation_centroid_residues]
+    observation_indexes = {observation_id: j for j, observation_id in enumerate(observation_ids)}
+    if centroid_ca_positions is None:
+        centroid_ca_atoms = [
+            neighbourhoods[observation_id].atoms[(centroid_res[0], centroid_res[1], 'CA')]
+            for observation_id, centroid_res
+            in observation_centroid_residues.items()
+        ]
+        centroid_ca_positions = [[atom.x, atom.y, atom.z] for atom in centroid_ca_atoms]
+    centroid_ca_positions = np.array(centroid_ca_positions, dtype=float).reshape((-1, 3))
+    near = _get_near_matrix(centroid_ca_positions, cutoff)
 
     # Identify current xtalform centre residues (for the considered canonical site)
-    centre_residues_positions = {
-        xtalform_site_id: centroid_ca_positions[tuple(xtalform_site_id.split('/'))]
-        for xtalform_site_id in xtalform_sites
-    }
+    centre_ids = [xtalform_site_id for xtalform_site_id in xtalform_sites]
+    centre_indexes = [observation_indexes[tuple(xtalform_site_id.split('/'))] for xtalform_site_id in xtalform_sites]
 
-    # While observations remain to be assigned
     assignments = {xtalform_site_id: [_x for _x in xtalform_sites[xtalform_site_id].members] for xtalform_site_id in
                    xtalform_sites}
-    assigned_observations = [observation_id for xtalform_site_id in assignments for observation_id in
-                             assignments[xtalform_site_id]]
-    observations_to_assign = [observation_id for observation_id in centroid_ca_positions]
-
-    while len(observations_to_assign) > 0:
-        for observation_id in observations_to_assign:
-            # Assign observations near current xtalform sites
-            for xtalform_site_id, xtalform_site_pos in centre_residues_positions.items():
-                if _get_dist(centroid_ca_positions[observation_id], xtalform_site_pos) < cutoff:
-                    assignments[xtalform_site_id].append(observation_id)
-                    assigned_observations.append(observation_id)
-                    break
-
-        # Identify observation with most remaining items within 10A
-        remaining_observations = [_k for _k in observations_to_assign if _k not in assigned_observations]
-        if len(remaining_observations) == 0:
-            break
-        num_near = {
-            observation_id: len(
-                [
-                    other_observation_id
-                    for other_observation_id in remaining_observations
-                    if (_get_dist(centroid_ca_positions[observation_id],
-                                  centroid_ca_positions[other_observation_id]) < cutoff) & (
-                               observation_id != other_observation_id)
-                ]
-            )
-            for observation_id in remaining_observations
-        }
-        new_centroid_observation_id = min(num_near, key=lambda _x: num_near[_x])
-
-        # Add it to centre residue list
-        centre_residues_positions[new_centroid_observation_id] = centroid_ca_positions[new_centroid_observation_id]
-        assignments[new_centroid_observation_id] = []
-
-        # Update observations to assign
-        # assigned_observations.append(new_centroid_observation_id)
-        observations_to_assign = [_k for _k in observations_to_assign if _k not in assigned_observations]
+    assigned_observations = {observation_id for xtalform_site_id in assignments for observation_id in
+                             assignments[xtalform_site_id]}
+
+    # Assign observations, including current members, to the first current xtalform site they are near
+    if len(centre_indexes) > 0:
+        near_centres = near[:, centre_indexes]
+        for j in np.flatnonzero(near_centres.any(axis=1)).tolist():
+            assignments[centre_ids[int(np.argmax(near_centres[j]))]].append(observation_ids[j])
+            assigned_observations.add(observation_ids[j])
+
+    # Count the other remaining observations near each
+    remaining = np.array(
+        [j for j, observation_id in enumerate(observation_ids) if observation_id not in assigned_observations],
+        dtype=int,
+    )
+    is_remaining = np.zeros(len(observation_ids), dtype=bool)
+    is_remaining[remaining] = True
+    num_near = np.sum(near[:, is_remaining], axis=1) - is_remaining
+
+    # While observations remain to be assigned, form a new site from the remaining observation with the fewest
+    # remaining observations near it. The remaining observations were not near any earlier site, so they go to the
+    # new site if they are near it
+    while len(remaining) > 0:
+        new_centroid_index = remaining[np.argmin(num_near[remaining])]
+        new_centroid_observation_id = observation_ids[new_centroid_index]
+        is_near = near[remaining, new_centroid_index]
+        assignments[new_centroid_observation_id] = [observation_ids[j] for j in remaining[is_near].tolist()]
+        num_near = num_near - np.sum(near[:, remaining[is_near]], axis=1)
+        remaining = remaining[~is_near]
 
     return assignments
 
@@ -1059,55 +1266,62 @@ def _update_xtalform_sites(
         in set(dataset_assignments.values())
     }
 
-    # Get Observation centroid CA names and positions
-    crystalform_observation_centroids = {
-        xtalform_name: {
-            member: _get_centroid_res(
-                [_x for _x in set([(aid[0], aid[1]) for aid in neighbourhoods[member].atoms])],
-                neighbourhoods[member]
-            )
+    for xtalform_name, observations in crystalform_observations.items():
+        current_xtalform_sites = {
+            xid: xs for xid, xs in xtalform_sites.items()
+            if (xs.xtalform_id == xtalform_name) & (xs.canonical_site_id == canonical_site_id)
+        }
+
+        # Skip xtalforms with no new observations
+        assigned_observations = {member for xs in current_xtalform_sites.values() for member in xs.members}
+        if all(observation_id in assigned_observations for observation_id in observations):
+            continue
+
+        # Get Observation centroid CA names and positions, only working them out for observations not seen before
+        known_centroids = {
+            member: centroid for xs in current_xtalform_sites.values() for member, centroid in xs.member_centroids.items()
+        }
+        observation_centroids = {
+            member: known_centroids[member] if member in known_centroids else _get_observation_centroid(
+                neighbourhoods[member])
             for member
-            in crystalform_observations[xtalform_name]
+            in observations
         }
-        for xtalform_name in crystalform_observations
-    }
 
-    # Spatially cluster
-    crystalform_observation_cluster_assignments = {
-        xtalform_name: _crystalform_incremental_cluster(
-            crystalform_observation_centroids[xtalform_name],
-            {xid: xs for xid, xs in xtalform_sites.items() if
-             (xs.xtalform_id == xtalform_name) & (xs.canonical_site_id == canonical_site_id)},
-            neighbourhoods
+        # Spatially cluster
+        cluster_assignments = _crystalform_incremental_cluster(
+            {member: centroid[:2] for member, centroid in observation_centroids.items()},
+            current_xtalform_sites,
+            neighbourhoods,
+            centroid_ca_positions=[centroid[2:] for centroid in observation_centroids.values()],
         )
-        for xtalform_name in crystalform_observations
-    }
-
-    # if debug:
-    #     raise Exception
 
-    # Create the xtalforms or assign new observations
-    for xtalform_name in crystalform_observation_cluster_assignments:
-        for centroid_residue, asigned_observation_ids in crystalform_observation_cluster_assignments[
-            xtalform_name].items():
+        # Create the xtalforms or assign new observations
+        for centroid_residue, asigned_observation_ids in cluster_assignments.items():
 
             # If the centroid is known, assign any new observations
             if centroid_residue in xtalform_sites:
+                xtalform_site = xtalform_sites[centroid_residue]
                 for asigned_observation_id in asigned_observation_ids:
-                    if asigned_observation_id not in xtalform_sites[centroid_residue].members:
-                        xtalform_sites[centroid_residue].members.append(asigned_observation_id)
+                    if asigned_observation_id not in xtalform_site.members:
+                        xtalform_site.members.append(asigned_observation_id)
 
             # Otherwise create a new crystalform site
             else:
                 xtalform_site_id = "/".join(centroid_residue)
                 xtalform_site = dt.XtalFormSite(
                     xtalform_name,
-                    crystalform_observation_centroids[xtalform_name][centroid_residue][0],
+                    observation_centroids[centroid_residue][0],
                     canonical_site_id,
                     asigned_observation_ids,
                 )
                 xtalform_sites[xtalform_site_id] = xtalform_site
 
+            # Keep the centroids of the members so they are not worked out again
+            for member in xtalform_site.members:
+                if member in observation_centroids:
+                    xtalform_site.member_centroids[member] = observation_centroids[member]
+
     # raise Exception
     #
     # matched = False
@@ -1378,10 +1592,17 @@ def _update(
         assembly_landmarks,
         assembly_transforms,
         version,
+        full_rematch: bool = False,
+        num_workers: int = 1,
+        num_xmap_workers=None,
+        structure_cache: StructureCache | None = None,
+        structure_registry_bytes: int = constants.STRUCTURE_REGISTRY_BYTES,
 ):
     logger.info(f"Version is: {version}")
-    # Get the structures
-    structures: dict = _get_structures(datasets)
+    # Get the structures, which are read as they are needed and only as many as fit the budget are kept in memory
+    if structure_cache is None:
+        structure_cache = StructureCache(fs_model.source_dir / constants.STRUCTURE_CACHE_YAML_FILE_NAME)
+    structures = StructureRegistry(datasets, structure_cache, max_bytes=structure_registry_bytes)
 
     # Get the assembly alignment hierarchy
     hierarchy, biochain_priorities = alignment_heirarchy._derive_alignment_heirarchy(assemblies)
@@ -1389,6 +1610,7 @@ def _update(
     alignment_heirarchy.save_yaml(fs_model.biochain_priorities, biochain_priorities, lambda x: x)
 
     # Get the assembly hierarchy transforms
+    structures.prefetch([assembly.reference for assembly in assemblies.values()])
     for assembly_name, assembly in assemblies.items():
         # Do not update if already have landmarks!
         if assembly_name in assembly_landmarks:
@@ -1411,6 +1633,7 @@ def _update(
 
     # Assign datasets
     new_dataset_assignments = {}
+    structures.prefetch(list(new_datasets))
     for dtag, dataset in new_datasets.items():
         new_dataset_assignments[dtag] = _assign_dataset(
             dataset,
@@ -1426,31 +1649,65 @@ def _update(
 
     # Get neighbourhoods
     logger.info(f"Updating neighbourhoods")
-    for dtag, dataset in new_datasets.items():
-        xtalform = xtalforms[dataset_assignments[dtag]]
-        neighborhoods = _get_neighbourhoods(dataset, xtalform, assemblies, version)
+    new_ligand_ids = []
+    new_neighbourhoods, neighbourhood_failures = _get_new_neighbourhoods(
+        new_datasets,
+        xtalforms,
+        dataset_assignments,
+        assemblies,
+        version,
+        num_workers=num_workers,
+        structure_cache=structure_cache,
+    )
+    for dtag, neighborhoods in new_neighbourhoods.items():
         logger.info(f"Dataset {dtag} has {len(neighborhoods)} ligand neighbourhoods")
         for lid, neighbourhood in neighborhoods.items():
             ligand_neighbourhoods[lid] = neighbourhood
+            new_ligand_ids.append(lid)
+    if len(neighbourhood_failures) > 0:
+        rprint(
+            f"Failed to get ligand neighbourhoods for {len(neighbourhood_failures)} datasets, which will not be "
+            f"aligned: {list(neighbourhood_failures)}"
+        )
     logger.info(f"Found {len(ligand_neighbourhoods)} ligand neighbourhoods!")
     _save_neighbourhoods(fs_model, ligand_neighbourhoods)
 
+    # The ligand IDs of each dataset, for the stages that work a dataset at a time
+    dataset_ligand_ids = {}
+    for lid in ligand_neighbourhoods:
+        dataset_ligand_ids.setdefault(lid[0], []).append(lid)
+
     # for nid, neighbourhood in ligand_neighbourhoods.items():
     #     print(nid)
     #     for atom_id in neighbourhood.atoms:
     #         if atom_id[2] == "CA":
     #             print(atom_id)
 
-    # Get chain to assembly transforms
+    # Get chain to assembly transforms, only reading the structures of datasets that do not have them all yet
     logger.info(f"Getting chain-to-assembly transforms...")
-    chain_to_assembly_transforms = {}
-    for dtag, st in structures.items():
-        xtalform_chains = [
+    known_chain_to_assembly_transforms = {}
+    if (not full_rematch) and fs_model.chain_to_assembly.exists():
+        known_chain_to_assembly_transforms = alignment_heirarchy.load_yaml(
+            fs_model.chain_to_assembly,
+            alignment_heirarchy.dict_to_chain_to_assembly_transforms,
+        )
+    dataset_xtalform_chains = {
+        dtag: [
             _chain for _xassembly in xtalforms[dataset_assignments[dtag]].assemblies.values() for _chain in
             _xassembly.chains]
+        for dtag in structures
+    }
+    missing_dtags = [
+        dtag for dtag, xtalform_chains in dataset_xtalform_chains.items()
+        if any((dtag, _chain) not in known_chain_to_assembly_transforms for _chain in xtalform_chains)
+    ]
+    logger.info(f"Getting chain-to-assembly transforms for {len(missing_dtags)} datasets")
+    structures.prefetch(missing_dtags)
+    for dtag in missing_dtags:
+        st = structures[dtag]
+        xtalform_chains = dataset_xtalform_chains[dtag]
 
         dataset_chains = [_chain.name for _chain in st[0]]
-        dataset_ligand_chains = [_x[1] for _x in ligand_neighbourhoods if _x[0] == dtag]
         # for _chain in dataset_ligand_chains:
         # for _chain in dataset_chains:
         for _chain in xtalform_chains:
@@ -1458,7 +1715,7 @@ def _update(
                 raise Exception(
                     f"A xtalform assignment error has occured. Dataset {dtag} has chain {_chain} in its chains {dataset_chains} however its assigned xtalform {dataset_assignments[dtag]} has chain {xtalform_chains}")
             try:
-                chain_to_assembly_transforms[
+                known_chain_to_assembly_transforms[
                     (
                         dtag,
                         _chain,
@@ -1473,6 +1730,11 @@ def _update(
             except Exception as e:
                 print(f'Exception in dataset: {dtag}, in xtalform {dataset_assignments[dtag]}')
                 raise e
+    chain_to_assembly_transforms = {
+        (dtag, _chain): known_chain_to_assembly_transforms[(dtag, _chain)]
+        for dtag, xtalform_chains in dataset_xtalform_chains.items()
+        for _chain in xtalform_chains
+    }
     logger.info(f'Got {len(chain_to_assembly_transforms)} chain to assembly transforms')
     alignment_heirarchy.save_yaml(fs_model.chain_to_assembly, chain_to_assembly_transforms,
                                   alignment_heirarchy.chain_to_assembly_transforms_to_dict)
@@ -1482,14 +1744,18 @@ def _update(
     logger.info(f"Updating alignment graph...")
     logger.info(f"Previously had {len(ligand_neighbourhood_transforms)} alignments between neighbourhoods")
 
-    # for dtag, dataset in new_datasets.items():
-    for lid, neighbourhood in ligand_neighbourhoods.items():
-        _update_ligand_neighbourhood_transforms(
-            ligand_neighbourhood_transforms,
-            lid,
-            ligand_neighbourhoods,
-            structures,
-        )
+    # Only pairs involving new neighbourhoods need matching unless a full rematch is requested, and only those
+    # sharing enough CAs according to the residue index are candidates. The index is cheap to build from the
+    # neighbourhoods, so it is built afresh each update rather than saved
+    ligand_neighbourhood_ca_index = {}
+    _update_ligand_neighbourhood_transforms_incremental(
+        ligand_neighbourhood_transforms,
+        new_ligand_ids,
+        ligand_neighbourhoods,
+        ligand_neighbourhood_ca_index,
+        full_rematch=full_rematch,
+        num_workers=num_workers,
+    )
 
     logger.info(f"Now have {len(ligand_neighbourhood_transforms)} alignments between neighbourhoods")
     # print(ligand_neighbourhood_transforms)
@@ -1517,6 +1783,7 @@ def _update(
     logger.info(f"Got {len(connected_components)} connected components")
     logger.info(f"Previously had {len(conformer_sites)} conformer sites")
 
+    conformer_site_index = _get_conformer_site_index(conformer_sites)
     for connected_component_id, connected_component in connected_components.items():
         # Update new datasets to indicate everything sharing a connected component
         #
@@ -1531,6 +1798,7 @@ def _update(
             assemblies,
             xtalforms,
             dataset_assignments,
+            conformer_site_index,
         )
     logger.info(f"Now have {len(conformer_sites)} conformer sites")
     # for conformer_site_id, conformer_site in conformer_sites.items():
@@ -1540,10 +1808,17 @@ def _update(
 
     # Update canonical sites
     logger.info(f"Previously had {len(canonical_sites)} canonical sites")
+    canonical_site_index = _CanonicalSiteIndex(canonical_sites)
     for conformer_site_id, conformer_site in conformer_sites.items():
         # If conformer site in a canonical site, replace with new data, otherwise
         # Check if residues match as usual, otherwise create a new canon site for it
-        _update_canonical_sites(canonical_sites, conformer_site, conformer_site_id, ligand_neighbourhoods)
+        _update_canonical_sites(
+            canonical_sites,
+            conformer_site,
+            conformer_site_id,
+            ligand_neighbourhoods,
+            canonical_site_index=canonical_site_index,
+        )
     logger.info(f"Now have {len(canonical_sites)} canonical sites")
     logger.info(f"Global reference dtag is: {list(canonical_sites.values())[0].global_reference_dtag}")
     _save_canonical_sites(fs_model, canonical_sites)
@@ -1568,6 +1843,13 @@ def _update(
     logger.info(f"Now have {len(xtalform_sites)} xtalform sites")
     _save_xtalform_sites(fs_model, xtalform_sites)
 
+    # Index the xtalform sites for the output stages, which look them up by reference ligand
+    xtalform_site_index = _get_xtalform_site_index(xtalform_sites)
+    ligand_xtalform_sites = {}
+    for xsid, _xtalform_site in xtalform_sites.items():
+        for member in _xtalform_site.members:
+            ligand_xtalform_sites.setdefault(member, {})[xsid] = _xtalform_site
+
     # Get conformer site transforms
     logger.info(f"Previously had {len(conformer_site_transforms)} conformer site transforms")
     for canonical_site_id, canonical_site in canonical_sites.items():
@@ -1614,7 +1896,8 @@ def _update(
                     xtalforms,
                     dataset_assignments,
                     xtalform_sites,
-                    canonical_site_id
+                    canonical_site_id,
+                    xtalform_site_index,
                 )
     logger.info(f"Now have {len(reference_structure_transforms)} reference structure transforms")
     save_reference_structure_transforms(
@@ -1637,6 +1920,20 @@ def _update(
     #     for conformer_site_id, conformer_site in canonical_site.conformer_sites.items():
     #         for lid in conformer_site.ligand_ids:
 
+    # The transforms of ligands to their site frames, resolved once for both the structure and map outputs
+    ligand_site_transforms = LigandSiteTransforms(
+        alignability_graph,
+        ligand_neighbourhood_transforms,
+        chain_to_assembly_transforms,
+        assembly_transforms,
+        xtalforms,
+        dataset_assignments,
+    )
+
+    # Work out every structure to output with its transform, grouped by dataset so that each dataset's structure
+    # is loaded once for all of its outputs
+    structure_jobs = {}
+    skipped_structures = []
     for dtag, dataset_alignment_info in fs_model.alignments.items():
         for chain, chain_alignment_info in dataset_alignment_info.items():
             for residue, residue_alignment_info in chain_alignment_info.items():
@@ -1647,13 +1944,11 @@ def _update(
                     ) in ligand_neighbourhood_output.aligned_structures.items():
                         if not ((fs_model.source_dir.parent / aligned_structure_path).exists() | Path(
                                 aligned_structure_path).exists()):
-                            # _update_aligned_structures()
-                            _structure = structures[dtag].clone()
                             canonical_site = canonical_sites[canonical_site_id]
                             # Check for the matching conformer site
                             conformer_site = None
                             for conformer_site_id in canonical_site.conformer_site_ids:
-                                if (dtag, chain, residue, version) in conformer_sites[conformer_site_id].members:
+                                if conformer_sites[conformer_site_id].has_member((dtag, chain, residue, version)):
                                     conformer_site = conformer_sites[conformer_site_id]
                                     break
                             if conformer_site is None:
@@ -1661,76 +1956,72 @@ def _update(
                                 continue
                             moving_ligand_id = (dtag, chain, residue, version)
                             reference_ligand_id = conformer_site.reference_ligand_id
-                            # print(aligned_structure_path)
 
                             # Get the site chain
                             site_chain = None
-                            xtalform_site = None
-                            # site_reference_ligand_id = conformer_sites[
-                            #     canonical_site.reference_conformer_site_id].reference_ligand_id
                             site_reference_ligand_id = conformer_site.reference_ligand_id
                             site_reference_ligand_xtalform_id = dataset_assignments[site_reference_ligand_id[0]]
-                            site_reference_ligand_xtalform = xtalforms[site_reference_ligand_xtalform_id]
-                            for xsid, _xtalform_site in xtalform_sites.items():
-                                _xtalform_id = _xtalform_site.xtalform_id
-                                _xtalform_canonical_site_id = _xtalform_site.canonical_site_id
-                                if (_xtalform_id == site_reference_ligand_xtalform_id) \
-                                        & (_xtalform_canonical_site_id == canonical_site_id) \
-                                        & (site_reference_ligand_id in _xtalform_site.members):
-                                    xtalform_site = _xtalform_site
+                            xtalform_site = _get_xtalform_site(
+                                xtalform_site_index,
+                                site_reference_ligand_xtalform_id,
+                                canonical_site_id,
+                                site_reference_ligand_id,
+                            )
                             site_chain = xtalform_site.crystallographic_chain
 
                             # Aligns to conformer site, then to the corresponding assembly, then from that assembly to
                             # the global frame
-                            try:
-                                _align_structure(
-                                    _structure,
+                            running_transform = ligand_site_transforms.get(
+                                moving_ligand_id,
+                                reference_ligand_id,
+                                site_chain,
+                            )
+
+                            if dtag not in structure_jobs:
+                                structure_jobs[dtag] = []
+                            structure_jobs[dtag].append(
+                                AlignedStructureJob(
                                     moving_ligand_id,
-                                    reference_ligand_id,
+                                    dt.Transform(running_transform.vec.tolist(), running_transform.mat.tolist()),
                                     ligand_neighbourhoods[moving_ligand_id],
-                                    [nid for nid in ligand_neighbourhoods if nid[0] == dtag],
-                                    alignability_graph,
-                                    ligand_neighbourhood_transforms,
-                                    conformer_site_transforms,
-                                    # canonical_site_transforms,
-                                    canonical_site_id,
-                                    conformer_site_id,
+                                    dataset_ligand_ids.get(dtag, []),
                                     xtalforms[dataset_assignments[dtag]],
+                                    # Only the xtalform sites of the moving ligand are needed to find its chain
+                                    ligand_xtalform_sites.get(moving_ligand_id, {}),
                                     aligned_structure_path,
-                                    site_reference_xform=xtalforms[
-                                        dataset_assignments[conformer_site.reference_ligand_id[0]]],
-                                    chain_to_assembly_transform=chain_to_assembly_transforms[
-                                        (
-                                            conformer_site.reference_ligand_id[0],
-                                            # conformer_site.reference_ligand_id[1],
-                                            site_chain
-                                            # conformer_site.reference_ligand_id[3]
-                                        )
-                                    ],
-                                    assembly_transform=assembly_transforms[
-                                        xtalforms[
-                                            dataset_assignments[conformer_site.reference_ligand_id[0]]].assemblies[
-                                            alignment_heirarchy._chain_to_xtalform_assembly(
-                                                # conformer_site.reference_ligand_id[1],
-                                                site_chain,
-                                                xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            )
-                                        ].assembly
-                                    ],
-                                    xtalform_sites=xtalform_sites
                                 )
-
-                            except:
-                                logger.info(f"Failed to generate aligned structure {aligned_structure_path}")
-                                raise
+                            )
                         else:
                             logger.info(f"Already output structure!")
+                            skipped_structures.append(aligned_structure_path)
+
+    if num_workers == 1:
+        structures.prefetch(list(structure_jobs))
+    structure_summary = _write_aligned_structures(
+        structure_jobs,
+        datasets,
+        structures,
+        num_workers=num_workers,
+        structure_cache=structure_cache,
+    )
+    structure_summary["skipped"] = skipped_structures
+    logger.info(
+        f"Wrote {len(structure_summary['written'])} aligned structures, skipped {len(skipped_structures)} that "
+        "were already output"
+    )
+    if len(structure_summary["failed"]) > 0:
+        rprint(
+            f"Failed to generate {len(structure_summary['failed'])} aligned structures: "
+            f"{list(structure_summary['failed'])}"
+        )
+
     # Generate alignments of references to each canonical site
     # for canonical_site_id, canonical_site in canonical_sites.items():
     #     for dtag, reference_dataset in reference_datasets.items():
     # _update_reference_alignments(
     #
     # )
+    structures.prefetch(list(fs_model.reference_alignments))
     for dtag, dataset_alignment_info in fs_model.reference_alignments.items():
         for canonical_site_id, alignment_info in dataset_alignment_info.items():
             aligned_structure_path = alignment_info["aligned_structures"]
@@ -1748,6 +2039,9 @@ def _update(
                 )
             else:
                 logger.info(f"Already output reference structure!")
+    structures.close()
+    logger.info(f"Read {structures.reads} structures for {len(structures)} datasets")
+    structure_cache.save()
 
     # Generate new aligned maps
     # for canonical_site_id, canonical_site in canonical_sites.items():
@@ -1757,6 +2051,9 @@ def _update(
     #             _update_aligned_xmaps()
     reference_xmap = read_xmap_from_mtz(datasets[[x for x in canonical_sites.values()][0].global_reference_dtag].mtz)
     logger.info(f"Outputting xmaps...")
+    # Work out every map to output with its transform and interpolation range, grouped by dataset so that each
+    # dataset's maps are written by a single task
+    xmap_jobs = {}
     for dtag, dataset_alignment_info in fs_model.alignments.items():
         for chain, chain_alignment_info in dataset_alignment_info.items():
             for residue, residue_alignment_info in chain_alignment_info.items():
@@ -1773,13 +2070,11 @@ def _update(
                         except:
                             rel = False
                         if rel:
-                            # print(fs_model.source_dir.parent / aligned_event_map_path)
-                            _structure = structures[dtag].clone()
                             canonical_site = canonical_sites[canonical_site_id]
                             # Check for the matching conformer site
                             conformer_site = None
                             for conformer_site_id in canonical_site.conformer_site_ids:
-                                if (dtag, chain, residue, version) in conformer_sites[conformer_site_id].members:
+                                if conformer_sites[conformer_site_id].has_member((dtag, chain, residue, version)):
                                     conformer_site = conformer_sites[conformer_site_id]
                                     break
 
@@ -1789,7 +2084,6 @@ def _update(
 
                             moving_ligand_id = (dtag, chain, residue, version)
                             reference_ligand_id = conformer_site.reference_ligand_id
-                            # print(ligand_neighbourhoods)
 
                             xmap_path = datasets[dtag].ligand_binding_events[(dtag, chain, residue)].xmap
 
@@ -1797,150 +2091,94 @@ def _update(
                             st_path = fs_model.source_dir.parent / aligned_structure_path
                             if not st_path.exists():
                                 st_path = aligned_structure_path
-                            aligned_structure = gemmi.read_structure(str(st_path))
-                            aligned_res = aligned_structure[0][chain][str(residue)][0]
 
                             # Get the site chain
                             site_chain = None
-                            xtalform_site = None
-                            # site_reference_ligand_id = conformer_sites[
-                            #     canonical_site.reference_conformer_site_id].reference_ligand_id
                             site_reference_ligand_id = conformer_site.reference_ligand_id
                             site_reference_ligand_xtalform_id = dataset_assignments[site_reference_ligand_id[0]]
-                            site_reference_ligand_xtalform = xtalforms[site_reference_ligand_xtalform_id]
-                            for xsid, _xtalform_site in xtalform_sites.items():
-                                _xtalform_id = _xtalform_site.xtalform_id
-                                _xtalform_canonical_site_id = _xtalform_site.canonical_site_id
-                                if (_xtalform_id == site_reference_ligand_xtalform_id) \
-                                        & (_xtalform_canonical_site_id == canonical_site_id) \
-                                        & (site_reference_ligand_id in _xtalform_site.members):
-                                    xtalform_site = _xtalform_site
+                            xtalform_site = _get_xtalform_site(
+                                xtalform_site_index,
+                                site_reference_ligand_xtalform_id,
+                                canonical_site_id,
+                                site_reference_ligand_id,
+                            )
                             site_chain = xtalform_site.crystallographic_chain
 
+                            # Aligns to conformer site, then to the corresponding assembly, then from that assembly to
+                            # the global frame
+                            running_transform = ligand_site_transforms.get(
+                                moving_ligand_id,
+                                reference_ligand_id,
+                                site_chain,
+                            )
+                            transform = dt.Transform(running_transform.vec.tolist(), running_transform.mat.tolist())
+                            interpolation_range = _get_interpolation_range(
+                                ligand_neighbourhoods[moving_ligand_id],
+                                running_transform,
+                                reference_xmap,
+                            )
+
+                            if dtag not in xmap_jobs:
+                                xmap_jobs[dtag] = []
+                            maps = []
                             if (xmap_path != "None") and (xmap_path is not None):
-                                xmap = read_xmap(xmap_path)
-
-                                __align_xmap(
-                                    ligand_neighbourhoods[(dtag, chain, residue, version)],
-                                    alignability_graph,
-                                    ligand_neighbourhood_transforms,
-                                    reference_xmap,
-                                    reference_ligand_id,
-                                    moving_ligand_id,
-                                    xmap,
-                                    conformer_site_transforms,
-                                    conformer_site_id,
-                                    # canonical_site_transforms,
-                                    canonical_site_id,
-                                    aligned_event_map_path,
-                                    ligand_neighbourhood_output.aligned_event_maps_crystallographic[canonical_site_id],
-                                    aligned_res,
-                                    chain_to_assembly_transform=chain_to_assembly_transforms[
-                                        (
-                                            conformer_site.reference_ligand_id[0],
-                                            # conformer_site.reference_ligand_id[1],
-                                            # alignment_heirarchy._chain_to_xtalform_assembly(
-                                            #     # conformer_site.reference_ligand_id[1],
-                                            #     site_chain,
-                                            #     xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            # )
-                                            site_chain
-                                            # conformer_site.reference_ligand_id[3]
-                                        )
-                                    ],
-                                    assembly_transform=assembly_transforms[
-                                        xtalforms[
-                                            dataset_assignments[conformer_site.reference_ligand_id[0]]].assemblies[
-                                            alignment_heirarchy._chain_to_xtalform_assembly(
-                                                site_chain,
-                                                # conformer_site.reference_ligand_id[1],
-                                                xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            )
-                                        ].assembly
-                                    ],
+                                maps.append(
+                                    (
+                                        "event",
+                                        xmap_path,
+                                        aligned_event_map_path,
+                                        ligand_neighbourhood_output.aligned_event_maps_crystallographic[
+                                            canonical_site_id],
+                                    )
                                 )
                             mtz_path = datasets[dtag].mtz
-                            # print(f"Mtz path: {mtz_path}")
-                            # raise Exception
                             if mtz_path != "None":
-                                xmap = read_xmap_from_mtz(mtz_path, "2Fo-Fc")
-                                __align_xmap(
-                                    ligand_neighbourhoods[(dtag, chain, residue, version)],
-                                    alignability_graph,
-                                    ligand_neighbourhood_transforms,
-                                    reference_xmap,
-                                    reference_ligand_id,
-                                    moving_ligand_id,
-                                    xmap,
-                                    conformer_site_transforms,
-                                    conformer_site_id,
-                                    # canonical_site_transforms,
-                                    canonical_site_id,
-                                    ligand_neighbourhood_output.aligned_xmaps[canonical_site_id],
-                                    ligand_neighbourhood_output.aligned_xmaps_crystallographic[canonical_site_id],
-                                    aligned_res,
-                                    chain_to_assembly_transform=chain_to_assembly_transforms[
-                                        (
-                                            conformer_site.reference_ligand_id[0],
-                                            # conformer_site.reference_ligand_id[1],
-                                            site_chain
-                                            # alignment_heirarchy._chain_to_xtalform_assembly(
-                                            #     site_chain,
-                                            #     # conformer_site.reference_ligand_id[1],
-                                            #     xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            # )
-                                            # conformer_site.reference_ligand_id[3]
-                                        )
-                                    ],
-                                    assembly_transform=assembly_transforms[
-                                        xtalforms[
-                                            dataset_assignments[conformer_site.reference_ligand_id[0]]].assemblies[
-                                            alignment_heirarchy._chain_to_xtalform_assembly(
-                                                # conformer_site.reference_ligand_id[1],
-                                                site_chain,
-                                                xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            )
-                                        ].assembly
-                                    ],
+                                maps.append(
+                                    (
+                                        "2Fo-Fc",
+                                        mtz_path,
+                                        ligand_neighbourhood_output.aligned_xmaps[canonical_site_id],
+                                        ligand_neighbourhood_output.aligned_xmaps_crystallographic[canonical_site_id],
+                                    )
                                 )
-                                xmap = read_xmap_from_mtz(mtz_path, "Fo-Fc")
-                                __align_xmap(
-                                    ligand_neighbourhoods[(dtag, chain, residue, version)],
-                                    alignability_graph,
-                                    ligand_neighbourhood_transforms,
-                                    reference_xmap,
-                                    reference_ligand_id,
-                                    moving_ligand_id,
-                                    xmap,
-                                    conformer_site_transforms,
-                                    conformer_site_id,
-                                    # canonical_site_transforms,
-                                    canonical_site_id,
-                                    ligand_neighbourhood_output.aligned_diff_maps[canonical_site_id],
-                                    ligand_neighbourhood_output.aligned_diff_maps_crystallographic[canonical_site_id],
-                                    aligned_res,
-                                    chain_to_assembly_transform=chain_to_assembly_transforms[
-                                        (
-                                            conformer_site.reference_ligand_id[0],
-                                            # conformer_site.reference_ligand_id[1],
-                                            site_chain
-                                            # conformer_site.reference_ligand_id[3]
-                                        )
-                                    ],
-                                    assembly_transform=assembly_transforms[
-                                        xtalforms[
-                                            dataset_assignments[conformer_site.reference_ligand_id[0]]].assemblies[
-                                            alignment_heirarchy._chain_to_xtalform_assembly(
-                                                site_chain,
-                                                # conformer_site.reference_ligand_id[1],
-                                                xtalforms[dataset_assignments[conformer_site.reference_ligand_id[0]]]
-                                            )
-                                        ].assembly
-                                    ],
+                                maps.append(
+                                    (
+                                        "Fo-Fc",
+                                        mtz_path,
+                                        ligand_neighbourhood_output.aligned_diff_maps[canonical_site_id],
+                                        ligand_neighbourhood_output.aligned_diff_maps_crystallographic[
+                                            canonical_site_id],
+                                    )
+                                )
+                            for map_type, _xmap_path, output_path, crystallographic_output_path in maps:
+                                xmap_jobs[dtag].append(
+                                    AlignedXmapJob(
+                                        map_type,
+                                        _xmap_path,
+                                        transform,
+                                        interpolation_range,
+                                        str(st_path),
+                                        chain,
+                                        residue,
+                                        output_path,
+                                        crystallographic_output_path,
+                                    )
                                 )
 
                         else:
                             logger.info(f"Already output xmap!")
+
+    if num_xmap_workers is None:
+        num_xmap_workers = num_workers
+    xmap_summary = _write_aligned_xmaps(
+        xmap_jobs,
+        GridTemplate.from_grid(reference_xmap),
+        num_workers=num_xmap_workers,
+    )
+    logger.info(f"Wrote {len(xmap_summary['written'])} aligned maps")
+    if len(xmap_summary["failed"]) > 0:
+        rprint(f"Failed to write {len(xmap_summary['failed'])} aligned maps: {list(xmap_summary['failed'])}")
+
     return fs_model
 
 
@@ -2040,7 +2278,28 @@ def _load_dataset_assignments(dataset_assignments_yaml, fail_if_not_found=False)
     return dataset_assignments
 
 
-def _load_ligand_neighbourhoods(ligand_neighbourhoods_yaml, fail_if_not_found=False):
+def _load_ligand_neighbourhoods(ligand_neighbourhoods_path, fail_if_not_found=False):
+    ligand_neighbourhoods_path = Path(ligand_neighbourhoods_path)
+
+    # Fall back to the YAML written by older runs
+    if (ligand_neighbourhoods_path.suffix == ".npz") and (not ligand_neighbourhoods_path.exists()):
+        ligand_neighbourhoods_yaml = ligand_neighbourhoods_path.with_name(constants.NEIGHBOURHOODS_YAML_FILE_NAME)
+        if ligand_neighbourhoods_yaml.exists():
+            return _load_ligand_neighbourhoods_yaml(ligand_neighbourhoods_yaml)
+
+    if fail_if_not_found and not ligand_neighbourhoods_path.is_file():
+        raise ValueError("File " + str(ligand_neighbourhoods_path) + " does not exist")
+
+    if ligand_neighbourhoods_path.suffix != ".npz":
+        return _load_ligand_neighbourhoods_yaml(ligand_neighbourhoods_path)
+
+    if ligand_neighbourhoods_path.exists():
+        return dt.NeighbourhoodStore.from_npz(ligand_neighbourhoods_path)
+
+    return dt.NeighbourhoodStore.from_neighbourhoods({})
+
+
+def _load_ligand_neighbourhoods_yaml(ligand_neighbourhoods_yaml, fail_if_not_found=False):
     if fail_if_not_found and not ligand_neighbourhoods_yaml.is_file():
         raise ValueError("File " + str(ligand_neighbourhoods_yaml) + " does not exist")
     ligand_neighbourhoods: dict[tuple[str, str, str], dt.Neighbourhood] = {}
@@ -2059,6 +2318,12 @@ def _load_ligand_neighbourhoods(ligand_neighbourhoods_yaml, fail_if_not_found=Fa
     return ligand_neighbourhoods
 
 
+def _migrate_ligand_neighbourhoods(ligand_neighbourhoods_yaml, ligand_neighbourhoods_npz):
+    ligand_neighbourhoods = _load_ligand_neighbourhoods_yaml(ligand_neighbourhoods_yaml, fail_if_not_found=True)
+    dt.NeighbourhoodStore.from_neighbourhoods(ligand_neighbourhoods).to_npz(ligand_neighbourhoods_npz)
+    return len(ligand_neighbourhoods)
+
+
 def _load_alignability_graph(alignability_graph, fail_if_not_found=False):
     if fail_if_not_found and not alignability_graph.is_file():
         raise ValueError("File " + str(alignability_graph) + " does not exist")
@@ -2097,7 +2362,32 @@ def _load_connected_components(connected_components_yaml, fail_if_not_found=Fals
     return connected_components
 
 
-def _load_ligand_neighbourhood_transforms(ligand_neighbourhood_transforms_yaml, fail_if_not_found=False):
+def _load_ligand_neighbourhood_transforms(ligand_neighbourhood_transforms_path, fail_if_not_found=False):
+    ligand_neighbourhood_transforms_path = Path(ligand_neighbourhood_transforms_path)
+
+    # Fall back to the YAML written by older runs
+    if (ligand_neighbourhood_transforms_path.suffix == ".bin") and (not ligand_neighbourhood_transforms_path.exists()):
+        ligand_neighbourhood_transforms_yaml = ligand_neighbourhood_transforms_path.with_name(
+            constants.TRANSFORMS_YAML_FILE_NAME
+        )
+        if ligand_neighbourhood_transforms_yaml.exists():
+            return dt.TransformStore.from_transforms(
+                _load_ligand_neighbourhood_transforms_yaml(ligand_neighbourhood_transforms_yaml)
+            )
+
+    if fail_if_not_found and not ligand_neighbourhood_transforms_path.is_file():
+        raise ValueError("File " + str(ligand_neighbourhood_transforms_path) + " does not exist")
+
+    if ligand_neighbourhood_transforms_path.suffix != ".bin":
+        return _load_ligand_neighbourhood_transforms_yaml(ligand_neighbourhood_transforms_path)
+
+    if ligand_neighbourhood_transforms_path.exists():
+        return dt.TransformStore.from_file(ligand_neighbourhood_transforms_path)
+
+    return dt.TransformStore.from_transforms({})
+
+
+def _load_ligand_neighbourhood_transforms_yaml(ligand_neighbourhood_transforms_yaml, fail_if_not_found=False):
     if fail_if_not_found and not ligand_neighbourhood_transforms_yaml.is_file():
         raise ValueError("File " + str(ligand_neighbourhood_transforms_yaml) + " does not exist")
     ligand_neighbourhood_transforms = {}
@@ -2209,6 +2499,34 @@ def _load_reference_stucture_transforms(reference_structure_transforms_yaml, fai
     return reference_structure_transforms
 
 
+def _load_assembly_landmarks(assembly_landmarks_yaml, fail_if_not_found=False):
+    if fail_if_not_found and not assembly_landmarks_yaml.is_file():
+        raise ValueError("File " + str(assembly_landmarks_yaml) + " does not exist")
+    assembly_landmarks = {}
+    if assembly_landmarks_yaml.exists():
+        with open(assembly_landmarks_yaml, "r") as f:
+            dic = yaml.safe_load(f)
+
+        if dic:
+            assembly_landmarks = alignment_heirarchy.dict_to_assembly_landmarks(dic)
+
+    return assembly_landmarks
+
+
+def _load_assembly_transforms(assembly_transforms_yaml, fail_if_not_found=False):
+    if fail_if_not_found and not assembly_transforms_yaml.is_file():
+        raise ValueError("File " + str(assembly_transforms_yaml) + " does not exist")
+    assembly_transforms = {}
+    if assembly_transforms_yaml.exists():
+        with open(assembly_transforms_yaml, "r") as f:
+            dic = yaml.safe_load(f)
+
+        if dic:
+            assembly_transforms = dic
+
+    return assembly_transforms
+
+
 class CLI:
     def schema(self, output_dir: str):
         _output_dir = Path(output_dir)
@@ -2225,7 +2543,7 @@ class CLI:
         save_schema(SystemData, _output_dir)
         save_schema(SystemData, _output_dir)
 
-    def update(self, options_json: str):
+    def update(self, options_json: str, full_rematch: bool = False, version: int = 1):
 
         options = Options.parse_file(options_json)
         # logger.info(f"Options json path is: {options}")
@@ -2264,7 +2582,9 @@ class CLI:
             fs_model, options.datasources, options.datasource_types, options.panddas
         )
 
-        datasets, reference_datasets, new_datasets = source_data_model.get_datasets()
+        discovery_cache = DiscoveryCache(fs_model.source_dir / constants.DISCOVERY_CACHE_YAML_FILE_NAME)
+        datasets, reference_datasets, new_datasets = source_data_model.get_datasets(discovery_cache)
+        discovery_cache.save()
         # print(datasets)
         # print(reference_datasets)
         # print(new_datasets)
@@ -2273,10 +2593,10 @@ class CLI:
         logger.info(f"Getting assemblies...")
         if source_fs_model:
             assemblies: dict[str, dt.Assembly] = _load_assemblies(
-                source_fs_model.assemblies, Path(options.assemblies_json)
+                source_fs_model.xtalforms, Path(options.assemblies_json)
             )
         else:
-            assemblies = _load_assemblies(fs_model.assemblies, Path(options.assemblies_json))
+            assemblies = _load_assemblies(fs_model.xtalforms, Path(options.assemblies_json))
         # for key, assembly in assemblies.items():
         #     print(assembly)
         #     for gen in assembly.generators:
@@ -2389,6 +2709,15 @@ class CLI:
                 fs_model.reference_structure_transforms
             )
 
+        # Get the assembly landmarks and transforms
+        logger.info("Getting assembly landmarks and transforms...")
+        if source_fs_model:
+            assembly_landmarks = _load_assembly_landmarks(source_fs_model.assembly_landmarks)
+            assembly_transforms = _load_assembly_transforms(source_fs_model.assembly_transforms)
+        else:
+            assembly_landmarks = _load_assembly_landmarks(fs_model.assembly_landmarks)
+            assembly_transforms = _load_assembly_transforms(fs_model.assembly_transforms)
+
         # Run the update
         _update(
             fs_model,
@@ -2408,6 +2737,17 @@ class CLI:
             # canonical_site_transforms,
             xtalform_sites,
             reference_structure_transforms,
+            assembly_landmarks,
+            assembly_transforms,
+            version,
+            full_rematch=full_rematch,
+            num_workers=options.num_workers,
+            num_xmap_workers=options.num_xmap_workers,
+            structure_cache=StructureCache(
+                fs_model.source_dir / constants.STRUCTURE_CACHE_YAML_FILE_NAME,
+                use_hash=options.hash_structures,
+            ),
+            structure_registry_bytes=options.structure_registry_bytes,
         )
 
     def process_all(self, option_json: str):
@@ -2746,6 +3086,17 @@ class CLI:
             system_data,  # dataset_xtalforms
         )
 
+    def migrate_neighbourhoods(self, source_dir: str):
+        _source_dir = Path(source_dir)
+        fs_model = dt.FSModel.from_dir(_source_dir)
+
+        num_neighbourhoods = _migrate_ligand_neighbourhoods(
+            fs_model.ligand_neighbourhoods.with_name(constants.NEIGHBOURHOODS_YAML_FILE_NAME),
+            fs_model.ligand_neighbourhoods,
+        )
+        _save_fs_model(fs_model)
+        rprint(f"Migrated {num_neighbourhoods} ligand neighbourhoods to {fs_model.ligand_neighbourhoods}")
+
     def write_options_json(self, source_dir, options_json):
         _source_dir = Path(source_dir)
         _options_json = Path(options_json)
@@ -22,6 +22,7 @@ SITES_FILE_NAME: str = "sites.json"
 
 PANDDA_ANALYSES_DIR: str = "analyses"
 PANDDA_EVENTS_INSPECT_TABLE_PATH: str = "pandda_inspect_events.csv"
+PANDDA_EVENT_TABLE_COLUMNS: list[str] = ["dtag", "event_idx", "x", "y", "z", "1-BDC", "Ligand Confidence"]
 PANDDA_FINAL_STRUCTURE_PDB_DIR: str = "modelled_structures"
 PANDDA_FINAL_STRUCTURE_PDB_TEMPLATE: str = "{dtag}-pandda-model.pdb"
 
@@ -56,8 +57,24 @@ ASSEMBLIES_YAML_FILE_NAME = "assemblies.yaml"
 XTALFORMS_YAML_FILE_NAME = "xtalforms.yaml"
 ASSIGNED_XTALFORMS_YAML_FILE_NAME = "assigned_xtalforms.yaml"
 NEIGHBOURHOODS_YAML_FILE_NAME = "neighbourhoods.yaml"
+NEIGHBOURHOODS_NPZ_FILE_NAME = "neighbourhoods.npz"
 CONNECTED_COMPONENTS_YAML_NAME = "connected_components.yaml"
 TRANSFORMS_YAML_FILE_NAME = "neighbourhood_transforms.yaml"
+TRANSFORMS_ARRAY_FILE_NAME = "neighbourhood_transforms.bin"
+TRANSFORM_LIGAND_IDS_FILE_NAME = "neighbourhood_transform_ligand_ids.txt"
+STRUCTURE_CACHE_YAML_FILE_NAME = "structure_cache.yaml"
+DISCOVERY_CACHE_YAML_FILE_NAME = "discovery_cache.yaml"
+
+# Per dataset task budget for maps held in memory while writing aligned maps
+XMAP_CACHE_BYTES = 2 * 1024**3
+# Budget for dataset structures held in memory during an update, and how many to read ahead of their use
+STRUCTURE_REGISTRY_BYTES = 4 * 1024**3
+STRUCTURE_REGISTRY_PREFETCH = 4
+# Measured for gemmi structures of PDB files, including their residues and chains
+STRUCTURE_BYTES_PER_ATOM = 200
+# Threads reading structures while discovering datasets, which is mostly waiting on the filesystem
+DISCOVERY_THREADS = 16
+
 CONFORMER_SITE_YAML_FILE = "conformer_sites.yaml"
 CONFORMER_SITES_TRANSFORMS_YAML_FILE_NAME = "conformer_site_transforms.yaml"
 CANONICAL_SITE_YAML_FILE = "canonical_sites.yaml"
@@ -641,6 +641,13 @@ class Options(BaseModel):
     assemblies_json: str
     xtalforms_json: str
     # dataset_xtalforms_json: str
+    num_workers: int = 1
+    # Aligned maps are memory hungry, so they can be written with fewer workers than the other stages
+    num_xmap_workers: int | None = None
+    # Also check structure files against a hash of their contents, not just their size and modification time
+    hash_structures: bool = False
+    # Memory budget for the dataset structures held during an update
+    structure_registry_bytes: int = constants.STRUCTURE_REGISTRY_BYTES
 
 
 class AssignedXtalForms(BaseModel):
@@ -0,0 +1,111 @@
+import fnmatch
+import os
+import threading
+from pathlib import Path
+
+import gemmi
+import numpy as np
+import yaml
+
+from ligand_neighbourhood_alignment import constants
+from ligand_neighbourhood_alignment.make_data_json import _get_ligand_centroids
+
+# The files looked for in each kind of datasource's model directories
+_MODEL_DIR_PATTERNS = {
+    "model_building": {"pdb": constants.MODEL_DIR_PDB},
+    "manual": {"pdb": "*.pdb", "xmap": "*.ccp4", "mtz": "*.mtz"},
+}
+
+
+def _get_model_dir_files(model_dir: Path, datasource_type: str):
+    # The first file matching each pattern, in directory order as glob would find them
+    try:
+        names = [entry.name for entry in os.scandir(model_dir) if not entry.name.startswith(".")]
+    except (NotADirectoryError, FileNotFoundError):
+        names = []
+
+    files = {}
+    for file_type, pattern in _MODEL_DIR_PATTERNS[datasource_type].items():
+        matches = fnmatch.filter(names, pattern)
+        if (len(matches) > 0) and (model_dir / matches[0]).exists():
+            files[file_type] = matches[0]
+        else:
+            files[file_type] = None
+    return files
+
+
+def _get_ligands(pdb):
+    # Read the file in Python so that threads can overlap on I/O, then parse it
+    structure = gemmi.read_pdb_string(Path(pdb).read_bytes().decode())
+    ligand_ids, centroids = _get_ligand_centroids(structure)
+    return [[chain, residue] + centroid for (chain, residue), centroid in zip(ligand_ids, centroids.tolist())]
+
+
+class DiscoveryCache:
+    # What was found in the datasources on earlier runs. Model directories are only listed again when their
+    # modification time changes, and the ligands of a PDB (chain, residue number and centroid) are only read again
+    # when its size or modification time changes
+    def __init__(self, path=None):
+        self.path = path
+        self.model_dirs = {}
+        self.pdbs = {}
+        self.dirs_listed = 0
+        self.dirs_cached = 0
+        self.pdbs_read = 0
+        self.pdbs_cached = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if (path is not None) and Path(path).exists():
+            with open(path, "r") as f:
+                dic = yaml.safe_load(f)
+            if dic:
+                self.model_dirs = dic.get("model_dirs", {})
+                self.pdbs = dic.get("pdbs", {})
+
+    def get_model_dir_files(self, model_dir: Path, datasource_type: str):
+        key = str(model_dir)
+        mtime = os.stat(model_dir).st_mtime_ns
+        entry = self.model_dirs.get(key)
+        if (entry is not None) and (entry["mtime"] == mtime) and (entry["datasource_type"] == datasource_type):
+            self.dirs_cached += 1
+        else:
+            self.dirs_listed += 1
+            entry = {
+                "mtime": mtime,
+                "datasource_type": datasource_type,
+                "files": _get_model_dir_files(model_dir, datasource_type),
+            }
+            self.model_dirs[key] = entry
+            self._dirty = True
+
+        return {
+            file_type: (model_dir / name if name is not None else None) for file_type, name in entry["files"].items()
+        }
+
+    def get_ligands(self, pdb):
+        # The ligand IDs other than DMS in the PDB and an array of their centroids
+        key = str(pdb)
+        stat = os.stat(pdb)
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        entry = self.pdbs.get(key)
+        if (entry is not None) and all(entry[name] == value for name, value in fingerprint.items()):
+            with self._lock:
+                self.pdbs_cached += 1
+        else:
+            entry = dict(fingerprint, ligands=_get_ligands(pdb))
+            with self._lock:
+                self.pdbs_read += 1
+                self.pdbs[key] = entry
+                self._dirty = True
+
+        ligand_ids = [(ligand[0], ligand[1]) for ligand in entry["ligands"]]
+        centroids = np.array([ligand[2:] for ligand in entry["ligands"]]).reshape((-1, 3))
+        return ligand_ids, centroids
+
+    def save(self):
+        if (self.path is None) or (not self._dirty):
+            return
+        with open(self.path, "w") as f:
+            yaml.safe_dump({"model_dirs": self.model_dirs, "pdbs": self.pdbs}, f)
+        self._dirty = False
@@ -1,10 +1,13 @@
 import json
 import os
 import re
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
+import time
 
-import pandas as pd
+import numpy as np
 import yaml
 from loguru import logger
 
@@ -142,28 +145,29 @@ class FSModel:
             if not (self.source_dir / constants.ALIGNED_FILES_DIR / dtag).exists():
                 os.mkdir(self.source_dir / constants.ALIGNED_FILES_DIR / dtag)
             for chain, chain_alignments in dataset_alignments.items():
-                for residue, ligand_neighbourhood_alignments in chain_alignments.items():
-                    for canonical_site_id in ligand_neighbourhood_alignments.aligned_structures:
-                        if canonical_site_id in ligand_neighbourhood_alignments.aligned_structures:
-                            old_path = Path(ligand_neighbourhood_alignments.aligned_structures[canonical_site_id])
-                            new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
-                            if not new_path.exists():
-                                symlink(old_path, new_path)
-                        if canonical_site_id in ligand_neighbourhood_alignments.aligned_artefacts:
-                            old_path = Path(ligand_neighbourhood_alignments.aligned_artefacts[canonical_site_id])
-                            new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
-                            if not new_path.exists():
-                                symlink(old_path, new_path)
-                        if canonical_site_id in ligand_neighbourhood_alignments.aligned_xmaps:
-                            old_path = Path(ligand_neighbourhood_alignments.aligned_xmaps[canonical_site_id])
-                            new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
-                            if not new_path.exists():
-                                symlink(old_path, new_path)
-                        if canonical_site_id in ligand_neighbourhood_alignments.aligned_event_maps:
-                            old_path = Path(ligand_neighbourhood_alignments.aligned_event_maps[canonical_site_id])
-                            new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
-                            if not new_path.exists():
-                                symlink(old_path, new_path)
+                for residue, residue_alignments in chain_alignments.items():
+                    for version, ligand_neighbourhood_alignments in residue_alignments.items():
+                        for canonical_site_id in ligand_neighbourhood_alignments.aligned_structures:
+                            if canonical_site_id in ligand_neighbourhood_alignments.aligned_structures:
+                                old_path = Path(ligand_neighbourhood_alignments.aligned_structures[canonical_site_id])
+                                new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
+                                if not new_path.exists():
+                                    symlink(old_path, new_path)
+                            if canonical_site_id in ligand_neighbourhood_alignments.aligned_artefacts:
+                                old_path = Path(ligand_neighbourhood_alignments.aligned_artefacts[canonical_site_id])
+                                new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
+                                if not new_path.exists():
+                                    symlink(old_path, new_path)
+                            if canonical_site_id in ligand_neighbourhood_alignments.aligned_xmaps:
+                                old_path = Path(ligand_neighbourhood_alignments.aligned_xmaps[canonical_site_id])
+                                new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
+                                if not new_path.exists():
+                                    symlink(old_path, new_path)
+                            if canonical_site_id in ligand_neighbourhood_alignments.aligned_event_maps:
+                                old_path = Path(ligand_neighbourhood_alignments.aligned_event_maps[canonical_site_id])
+                                new_path = self.source_dir / constants.ALIGNED_FILES_DIR / dtag / old_path.name
+                                if not new_path.exists():
+                                    symlink(old_path, new_path)
 
         # Symlink old alignments
         for dtag, dtag_alignment_info in self.reference_alignments.items():
@@ -203,10 +207,10 @@ class FSModel:
         # assemblies = source_dir / constants.ASSEMBLIES_YAML_FILE_NAME
         xtalforms = source_dir / constants.XTALFORMS_YAML_FILE_NAME
         dataset_assignments = source_dir / constants.ASSIGNED_XTALFORMS_YAML_FILE_NAME
-        ligand_neighbourhoods = source_dir / constants.NEIGHBOURHOODS_YAML_FILE_NAME
+        ligand_neighbourhoods = source_dir / constants.NEIGHBOURHOODS_NPZ_FILE_NAME
         alignability_graph = source_dir / constants.ALIGNABILITY_GRAPH_FILE_NAME
         connected_components = source_dir / constants.CONNECTED_COMPONENTS_YAML_NAME
-        ligand_neighbourhood_transforms = source_dir / constants.TRANSFORMS_YAML_FILE_NAME
+        ligand_neighbourhood_transforms = source_dir / constants.TRANSFORMS_ARRAY_FILE_NAME
         conformer_sites = source_dir / constants.CONFORMER_SITE_YAML_FILE
         conformer_site_transforms = source_dir / constants.CONFORMER_SITES_TRANSFORMS_YAML_FILE_NAME
         canonical_sites = source_dir / constants.CANONICAL_SITE_YAML_FILE
@@ -288,10 +292,14 @@ class FSModel:
             fs_model=Path(dic["fs_model"]),
             xtalforms=Path(dic["crystalforms"]),
             dataset_assignments=Path(dic["dataset_assignments"]),
-            ligand_neighbourhoods=Path(dic["ligand_neighbourhoods"]),
+            # Neighbourhoods of older runs in YAML are migrated to the columnar file alongside on the next save
+            ligand_neighbourhoods=Path(dic["ligand_neighbourhoods"]).with_name(constants.NEIGHBOURHOODS_NPZ_FILE_NAME),
             alignability_graph=Path(dic["alignability_graph"]),
             connected_components=Path(dic["connected_components"]),
-            ligand_neighbourhood_transforms=Path(dic["ligand_neighbourhood_transforms"]),
+            # Transforms of older runs in YAML are migrated to the array file alongside on the next save
+            ligand_neighbourhood_transforms=Path(dic["ligand_neighbourhood_transforms"]).with_name(
+                constants.TRANSFORMS_ARRAY_FILE_NAME
+            ),
             conformer_sites=Path(dic["conformer_sites"]),
             conformer_site_transforms=Path(dic["conformer_site_transforms"]),
             canonical_sites=Path(dic["canonical_sites"]),
@@ -437,91 +445,126 @@ class SourceDataModel:
         return SourceDataModel(fs_model, _datasources, _panddas)
         ...
 
-    def get_datasets(self):
+    def get_datasets(self, discovery_cache=None, num_threads: int = constants.DISCOVERY_THREADS):
+        # Imported here as make_data_json depends on this module
+        from ligand_neighbourhood_alignment.discovery_cache import DiscoveryCache
+        from ligand_neighbourhood_alignment.make_data_json import (
+            _get_ligand_binding_events_from_panddas,
+            _get_ligand_binding_events_from_structure,
+            _get_pandda_events,
+            _read_pandda_event_table,
+        )
+
+        if discovery_cache is None:
+            discovery_cache = DiscoveryCache()
+        start = time.perf_counter()
 
         datasets = {}
         reference_datasets = {}
         new_datasets = {}
 
-        # Get the pandda tables
-        pandda_event_tables = {pandda.path: pd.read_csv(pandda.event_table_path) for pandda in self.panddas}
+        # Get the pandda tables, with their events grouped by dataset
+        pandda_event_tables = {
+            pandda.path: _read_pandda_event_table(pandda.event_table_path) for pandda in self.panddas
+        }
+        pandda_events = _get_pandda_events(pandda_event_tables)
+        tables_time = time.perf_counter()
 
-        # Get all the datasets attested in the data sources
+        # Get the model directories attested in the data sources and their files, only listing those that changed
+        model_dirs = []
         for datasource in self.datasources:
             logger.info(f"Parsing datasource: {datasource.path}")
-            if datasource.datasource_type == "model_building":
-                for model_dir in Path(datasource.path).glob("*"):
-                    dtag = model_dir.name
-                    if dtag in datasets:
-                        st = f"Dataset ID {dtag} already found! Using new!"
-                        logger.warning(st)
-                        continue
-
-                    pdb = model_dir / constants.MODEL_DIR_PDB
-                    xmap = model_dir / constants.MODEL_DIR_XMAP
-                    mtz = model_dir / constants.MODEL_DIR_MTZ
-                    if not pdb.exists():
-                        continue
-
-                    ligand_binding_events = _get_ligand_binding_events_from_panddas(
-                        pandda_event_tables,
-                        pdb,
-                        dtag,
-                    )
-                    if len(ligand_binding_events) == 0:
-                        logger.warning(f"Dataset {dtag} has no ligand binding events!")
-                        continue
-                    dataset = Dataset(
-                        dtag=dtag,
-                        pdb=str(pdb),
-                        xmap=str(xmap),
-                        mtz=str(mtz),
-                        ligand_binding_events=ligand_binding_events,
-                    )
-                    # dataset_ids.append(dataset_id)
-                    datasets[dtag] = dataset
-                    logger.debug(f"Added dataset: {dtag}")
-
-            elif datasource.datasource_type == "manual":
-                for model_dir in Path(datasource.path).glob("*"):
-                    dtag = model_dir.name
-
-                    if dtag in datasets:
-                        st = f"Dataset ID {dtag} already found! Using new!"
-                        logger.warning(st)
-                    try:
-                        pdb = next(model_dir.glob("*.pdb"))
-                    except Exception:
-                        raise Exception(f"Could not find pdb in dir: {model_dir}")
-                    try:
-                        xmap = next(model_dir.glob("*.ccp4"))
-                    except Exception as e:
-                        print(e)
-                        xmap = None
-                        logger.warning("No xmap!")
-                    try:
-                        mtz = next(model_dir.glob("*.mtz"))
-                    except Exception as e:
-                        print(e)
-                        mtz = None
-                        logger.warning("No mtz!")
-
-                    ligand_binding_events = _get_ligand_binding_events_from_structure(pdb, xmap, dtag)
-                    if len(ligand_binding_events) == 0:
-                        logger.warning(f"Dataset {dtag} has no ligand binding events!")
-                        continue
-                    dataset = Dataset(
-                        dtag=dtag,
-                        pdb=str(pdb),
-                        xmap=str(xmap),
-                        mtz=str(mtz),
-                        ligand_binding_events=ligand_binding_events,
-                    )
-                    datasets[dtag] = dataset
-                    reference_datasets[dtag] = dataset
-                    logger.debug(f"Added dataset: {dtag}")
-            else:
+            if datasource.datasource_type not in ["model_building", "manual"]:
                 raise Exception(f"Source type {datasource.datasource_type} unknown!")
+            for model_dir in Path(datasource.path).glob("*"):
+                files = discovery_cache.get_model_dir_files(model_dir, datasource.datasource_type)
+                model_dirs.append((datasource.datasource_type, model_dir, files))
+        list_time = time.perf_counter()
+
+        # Find the ligands of the structures that may be datasets
+        pdbs = [
+            files["pdb"]
+            for datasource_type, model_dir, files in model_dirs
+            if (files["pdb"] is not None) and ((datasource_type == "manual") or (model_dir.name in pandda_events))
+        ]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            ligands = dict(zip(pdbs, executor.map(discovery_cache.get_ligands, pdbs)))
+        ligands_time = time.perf_counter()
+
+        # Get all the datasets
+        for datasource_type, model_dir, files in model_dirs:
+            if datasource_type == "model_building":
+                dtag = model_dir.name
+                if dtag in datasets:
+                    st = f"Dataset ID {dtag} already found! Using new!"
+                    logger.warning(st)
+                    continue
+
+                pdb = files["pdb"]
+                xmap = model_dir / constants.MODEL_DIR_XMAP
+                mtz = model_dir / constants.MODEL_DIR_MTZ
+                if pdb is None:
+                    continue
+
+                ligand_binding_events = _get_ligand_binding_events_from_panddas(
+                    pandda_events,
+                    pdb,
+                    dtag,
+                    ligands.get(pdb),
+                )
+                if len(ligand_binding_events) == 0:
+                    logger.warning(f"Dataset {dtag} has no ligand binding events!")
+                    continue
+                dataset = Dataset(
+                    dtag=dtag,
+                    pdb=str(pdb),
+                    xmap=str(xmap),
+                    mtz=str(mtz),
+                    ligand_binding_events=ligand_binding_events,
+                )
+                # dataset_ids.append(dataset_id)
+                datasets[dtag] = dataset
+                logger.debug(f"Added dataset: {dtag}")
+
+            elif datasource_type == "manual":
+                dtag = model_dir.name
+
+                if dtag in datasets:
+                    st = f"Dataset ID {dtag} already found! Using new!"
+                    logger.warning(st)
+                pdb = files["pdb"]
+                if pdb is None:
+                    raise Exception(f"Could not find pdb in dir: {model_dir}")
+                xmap = files["xmap"]
+                if xmap is None:
+                    logger.warning("No xmap!")
+                mtz = files["mtz"]
+                if mtz is None:
+                    logger.warning("No mtz!")
+
+                ligand_binding_events = _get_ligand_binding_events_from_structure(pdb, xmap, dtag, ligands[pdb])
+                if len(ligand_binding_events) == 0:
+                    logger.warning(f"Dataset {dtag} has no ligand binding events!")
+                    continue
+                dataset = Dataset(
+                    dtag=dtag,
+                    pdb=str(pdb),
+                    xmap=str(xmap),
+                    mtz=str(mtz),
+                    ligand_binding_events=ligand_binding_events,
+                )
+                datasets[dtag] = dataset
+                reference_datasets[dtag] = dataset
+                logger.debug(f"Added dataset: {dtag}")
+
+        logger.info(
+            f"Discovered {len(datasets)} datasets in {time.perf_counter() - start:.2f} s: "
+            f"event tables {tables_time - start:.2f} s, "
+            f"{len(model_dirs)} model directories ({discovery_cache.dirs_listed} listed, "
+            f"{discovery_cache.dirs_cached} unchanged) {list_time - tables_time:.2f} s, "
+            f"ligands of {len(pdbs)} structures ({discovery_cache.pdbs_read} read, "
+            f"{discovery_cache.pdbs_cached} unchanged) {ligands_time - list_time:.2f} s"
+        )
 
         # Determine which of these are new using the fs_model output
         for dtag, dataset in datasets.items():
@@ -654,6 +697,22 @@ class Neighbourhood:
     def __init__(self, atoms: dict[tuple[str, str, str], Atom], artefact_atoms: dict[tuple[str, str, str], Atom]):
         self.atoms = atoms
         self.artefact_atoms = artefact_atoms
+        self._ca_array = None
+
+    @property
+    def ca_array(self):
+        # Residue numbers and positions of the CA atoms sorted by residue number, computed on first use
+        if self._ca_array is None:
+            ca_ids = [atom_id for atom_id in self.atoms if atom_id[2] == "CA"]
+            residues = np.array([int(atom_id[1]) for atom_id in ca_ids], dtype=np.int64)
+            positions = np.array(
+                [[self.atoms[atom_id].x, self.atoms[atom_id].y, self.atoms[atom_id].z] for atom_id in ca_ids],
+                dtype=np.float64,
+            ).reshape((-1, 3))
+            order = np.argsort(residues, kind="stable")
+            self._ca_array = (residues[order], positions[order])
+
+        return self._ca_array
 
     @staticmethod
     def from_dict(dic):
@@ -685,6 +744,329 @@ class Neighbourhood:
         return dic
 
 
+class NeighbourhoodStore(MutableMapping):
+    # Ligand neighbourhoods held as columns: per neighbourhood offsets into shared atom ID, element, position and
+    # image index arrays, with a table of the distinct image transforms. Neighbourhoods are only made into
+    # Neighbourhood objects when accessed, and those added or replaced are kept as objects
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.arrays = arrays
+        self._stored_index = {tuple(ligand_id): j for j, ligand_id in enumerate(arrays["ligand_ids"].tolist())}
+        self._order = {ligand_id: None for ligand_id in self._stored_index}
+        self._neighbourhoods = {}
+
+    @staticmethod
+    def from_npz(path):
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+        return NeighbourhoodStore(arrays)
+
+    def to_npz(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **self.to_arrays())
+
+    @staticmethod
+    def from_neighbourhoods(ligand_neighbourhoods: dict[tuple[str, str, str, str], Neighbourhood]):
+        store = NeighbourhoodStore(_get_empty_neighbourhood_arrays())
+        store.update(ligand_neighbourhoods)
+        return store
+
+    def __getitem__(self, ligand_id):
+        if ligand_id not in self._neighbourhoods:
+            if ligand_id not in self._order:
+                raise KeyError(ligand_id)
+            self._neighbourhoods[ligand_id] = self._get_stored_neighbourhood(self._stored_index[ligand_id])
+        return self._neighbourhoods[ligand_id]
+
+    def __setitem__(self, ligand_id, neighbourhood: Neighbourhood):
+        self._order[ligand_id] = None
+        self._neighbourhoods[ligand_id] = neighbourhood
+        self._stored_index.pop(ligand_id, None)
+
+    def __delitem__(self, ligand_id):
+        del self._order[ligand_id]
+        self._neighbourhoods.pop(ligand_id, None)
+        self._stored_index.pop(ligand_id, None)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, ligand_id):
+        return ligand_id in self._order
+
+    def _get_stored_neighbourhood(self, j: int):
+        start, artefact_start, stop = self.arrays["offsets"][j].tolist()
+        atom_ids = self.arrays["atom_ids"][start:stop].tolist()
+        elements = self.arrays["elements"][start:stop].tolist()
+        positions = self.arrays["positions"][start:stop].tolist()
+        images = {}
+        atom_items = []
+        for atom_id, element, position, image_index in zip(
+            atom_ids, elements, positions, self.arrays["image_indexes"][start:stop].tolist()
+        ):
+            if image_index not in images:
+                image = self.arrays["images"][image_index]
+                images[image_index] = (image[:3].tolist(), image[3:].reshape((3, 3)).tolist())
+            vec, mat = images[image_index]
+            atom_items.append(
+                (tuple(atom_id), Atom(element, *position, Transform(list(vec), [list(row) for row in mat])))
+            )
+
+        return Neighbourhood(
+            dict(atom_items[: artefact_start - start]),
+            dict(atom_items[artefact_start - start :]),
+        )
+
+    def to_arrays(self):
+        # Neighbourhoods still stored are copied across as array slices, the rest are made into columns. Ligands
+        # and atoms are ordered by their joined IDs, as they were in the YAML
+        ligand_ids, offsets, images = [], [], [self.arrays["images"]]
+        columns = {"atom_ids": [], "elements": [], "positions": [], "image_indexes": []}
+        num_atoms, num_images = 0, len(self.arrays["images"])
+        for ligand_id in sorted(self._order, key=lambda _ligand_id: "/".join(_ligand_id)):
+            if ligand_id in self._stored_index:
+                start, artefact_start, stop = self.arrays["offsets"][self._stored_index[ligand_id]].tolist()
+                for key, column in columns.items():
+                    column.append(self.arrays[key][start:stop])
+                num_artefact_atoms = stop - artefact_start
+            else:
+                neighbourhood = self._neighbourhoods[ligand_id]
+                atom_items = sorted(neighbourhood.atoms.items(), key=lambda _item: "/".join(_item[0])) + sorted(
+                    neighbourhood.artefact_atoms.items(), key=lambda _item: "/".join(_item[0])
+                )
+                image_rows = np.array(
+                    [atom.image.vec + [x for row in atom.image.mat for x in row] for _atom_id, atom in atom_items],
+                    dtype=np.float64,
+                ).reshape((-1, 12))
+                columns["atom_ids"].append(
+                    np.array([atom_id for atom_id, _atom in atom_items], dtype=str).reshape((-1, 3))
+                )
+                columns["elements"].append(np.array([atom.element for _atom_id, atom in atom_items], dtype=str))
+                columns["positions"].append(
+                    np.array([[atom.x, atom.y, atom.z] for _atom_id, atom in atom_items], dtype=np.float64).reshape(
+                        (-1, 3)
+                    )
+                )
+                columns["image_indexes"].append(np.arange(num_images, num_images + len(image_rows), dtype=np.int64))
+                images.append(image_rows)
+                num_images += len(image_rows)
+                num_artefact_atoms = len(neighbourhood.artefact_atoms)
+
+            num_neighbourhood_atoms = len(columns["elements"][-1])
+            ligand_ids.append(ligand_id)
+            offsets.append(
+                [
+                    num_atoms,
+                    num_atoms + num_neighbourhood_atoms - num_artefact_atoms,
+                    num_atoms + num_neighbourhood_atoms,
+                ]
+            )
+            num_atoms += num_neighbourhood_atoms
+
+        # Only the distinct image transforms are kept
+        images, image_indexes = np.unique(np.concatenate(images), axis=0, return_inverse=True)
+        empty = _get_empty_neighbourhood_arrays()
+        arrays = {
+            "ligand_ids": np.array(ligand_ids, dtype=str).reshape((-1, 4)),
+            "offsets": np.array(offsets, dtype=np.int64).reshape((-1, 3)),
+            "images": images.reshape((-1, 12)),
+        }
+        for key, column in columns.items():
+            arrays[key] = np.concatenate([empty[key]] + column)
+        arrays["image_indexes"] = image_indexes.reshape(-1)[arrays["image_indexes"]].astype(np.int64)
+
+        return arrays
+
+
+def _get_empty_neighbourhood_arrays():
+    return {
+        "ligand_ids": np.zeros((0, 4), dtype=str),
+        "offsets": np.zeros((0, 3), dtype=np.int64),
+        "atom_ids": np.zeros((0, 3), dtype=str),
+        "elements": np.zeros((0,), dtype=str),
+        "positions": np.zeros((0, 3), dtype=np.float64),
+        "image_indexes": np.zeros((0,), dtype=np.int64),
+        "images": np.zeros((0, 12), dtype=np.float64),
+    }
+
+
+class TransformStore(MutableMapping):
+    # Transforms between ligand neighbourhoods keyed by (to ligand ID, from ligand ID), holding one direction of each
+    # pair. Ligand IDs are interned to integers and the transforms kept as rows of 3 translation then 9 rotation
+    # values, with the inverse direction derived when asked for. Rows are only ever appended: setting a pair to a new
+    # transform adds a row that supersedes the old one, so saving to the file a store was read from appends the new
+    # rows. Once superseded rows outnumber live ones, or after a pair is deleted, the file is rewritten with only the
+    # live rows
+    record_dtype = np.dtype([("pair", "<i8", (2,)), ("transform", "<f8", (12,))])
+
+    def __init__(self, ligand_ids: list[tuple[str, str, str, str]], pairs: np.ndarray, transforms: np.ndarray):
+        self.ligand_ids = list(ligand_ids)
+        self._ligand_index = {ligand_id: j for j, ligand_id in enumerate(self.ligand_ids)}
+        self._pairs = np.array(pairs, dtype=np.int64).reshape((-1, 2))
+        self._transforms = np.array(transforms, dtype=np.float64).reshape((-1, 12))
+        self._num_rows = len(self._pairs)
+
+        # The latest row of each unordered pair, in the order pairs were first added
+        self._pair_rows = dict(zip(self._get_pair_keys(self._pairs).tolist(), range(self._num_rows)))
+        self._num_self_pairs = len(np.unique(self._pairs[self._pairs[:, 0] == self._pairs[:, 1], 0]))
+
+        self.path = None
+        self._num_saved_ligand_ids = 0
+        self._num_saved_rows = 0
+        self._has_deleted = False
+
+    @property
+    def pairs(self):
+        return self._pairs[: self._num_rows]
+
+    @property
+    def transforms(self):
+        return self._transforms[: self._num_rows]
+
+    @staticmethod
+    def _get_pair_keys(pairs):
+        return (np.minimum(pairs[:, 0], pairs[:, 1]) << 32) | np.maximum(pairs[:, 0], pairs[:, 1])
+
+    @staticmethod
+    def from_file(path):
+        with open(TransformStore.get_ligand_ids_path(path), "r") as f:
+            ligand_ids = [tuple(line.split("/")) for line in f.read().splitlines()]
+        records = np.fromfile(path, dtype=TransformStore.record_dtype)
+        store = TransformStore(ligand_ids, records["pair"], records["transform"])
+        store.path = Path(path)
+        store._num_saved_ligand_ids = len(store.ligand_ids)
+        store._num_saved_rows = store._num_rows
+        return store
+
+    @staticmethod
+    def from_transforms(transforms: dict[tuple[tuple[str, str, str, str], tuple[str, str, str, str]], "Transform"]):
+        store = TransformStore([], np.zeros((0, 2)), np.zeros((0, 12)))
+        for key, transform in transforms.items():
+            store[key] = transform
+        return store
+
+    @staticmethod
+    def get_ligand_ids_path(path):
+        return Path(path).with_name(constants.TRANSFORM_LIGAND_IDS_FILE_NAME)
+
+    def compact(self):
+        # Drop superseded rows, keeping the live ones in the order their pairs were first added
+        rows = list(self._pair_rows.values())
+        self._pairs = self._pairs[rows]
+        self._transforms = self._transforms[rows]
+        self._num_rows = len(rows)
+        self._pair_rows = dict(zip(self._pair_rows, range(self._num_rows)))
+        self._num_saved_rows = 0
+        self._has_deleted = False
+
+    def save(self, path):
+        path = Path(path)
+        ligand_ids_path = TransformStore.get_ligand_ids_path(path)
+        if self._has_deleted or (self._num_rows - len(self._pair_rows) > len(self._pair_rows)):
+            self.compact()
+            self.path = None
+        if (self.path is not None) and (self.path.resolve() == path.resolve()) and path.exists():
+            mode = "ab"
+            ligand_ids = self.ligand_ids[self._num_saved_ligand_ids :]
+            rows = slice(self._num_saved_rows, self._num_rows)
+        else:
+            mode = "wb"
+            ligand_ids, rows = self.ligand_ids, slice(0, self._num_rows)
+
+        with open(ligand_ids_path, mode[0]) as f:
+            f.writelines(["/".join(ligand_id) + "\n" for ligand_id in ligand_ids])
+
+        records = np.zeros(rows.stop - rows.start, dtype=TransformStore.record_dtype)
+        records["pair"] = self._pairs[rows]
+        records["transform"] = self._transforms[rows]
+        with open(path, mode) as f:
+            records.tofile(f)
+
+        self.path = path
+        self._num_saved_ligand_ids = len(self.ligand_ids)
+        self._num_saved_rows = self._num_rows
+
+    def _get_row(self, key):
+        to_index = self._ligand_index.get(key[0])
+        from_index = self._ligand_index.get(key[1])
+        if (to_index is None) or (from_index is None):
+            return None, None
+        row = self._pair_rows.get((min(to_index, from_index) << 32) | max(to_index, from_index))
+        if row is None:
+            return None, None
+        return row, self._pairs[row, 0] == to_index
+
+    def __getitem__(self, key):
+        row, forward = self._get_row(key)
+        if row is None:
+            raise KeyError(key)
+        return self._get_transform(row, forward)
+
+    def _get_transform(self, row, forward):
+        translation = self._transforms[row, :3]
+        rotation = self._transforms[row, 3:].reshape((3, 3))
+        if not forward:
+            rotation = rotation.T
+            translation = -(rotation @ translation)
+        return Transform(vec=translation.tolist(), mat=rotation.tolist())
+
+    def __setitem__(self, key, transform: "Transform"):
+        # Setting a pair to the transform it already has, in either direction, changes nothing
+        row, forward = self._get_row(key)
+        if row is not None:
+            current = self._get_transform(row, forward)
+            if np.allclose(current.vec, transform.vec, rtol=0.0, atol=1e-9) and np.allclose(
+                current.mat, transform.mat, rtol=0.0, atol=1e-9
+            ):
+                return
+
+        for ligand_id in key:
+            if ligand_id not in self._ligand_index:
+                self._ligand_index[ligand_id] = len(self.ligand_ids)
+                self.ligand_ids.append(ligand_id)
+
+        if self._num_rows == len(self._pairs):
+            capacity = max(2 * len(self._pairs), 1024)
+            self._pairs = np.resize(self._pairs, (capacity, 2))
+            self._transforms = np.resize(self._transforms, (capacity, 12))
+        to_index, from_index = self._ligand_index[key[0]], self._ligand_index[key[1]]
+        self._pairs[self._num_rows] = (to_index, from_index)
+        self._transforms[self._num_rows, :3] = transform.vec
+        self._transforms[self._num_rows, 3:] = np.array(transform.mat, dtype=np.float64).reshape(-1)
+        pair_key = (min(to_index, from_index) << 32) | max(to_index, from_index)
+        if (to_index == from_index) and (pair_key not in self._pair_rows):
+            self._num_self_pairs += 1
+        self._pair_rows[pair_key] = self._num_rows
+        self._num_rows += 1
+
+    def __delitem__(self, key):
+        # Deleting either direction deletes the pair
+        row, _ = self._get_row(key)
+        if row is None:
+            raise KeyError(key)
+        to_index, from_index = self._pairs[row].tolist()
+        del self._pair_rows[(min(to_index, from_index) << 32) | max(to_index, from_index)]
+        if to_index == from_index:
+            self._num_self_pairs -= 1
+        self._has_deleted = True
+
+    def __iter__(self):
+        # Each pair in the direction it was stored, then the inverse
+        for row in self._pair_rows.values():
+            to_index, from_index = self._pairs[row].tolist()
+            yield self.ligand_ids[to_index], self.ligand_ids[from_index]
+            if to_index != from_index:
+                yield self.ligand_ids[from_index], self.ligand_ids[to_index]
+
+    def __len__(self):
+        return 2 * len(self._pair_rows) - self._num_self_pairs
+
+    def __contains__(self, key):
+        return self._get_row(key)[0] is not None
+
+
 class AlignabilityGraph:
     ...
 
@@ -701,6 +1083,19 @@ class ConformerSite:
         self.residues_aligned = residues_aligned
         self.members: list[tuple[str, str, str, str]] = members
         self.reference_ligand_id: tuple[str, str, str, str] = reference_ligand_id
+        # The members as a set for membership checks, kept in step with the members list by add_member
+        self.member_set: set[tuple[str, str, str, str]] = set(members)
+
+    def has_member(self, lid: tuple[str, str, str, str]):
+        return lid in self.member_set
+
+    def add_member(self, lid: tuple[str, str, str, str]):
+        # Append the ligand to the members if it is not already one, returning whether it was added
+        if lid in self.member_set:
+            return False
+        self.members.append(lid)
+        self.member_set.add(lid)
+        return True
 
     @staticmethod
     def from_dict(dic):
@@ -778,11 +1173,16 @@ class XtalFormSite:
             crystallographic_chain: str,
             canonical_site_id: str,
             members: list[tuple[str, str, str]],
+            member_centroids: dict[tuple[str, str, str, str], tuple[str, str, float, float, float]] | None = None,
     ):
         self.xtalform_id: str = xtalform_id
         self.crystallographic_chain: str = crystallographic_chain
         self.canonical_site_id: str = canonical_site_id
         self.members: list[tuple[str, str, str]] = members
+        # The centroid residue of each member's neighbourhood and the position of its CA
+        self.member_centroids: dict[tuple[str, str, str, str], tuple[str, str, float, float, float]] = (
+            member_centroids if member_centroids is not None else {}
+        )
 
     @staticmethod
     def from_dict(dic):
@@ -790,7 +1190,12 @@ class XtalFormSite:
         for member in dic["members"]:
             dtag, chain, residue, version = member.split("/")
             members.append((dtag, chain, residue, version))
-        return XtalFormSite(dic["xtalform_id"], dic["crystallographic_chain"], dic["canonical_site_id"], members)
+        member_centroids = {
+            tuple(member.split("/")): tuple(centroid) for member, centroid in dic.get("member_centroids", {}).items()
+        }
+        return XtalFormSite(
+            dic["xtalform_id"], dic["crystallographic_chain"], dic["canonical_site_id"], members, member_centroids
+        )
 
     def to_dict(self):
         dic = {}
@@ -801,6 +1206,9 @@ class XtalFormSite:
         dic["xtalform_id"] = self.xtalform_id
         dic["crystallographic_chain"] = self.crystallographic_chain
         dic["canonical_site_id"] = self.canonical_site_id
+        dic["member_centroids"] = {
+            "/".join(member): list(centroid) for member, centroid in self.member_centroids.items()
+        }
         return dic
 
     def __rich_repr__(self):
@@ -1,5 +1,6 @@
 # import os
 import re
+import traceback
 from pathlib import Path
 
 import gemmi
@@ -467,16 +468,6 @@ xtalform_sites
     #     for chain in model:
     #         print(chain.name)
 
-    # Drop chains without atoms in neighbourhood
-    reduced_structure = _drop_non_binding_chains_and_symmetrize_waters(
-        _structure,
-        neighbourhood,
-        moving_ligand_id,
-        dataset_ligand_neighbourhood_ids,
-        xtalform,
-        xtalform_sites
-    )
-
     previous_ligand_id = moving_ligand_id
     running_transform = gemmi.Transform()
     for next_ligand_id in shortest_path:
@@ -513,17 +504,89 @@ xtalform_sites
 
     logger.debug(f"Transform from native frame to reference frame is: {gemmi_to_transform(running_transform)}")
 
-    _structure = superpose_structure(running_transform, reduced_structure)
+    _write_aligned_structure(
+        _structure,
+        running_transform,
+        neighbourhood,
+        moving_ligand_id,
+        dataset_ligand_neighbourhood_ids,
+        xtalform,
+        out_path,
+        xtalform_sites,
+    )
 
-    # print(f'After modification')
-    # for model in _structure:
-    #     for chain in model:
-    #         print(chain.name)
+
+def _write_aligned_structure(
+        _structure,
+        running_transform,
+        neighbourhood: dt.Neighbourhood,
+        moving_ligand_id: tuple[str, str, str],
+        dataset_ligand_neighbourhood_ids,
+        xtalform: dt.XtalForm,
+        out_path: Path,
+        xtalform_sites,
+):
+    # Drop chains without atoms in neighbourhood
+    reduced_structure = _drop_non_binding_chains_and_symmetrize_waters(
+        _structure,
+        neighbourhood,
+        moving_ligand_id,
+        dataset_ligand_neighbourhood_ids,
+        xtalform,
+        xtalform_sites
+    )
+
+    _structure = superpose_structure(running_transform, reduced_structure)
 
     # Write the fully aligned structure
     _structure.write_pdb(str(out_path))
 
 
+class AlignedStructureJob:
+    # A ligand of a dataset to align to a site: its precomputed transform to the site frame, what is needed to
+    # cut down the structure around it, and where to write it
+    def __init__(
+            self,
+            moving_ligand_id: tuple[str, str, str, str],
+            transform: dt.Transform,
+            neighbourhood: dt.Neighbourhood,
+            dataset_ligand_neighbourhood_ids,
+            xtalform: dt.XtalForm,
+            xtalform_sites,
+            out_path: str,
+    ):
+        self.moving_ligand_id = moving_ligand_id
+        self.transform = transform
+        self.neighbourhood = neighbourhood
+        self.dataset_ligand_neighbourhood_ids = dataset_ligand_neighbourhood_ids
+        self.xtalform = xtalform
+        self.xtalform_sites = xtalform_sites
+        self.out_path = out_path
+
+
+def _write_dataset_aligned_structures(_structure, jobs: list[AlignedStructureJob]):
+    # Write all the aligned structures of one dataset, returning the error for any that could not be written
+    # rather than stopping at the first
+    errors = []
+    for job in jobs:
+        try:
+            _write_aligned_structure(
+                _structure,
+                transform_to_gemmi(job.transform),
+                job.neighbourhood,
+                job.moving_ligand_id,
+                job.dataset_ligand_neighbourhood_ids,
+                job.xtalform,
+                job.out_path,
+                job.xtalform_sites,
+            )
+            errors.append(None)
+        except Exception:
+            errors.append(traceback.format_exc())
+
+    return errors
+
+
 def _align_reference_structure(
         _structure,
         dtag: str,
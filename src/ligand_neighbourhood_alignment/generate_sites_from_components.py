@@ -314,6 +314,25 @@ def _update_canonical_site_transforms(
     )
 
 
+def _get_xtalform_site_index(xtalform_sites: dict[str, dt.XtalFormSite]):
+    # The xtalform site of each (xtalform ID, canonical site ID, ligand ID). Where a ligand is a member of more than
+    # one site of an xtalform and canonical site, the last of them is taken
+    xtalform_site_index = {}
+    for xtalform_site in xtalform_sites.values():
+        for member in xtalform_site.members:
+            xtalform_site_index[(xtalform_site.xtalform_id, xtalform_site.canonical_site_id, member)] = xtalform_site
+    return xtalform_site_index
+
+
+def _get_xtalform_site(xtalform_site_index, xtalform_id, canonical_site_id, ligand_id):
+    key = (xtalform_id, canonical_site_id, ligand_id)
+    if key not in xtalform_site_index:
+        raise KeyError(
+            f"No xtalform site of xtalform {xtalform_id} and canonical site {canonical_site_id} has ligand {ligand_id}"
+        )
+    return xtalform_site_index[key]
+
+
 def _update_reference_structure_transforms(
     reference_structure_transforms,
     key,
@@ -324,18 +343,19 @@ def _update_reference_structure_transforms(
     xtalforms,
     dataset_assignments,
     xtalform_sites,
-    canonical_site_id
+    canonical_site_id,
+    xtalform_site_index=None,
 ):
+    if xtalform_site_index is None:
+        xtalform_site_index = _get_xtalform_site_index(xtalform_sites)
+
     # # Get the biochain of the canonical site
     site_reference_ligand_id = conformer_sites[canonical_site.reference_conformer_site_id].reference_ligand_id
     site_reference_ligand_xtalform_id = dataset_assignments[site_reference_ligand_id[0]]
     site_reference_ligand_xtalform = xtalforms[site_reference_ligand_xtalform_id]
-    for xsid, _xtalform_site in xtalform_sites.items():
-        _xtalform_id = _xtalform_site.xtalform_id
-        if (_xtalform_id == site_reference_ligand_xtalform_id) &\
-            (_xtalform_site.canonical_site_id == canonical_site_id) & \
-                (site_reference_ligand_id in _xtalform_site.members):
-                xtalform_site = _xtalform_site
+    xtalform_site = _get_xtalform_site(
+        xtalform_site_index, site_reference_ligand_xtalform_id, canonical_site_id, site_reference_ligand_id
+    )
     site_chain = xtalform_site.crystallographic_chain
     canonical_site_biochain = alignment_heirarchy._chain_to_biochain(
         site_chain,
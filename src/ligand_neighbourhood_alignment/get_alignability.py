@@ -1,3 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
 import gemmi
 import numpy as np
 from loguru import logger
@@ -10,7 +14,7 @@ from ligand_neighbourhood_alignment.data import (
     Transform,
     Transforms,
 )
-from ligand_neighbourhood_alignment.matching import match_atom, _match_atom
+from ligand_neighbourhood_alignment.matching import match_atom
 
 
 def match_cas(
@@ -105,54 +109,86 @@ def get_alignability(
 from ligand_neighbourhood_alignment import dt
 
 
+def _get_shared_ca_indexes(residues_1, residues_2):
+    # Pair up the CAs of two residue sorted arrays that share a residue number. As chains are ignored, a residue
+    # number present in several chains pairs every copy in one neighbourhood with every copy in the other
+    shared_residues = np.intersect1d(residues_1, residues_2)
+    starts_1 = np.searchsorted(residues_1, shared_residues, side="left")
+    counts_1 = np.searchsorted(residues_1, shared_residues, side="right") - starts_1
+    starts_2 = np.searchsorted(residues_2, shared_residues, side="left")
+    counts_2 = np.searchsorted(residues_2, shared_residues, side="right") - starts_2
+
+    counts = counts_1 * counts_2
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    indexes_1 = np.repeat(starts_1, counts) + offsets // np.repeat(counts_2, counts)
+    indexes_2 = np.repeat(starts_2, counts) + offsets % np.repeat(counts_2, counts)
+
+    return indexes_1, indexes_2
+
+
+def _superpose_ca_positions(positions_1, positions_2):
+    # Least squares fit of positions 2 onto positions 1 - the transform is frame 2 to frame 1
+    centroid_1 = np.mean(positions_1, axis=0)
+    centroid_2 = np.mean(positions_2, axis=0)
+    covariance = (positions_2 - centroid_2).T @ (positions_1 - centroid_1)
+
+    # Gemmi's superposition gives no fit (a nan rmsd) for fewer than three or colinear positions, so neither do we
+    if (len(positions_1) < 3) or (np.linalg.matrix_rank(covariance) < 2):
+        return None, None, None
+
+    u, s, vt = np.linalg.svd(covariance)
+    handedness = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1.0, 1.0, handedness]) @ u.T
+    translation = centroid_1 - (rotation @ centroid_2)
+
+    residuals = positions_1 - ((positions_2 @ rotation.T) + translation)
+    rmsd = np.sqrt(np.mean(np.sum(residuals * residuals, axis=1)))
+
+    return rotation, translation, rmsd
+
+
+def _match_ca_arrays(
+    ligand_1_ca_array,
+    ligand_1_num_atoms: int,
+    ligand_2_ca_array,
+    ligand_2_num_atoms: int,
+    min_alignable_atoms: int = 9,
+    max_alignable_rmsd: float = 1.0,
+):
+    residues_1, positions_1 = ligand_1_ca_array
+    residues_2, positions_2 = ligand_2_ca_array
+    indexes_1, indexes_2 = _get_shared_ca_indexes(residues_1, residues_2)
+
+    if len(indexes_1) < min([min_alignable_atoms, ligand_1_num_atoms, ligand_2_num_atoms]):
+        return False, None, None
+
+    rotation, translation, rmsd = _superpose_ca_positions(positions_1[indexes_1], positions_2[indexes_2])
+    if (rmsd is None) or (not (rmsd < max_alignable_rmsd)):
+        return False, None, None
+
+    inverse_rotation = rotation.T
+    inverse_translation = -(inverse_rotation @ translation)
+    return (
+        True,
+        dt.Transform(vec=translation.tolist(), mat=rotation.tolist()),
+        dt.Transform(vec=inverse_translation.tolist(), mat=inverse_rotation.tolist()),
+    )
+
+
 def _match_cas(
     ligand_1_neighbourhood: dt.Neighbourhood,
     ligand_2_neighbourhood: dt.Neighbourhood,
     min_alignable_atoms: int = 9,  # 10 splits A71, but some things almost identical end up in different clusters
     max_alignable_rmsd: float = 1.0,
 ):
-
-    alignable_cas = []
-    for ligand_1_atom_id, ligand_1_atom in ligand_1_neighbourhood.atoms.items():
-        for ligand_2_atom_id, ligand_2_atom in ligand_2_neighbourhood.atoms.items():
-            if ligand_1_atom_id[2] == "CA":
-                if _match_atom(ligand_1_atom_id, ligand_2_atom_id, ignore_chain=True):
-                    alignable_cas.append(
-                        (
-                            gemmi.Position(
-                                ligand_1_atom.x,
-                                ligand_1_atom.y,
-                                ligand_1_atom.z,
-                            ),
-                            gemmi.Position(
-                                ligand_2_atom.x,
-                                ligand_2_atom.y,
-                                ligand_2_atom.z,
-                            ),
-                        )
-                    )
-
-    if len(alignable_cas) >= min(
-        [min_alignable_atoms, len(ligand_1_neighbourhood.atoms), len(ligand_2_neighbourhood.atoms)]
-    ):
-        sup = gemmi.superpose_positions(
-            [alignable_ca[0] for alignable_ca in alignable_cas],
-            [alignable_ca[1] for alignable_ca in alignable_cas],
-        )
-        transform = sup.transform
-        inverse_transform = sup.transform.inverse()
-
-        rmsd = sup.rmsd
-        if rmsd < max_alignable_rmsd:
-            return (
-                True,
-                dt.Transform(vec=transform.vec.tolist(), mat=transform.mat.tolist()),
-                dt.Transform(vec=inverse_transform.vec.tolist(), mat=inverse_transform.mat.tolist()),
-            )
-        else:
-            return False, None, None
-    else:
-        return False, None, None
+    return _match_ca_arrays(
+        ligand_1_neighbourhood.ca_array,
+        len(ligand_1_neighbourhood.atoms),
+        ligand_2_neighbourhood.ca_array,
+        len(ligand_2_neighbourhood.atoms),
+        min_alignable_atoms,
+        max_alignable_rmsd,
+    )
 
 
 def _update_ligand_neighbourhood_transforms(
@@ -198,3 +234,233 @@ def _update_ligand_neighbourhood_transforms(
 
     # logger.debug(connectivity)
     # return ligand_neighbourhood_transforms
+
+
+def _update_ligand_neighbourhood_ca_index(
+    ligand_neighbourhood_ca_index: dict[tuple[str, str], dict[tuple[str, str, str, str], int]],
+    ligand_id: tuple[str, str, str, str],
+    ligand_neighbourhood: dt.Neighbourhood,
+    reindex: bool = False,
+):
+    # Record how many CAs with each residue number the neighbourhood contains. A neighbourhood that was indexed
+    # before (for example from a reprocessed dataset) has its old postings dropped first
+    if reindex:
+        for postings in ligand_neighbourhood_ca_index.values():
+            if ligand_id in postings:
+                del postings[ligand_id]
+
+    residues, _ = ligand_neighbourhood.ca_array
+    for residue, count in zip(*np.unique(residues, return_counts=True)):
+        key = (str(residue), "CA")
+        if key not in ligand_neighbourhood_ca_index:
+            ligand_neighbourhood_ca_index[key] = {}
+        ligand_neighbourhood_ca_index[key][ligand_id] = int(count)
+
+
+def _get_ligand_neighbourhood_pairs(
+    ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
+    ligand_ids,
+    ligand_neighbourhood_ca_index: dict[tuple[str, str], dict[tuple[str, str, str, str], int]],
+    min_alignable_atoms: int = 9,
+):
+    # Get every unordered pair of distinct neighbourhoods involving at least one of the given ligands that share
+    # enough CAs to be matched, counted from the index postings. Each pair is oriented as (later, earlier) in the
+    # order of ligand_neighbourhoods, which is the orientation whose match a full all against all pass ends up
+    # keeping for both directions
+    order = {ligand_id: j for j, ligand_id in enumerate(ligand_neighbourhoods)}
+    pairs = set()
+    for ligand_1_id in set(ligand_ids):
+        ligand_1_neighbourhood = ligand_neighbourhoods[ligand_1_id]
+        residues, _ = ligand_1_neighbourhood.ca_array
+
+        # CAs are matched ignoring chain, so a residue number shared by several chains counts every combination
+        num_shared_cas = {}
+        for residue, count in zip(*np.unique(residues, return_counts=True)):
+            for ligand_2_id, ligand_2_count in ligand_neighbourhood_ca_index.get((str(residue), "CA"), {}).items():
+                num_shared_cas[ligand_2_id] = num_shared_cas.get(ligand_2_id, 0) + (int(count) * ligand_2_count)
+
+        for ligand_2_id, num_shared in num_shared_cas.items():
+            if (ligand_2_id == ligand_1_id) or (ligand_2_id not in order):
+                continue
+            if num_shared < min(
+                [min_alignable_atoms, len(ligand_1_neighbourhood.atoms), len(ligand_neighbourhoods[ligand_2_id].atoms)]
+            ):
+                continue
+            if order[ligand_1_id] > order[ligand_2_id]:
+                pairs.add((ligand_1_id, ligand_2_id))
+            else:
+                pairs.add((ligand_2_id, ligand_1_id))
+
+    return sorted(pairs, key=lambda _pair: (order[_pair[0]], order[_pair[1]]))
+
+
+def _match_ligand_neighbourhood_pairs(
+    pairs,
+    ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
+):
+    matches = []
+    for ligand_1_id, ligand_2_id in pairs:
+        # See if atoms match - transform is frame 2 to frame 1
+        ca_match, transform, inverse_transform = _match_cas(
+            ligand_neighbourhoods[ligand_1_id],
+            ligand_neighbourhoods[ligand_2_id],
+        )
+        if ca_match:
+            matches.append(((ligand_1_id, ligand_2_id), transform, inverse_transform))
+
+    return matches
+
+
+# CA arrays attached from shared memory in each matching worker process
+_worker_ca_arrays = {}
+
+
+def _pack_ca_arrays(
+    ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
+    ligand_ids,
+):
+    # Concatenate the CA arrays of the given neighbourhoods, with offsets to recover each one
+    ca_arrays = [ligand_neighbourhoods[ligand_id].ca_array for ligand_id in ligand_ids]
+    return {
+        "residues": np.concatenate([residues for residues, _ in ca_arrays] + [np.zeros(0, dtype=np.int64)]),
+        "positions": np.concatenate([positions for _, positions in ca_arrays] + [np.zeros((0, 3))]),
+        "offsets": np.cumsum([0] + [len(residues) for residues, _ in ca_arrays], dtype=np.int64),
+        "num_atoms": np.array(
+            [len(ligand_neighbourhoods[ligand_id].atoms) for ligand_id in ligand_ids], dtype=np.int64
+        ),
+    }
+
+
+def _init_matching_worker(shared_array_specs):
+    for key, (name, shape, dtype) in shared_array_specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_ca_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _match_packed_ca_pairs(
+    pair_indexes,
+    min_alignable_atoms: int = 9,
+    max_alignable_rmsd: float = 1.0,
+):
+    # Match pairs of neighbourhoods given by their index into the shared CA arrays, returning the position in
+    # the shard and the transforms of each pair that matches
+    residues = _worker_ca_arrays["residues"][1]
+    positions = _worker_ca_arrays["positions"][1]
+    offsets = _worker_ca_arrays["offsets"][1]
+    num_atoms = _worker_ca_arrays["num_atoms"][1]
+
+    matches = []
+    for j, (index_1, index_2) in enumerate(pair_indexes):
+        ca_match, transform, inverse_transform = _match_ca_arrays(
+            (residues[offsets[index_1] : offsets[index_1 + 1]], positions[offsets[index_1] : offsets[index_1 + 1]]),
+            int(num_atoms[index_1]),
+            (residues[offsets[index_2] : offsets[index_2 + 1]], positions[offsets[index_2] : offsets[index_2 + 1]]),
+            int(num_atoms[index_2]),
+            min_alignable_atoms,
+            max_alignable_rmsd,
+        )
+        if ca_match:
+            matches.append((j, transform, inverse_transform))
+
+    return matches
+
+
+def _match_ligand_neighbourhood_pairs_parallel(
+    pairs,
+    ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
+    num_workers: int,
+    min_alignable_atoms: int = 9,
+    max_alignable_rmsd: float = 1.0,
+):
+    # The CA arrays are placed in shared memory once for all workers, so that tasks only carry pair indexes.
+    # Shards are collected in order, giving the same matches in the same order as the serial path
+    ligand_ids = list(dict.fromkeys(ligand_id for pair in pairs for ligand_id in pair))
+    ligand_indexes = {ligand_id: j for j, ligand_id in enumerate(ligand_ids)}
+    pair_indexes = np.array(
+        [[ligand_indexes[ligand_1_id], ligand_indexes[ligand_2_id]] for ligand_1_id, ligand_2_id in pairs],
+        dtype=np.int64,
+    )
+
+    shms = []
+    shared_array_specs = {}
+    try:
+        for key, array in _pack_ca_arrays(ligand_neighbourhoods, ligand_ids).items():
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shms.append(shm)
+            shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared_array[...] = array
+            del shared_array
+            shared_array_specs[key] = (shm.name, array.shape, array.dtype.str)
+
+        shard_size = max(1, -(-len(pairs) // (num_workers * 4)))
+        shard_starts = list(range(0, len(pairs), shard_size))
+        matches = []
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_matching_worker,
+            initargs=(shared_array_specs,),
+        ) as executor:
+            shard_matches = executor.map(
+                partial(
+                    _match_packed_ca_pairs,
+                    min_alignable_atoms=min_alignable_atoms,
+                    max_alignable_rmsd=max_alignable_rmsd,
+                ),
+                [pair_indexes[shard_start : shard_start + shard_size] for shard_start in shard_starts],
+            )
+            for shard_start, _matches in zip(shard_starts, shard_matches):
+                for j, transform, inverse_transform in _matches:
+                    matches.append((pairs[shard_start + j], transform, inverse_transform))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    return matches
+
+
+def _update_ligand_neighbourhood_transforms_incremental(
+    ligand_neighbourhood_transforms: dict[tuple[tuple[str, str, str, str], tuple[str, str, str, str]], dt.Transform],
+    new_ligand_ids,
+    ligand_neighbourhoods: dict[tuple[str, str, str, str], dt.Neighbourhood],
+    ligand_neighbourhood_ca_index: dict[tuple[str, str], dict[tuple[str, str, str, str], int]],
+    full_rematch: bool = False,
+    num_workers: int = 1,
+):
+    # Match only the pairs that involve a new neighbourhood: pairs between existing neighbourhoods already have
+    # their transforms recorded from previous updates. Self pairs are skipped since they only ever give the
+    # identity, and each unordered pair is matched once with the inverse recorded for the other direction
+    if full_rematch:
+        new_ligand_ids = list(ligand_neighbourhoods)
+        ligand_neighbourhood_ca_index.clear()
+
+    # Index the new neighbourhoods along with any that are missing from the index
+    indexed_ligand_ids = {
+        ligand_id for postings in ligand_neighbourhood_ca_index.values() for ligand_id in postings
+    }
+    for ligand_id in set(new_ligand_ids).union(set(ligand_neighbourhoods).difference(indexed_ligand_ids)):
+        _update_ligand_neighbourhood_ca_index(
+            ligand_neighbourhood_ca_index,
+            ligand_id,
+            ligand_neighbourhoods[ligand_id],
+            reindex=ligand_id in indexed_ligand_ids,
+        )
+
+    pairs = _get_ligand_neighbourhood_pairs(ligand_neighbourhoods, new_ligand_ids, ligand_neighbourhood_ca_index)
+    logger.info(f"Matching {len(pairs)} candidate pairs of ligand neighbourhoods")
+
+    if (num_workers > 1) and (len(pairs) > 0):
+        matches = _match_ligand_neighbourhood_pairs_parallel(pairs, ligand_neighbourhoods, num_workers)
+    else:
+        matches = _match_ligand_neighbourhood_pairs(pairs, ligand_neighbourhoods)
+
+    matched = set()
+    for (ligand_1_id, ligand_2_id), transform, inverse_transform in matches:
+        ligand_neighbourhood_transforms[(ligand_1_id, ligand_2_id)] = transform
+        ligand_neighbourhood_transforms[(ligand_2_id, ligand_1_id)] = inverse_transform
+        matched.add(ligand_1_id)
+        matched.add(ligand_2_id)
+
+    for ligand_id in new_ligand_ids:
+        if ligand_id not in matched:
+            rprint(f"No Matches For {ligand_id} against any other ligand neighbourhood!")
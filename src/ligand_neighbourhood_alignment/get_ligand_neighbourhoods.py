@@ -1,4 +1,7 @@
+import math
+
 import gemmi
+import numpy as np
 from loguru import logger
 
 # import loguru
@@ -99,6 +102,40 @@ def __get_model_and_artefact_atoms(
     return model_atoms, artefact_atoms
 
 
+class _PositionHash:
+    # Positions bucketed on a grid, so that checking for one within the tolerance of a query only needs the
+    # surrounding buckets. Buckets are twice the tolerance so that rounding can not put a close pair two buckets apart
+    def __init__(self, positions=(), tolerance: float = 0.1):
+        self.tolerance = tolerance
+        self.bucket_size = 2 * tolerance
+        self.buckets = {}
+        for pos in positions:
+            self.add(pos)
+
+    def _get_key(self, pos: gemmi.Position):
+        return (
+            math.floor(pos.x / self.bucket_size),
+            math.floor(pos.y / self.bucket_size),
+            math.floor(pos.z / self.bucket_size),
+        )
+
+    def add(self, pos: gemmi.Position):
+        key = self._get_key(pos)
+        if key not in self.buckets:
+            self.buckets[key] = []
+        self.buckets[key].append(pos)
+
+    def has_close(self, pos: gemmi.Position):
+        x, y, z = self._get_key(pos)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for other_pos in self.buckets.get((x + dx, y + dy, z + dz), ()):
+                        if other_pos.dist(pos) <= self.tolerance:
+                            return True
+        return False
+
+
 def get_model_and_artefact_atoms(
     residue_neighbours: list[tuple[gemmi.Position, gemmi.CRA]],
     structure: Structure,
@@ -108,6 +145,7 @@ def get_model_and_artefact_atoms(
     model_atoms: list[tuple[gemmi.Position, gemmi.CRA]] = []
     artefact_atoms: list[tuple[gemmi.Position, gemmi.CRA]] = []
     possible_artefact_atoms = []
+    model_positions = _PositionHash()
     for pos, cra in residue_neighbours:
         # Image 0 is the identity i.e. part of the normal model
         # cra = mark.to_cra(structure[0])
@@ -134,8 +172,9 @@ def get_model_and_artefact_atoms(
         # Canonical/model atom confirnmed: just see if already handled
         else:
             # Check there is not already a nearby atom in there
-            if all([model_atom[0].dist(pos) > 0.1 for model_atom in model_atoms]):
+            if not model_positions.has_close(pos):
                 model_atoms.append((pos, cra))
+                model_positions.add(pos)
 
         # rounded_pos = (
         #         round(pos.x, 1),
@@ -143,19 +182,18 @@ def get_model_and_artefact_atoms(
         #         round(pos.z, 1),
         #     )
         # if roun
+    artefact_positions = _PositionHash()
     for pos, cra in possible_artefact_atoms:
         # Check it isn't a ncs image by seeing if it overlays a model atom
-        if all([model_atom[0].dist(pos) > 0.1 for model_atom in model_atoms]):
-            if all([model_atom[0].dist(pos) > 0.1 for model_atom in artefact_atoms]):
+        if not model_positions.has_close(pos):
+            if not artefact_positions.has_close(pos):
                 artefact_atoms.append((pos, cra))
+                artefact_positions.add(pos)
 
-    updated_model_atoms = [
-        atom for atom in model_atoms if all([fragment_atom.pos.dist(atom[0]) > 0.1 for fragment_atom in fragment])
-    ]
+    fragment_positions = _PositionHash([fragment_atom.pos for fragment_atom in fragment])
+    updated_model_atoms = [atom for atom in model_atoms if not fragment_positions.has_close(atom[0])]
 
-    updated_artefact_atoms = [
-        atom for atom in artefact_atoms if all([fragment_atom.pos.dist(atom[0]) > 0.1 for fragment_atom in fragment])
-    ]
+    updated_artefact_atoms = [atom for atom in artefact_atoms if not fragment_positions.has_close(atom[0])]
 
     # return model_atoms, artefact_atoms
     return updated_model_atoms, updated_artefact_atoms
@@ -289,6 +327,20 @@ def get_ligand_neighbourhood(
 from ligand_neighbourhood_alignment import dt
 
 
+def _apply_transform_columns(mat, vec, x, y, z):
+    # A gemmi Transform applied to columns of coordinates, summing in the same order as gemmi for the same result
+    return (
+        mat[..., 0, 0] * x + mat[..., 0, 1] * y + mat[..., 0, 2] * z + vec[..., 0],
+        mat[..., 1, 0] * x + mat[..., 1, 1] * y + mat[..., 1, 2] * z + vec[..., 1],
+        mat[..., 2, 0] * x + mat[..., 2, 1] * y + mat[..., 2, 2] * z + vec[..., 2],
+    )
+
+
+def _round_half_away(x):
+    # Rounding as gemmi does when finding the nearest periodic image, rather than numpy's round half to even
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+
 def _get_ligand_neighbourhood(
     structure,
     ns: gemmi.NeighborSearch,
@@ -298,10 +350,16 @@ def _get_ligand_neighbourhood(
 ):
     # For each atom, get the neighbouring atoms, and filter them on their
     # real space position
-    residue_neighbours: list[tuple[gemmi.Position, gemmi.CRA]] = []
-
-    atom_images = {}
-    for atom in fragment:
+    cell = structure.cell
+
+    # Collect the marks near each fragment atom, keeping each image of each atom once
+    mark_indexes = {}
+    marks = []
+    pair_marks = []
+    pair_fragment_atoms = []
+    fragment_positions = []
+    for fragment_atom_index, atom in enumerate(fragment):
+        fragment_positions.append(atom.pos.tolist())
         # Get the atom neighbours (as arbitrary image marks)
         atom_neighbours: list[gemmi.NeighborSearch.Mark] = ns.find_neighbors(
             atom,
@@ -309,37 +367,70 @@ def _get_ligand_neighbourhood(
             max_dist=max_dist,
         )
         for neighbour in atom_neighbours:
-            # Get positions of the marks nearest image to canon atom
-            cra = neighbour.to_cra(structure[0])
-            atom_id: tuple[str, str, str] = (
-                str(cra.chain.name),
-                str(cra.residue.seqid.num),
-                str(cra.atom.name),
-            )
-
-            # Nearest image of canon atom
-            nearest_image = structure.cell.find_nearest_pbc_image(
-                atom.pos,
-                cra.atom.pos,
-                neighbour.image_idx,
-            )
-
-            # Get canon atom pos as tractional
-            fpos = structure.cell.fractionalize(cra.atom.pos)
-
-            # Get transform that generates image from canon
-            ftransform = ns.get_image_transformation(neighbour.image_idx)
-            atom_images[atom_id] = ftransform
-
-            # Apply the canon -> image and image -> pbc image transforms
-            fpos_trans = ftransform.apply(fpos)
-            fpos_trans.x = fpos_trans.x + nearest_image.pbc_shift[0]
-            fpos_trans.y = fpos_trans.y + nearest_image.pbc_shift[1]
-            fpos_trans.z = fpos_trans.z + nearest_image.pbc_shift[2]
-
-            pos = structure.cell.orthogonalize(fpos_trans)
-
-            residue_neighbours.append((pos, cra))
+            key = (neighbour.chain_idx, neighbour.residue_idx, neighbour.atom_idx, neighbour.image_idx)
+            if key not in mark_indexes:
+                mark_indexes[key] = len(marks)
+                marks.append(neighbour)
+            pair_marks.append(mark_indexes[key])
+            pair_fragment_atoms.append(fragment_atom_index)
+
+    if len(marks) == 0:
+        return dt.Neighbourhood({}, {})
+
+    # Resolve each distinct mark to its canon atom, and each distinct image to its transform, once
+    cras = [mark.to_cra(structure[0]) for mark in marks]
+    mark_atom_ids = [(str(cra.chain.name), str(cra.residue.seqid.num), str(cra.atom.name)) for cra in cras]
+    mark_image_idxs = [mark.image_idx for mark in marks]
+    image_idxs = sorted(set(mark_image_idxs))
+    image_transforms = {image_idx: ns.get_image_transformation(image_idx) for image_idx in image_idxs}
+    images = {
+        image_idx: dt.Transform(vec=transform.vec.tolist(), mat=transform.mat.tolist())
+        for image_idx, transform in image_transforms.items()
+    }
+    image_rows = {image_idx: j for j, image_idx in enumerate(image_idxs)}
+    image_mats = np.array([image_transforms[image_idx].mat.tolist() for image_idx in image_idxs])
+    image_vecs = np.array([image_transforms[image_idx].vec.tolist() for image_idx in image_idxs])
+    mark_image_rows = np.array([image_rows[image_idx] for image_idx in mark_image_idxs])
+
+    # Each atom takes the image of the last mark of it found, as when marks were handled one at a time
+    atom_images = dict(zip([mark_atom_ids[j] for j in pair_marks], [mark_image_idxs[j] for j in pair_marks]))
+
+    # Get canon atom pos as fractional, and apply the canon -> image transforms
+    frac_mat = np.array(cell.frac.mat.tolist())
+    frac_vec = np.array(cell.frac.vec.tolist())
+    canon_positions = np.array([cra.atom.pos.tolist() for cra in cras])
+    fpos = _apply_transform_columns(frac_mat, frac_vec, *canon_positions.T)
+    fpos_image = _apply_transform_columns(
+        image_mats[mark_image_rows],
+        image_vecs[mark_image_rows],
+        *fpos,
+    )
+    fpos_image = np.stack(fpos_image, axis=1)
+
+    # The image -> pbc image shift nearest each fragment atom the mark was found from
+    fragment_fpos = np.stack(_apply_transform_columns(frac_mat, frac_vec, *np.array(fragment_positions).T), axis=1)
+    pair_marks = np.array(pair_marks)
+    if cell.is_crystal():
+        pbc_shifts = -_round_half_away(fpos_image[pair_marks] - fragment_fpos[np.array(pair_fragment_atoms)])
+    else:
+        pbc_shifts = np.zeros((len(pair_marks), 3))
+
+    # Keep each distinct image position once, in the order first found
+    _, first_indexes = np.unique(
+        np.concatenate([pair_marks.reshape((-1, 1)), pbc_shifts], axis=1),
+        axis=0,
+        return_index=True,
+    )
+    first_indexes = np.sort(first_indexes)
+    neighbour_marks = pair_marks[first_indexes]
+    fpos_trans = fpos_image[neighbour_marks] + pbc_shifts[first_indexes]
+    orth_mat = np.array(cell.orth.mat.tolist())
+    orth_vec = np.array(cell.orth.vec.tolist())
+    positions = np.stack(_apply_transform_columns(orth_mat, orth_vec, *fpos_trans.T), axis=1)
+
+    residue_neighbours: list[tuple[gemmi.Position, gemmi.CRA]] = [
+        (gemmi.Position(*pos), cras[j]) for pos, j in zip(positions.tolist(), neighbour_marks.tolist())
+    ]
 
     # # Seperate out model and artefact atoms
     _model_atoms, _artefact_atoms = get_model_and_artefact_atoms(residue_neighbours, structure, fragment)
@@ -350,54 +441,44 @@ def _get_ligand_neighbourhood(
     model_atoms: dict[tuple[str, str, str], dt.Atom] = {}
     for pos, cra in _model_atoms:
         # cra = atom.to_cra(structure[0])
-        model_atom_id: tuple[str, str, str] = (
+        atom_id: tuple[str, str, str] = (
             str(cra.chain.name),
             str(cra.residue.seqid.num),
             str(cra.atom.name),
         )
-        image_transform = atom_images[model_atom_id]
         model_atom_id: tuple[str, str, str] = (
             str(cra.chain.name).split("~")[0],
             str(cra.residue.seqid.num),
             str(cra.atom.name),
         )
-        transform = dt.Transform(
-            vec=image_transform.vec.tolist(),
-            mat=image_transform.mat.tolist(),
-        )
         model_atoms[model_atom_id] = dt.Atom(
             element=cra.atom.element.name,
             x=pos.x,
             y=pos.y,
             z=pos.z,
-            image=transform,
+            image=images[atom_images[atom_id]],
         )
 
     # Artefact atoms
     artefact_atoms: dict[tuple[str, str, str], dt.Atom] = {}
     for pos, cra in _artefact_atoms:
         # artefact_cra = atom.to_cra(structure[0])
-        artefact_atom_id: tuple[str, str, str] = (
+        atom_id: tuple[str, str, str] = (
             str(cra.chain.name),
             str(cra.residue.seqid.num),
             str(cra.atom.name),
         )
-        image_transform = atom_images[artefact_atom_id]
         artefact_atom_id: tuple[str, str, str] = (
             str(cra.chain.name).split("~")[0],
             str(cra.residue.seqid.num),
             str(cra.atom.name),
         )
-        transform = dt.Transform(
-            vec=image_transform.vec.tolist(),
-            mat=image_transform.mat.tolist(),
-        )
         artefact_atoms[artefact_atom_id] = dt.Atom(
             element=cra.atom.element.name,
             x=pos.x,
             y=pos.y,
             z=pos.z,
-            image=transform,
+            image=images[atom_images[atom_id]],
         )
 
     # Cosntruct the neighbourhood
@@ -17,31 +17,32 @@ from ligand_neighbourhood_alignment.data import (
 )
 
 
-def get_closest_lig(structure, coord):
-    coord_gemmi = gemmi.Position(*coord)
-
-    distances = {}
+def _get_ligand_centroids(structure):
+    # The (chain, residue number) of each ligand other than DMS and an array of their centroids
+    ligand_ids = []
+    centroids = []
     for model in structure:
         for chain in model:
             for residue in chain.get_ligands():
                 # if residue.name == "LIG":
                 if residue.name == "DMS":
                     continue
-                poss = []
-                for atom in residue:
-                    pos = atom.pos
-                    poss.append([pos.x, pos.y, pos.z])
-
-                arr = np.array(poss)
-                mean = np.mean(arr, axis=0)
-                mean_pos = gemmi.Position(*mean)
-                distance = coord_gemmi.dist(mean_pos)
-                distances[(chain.name, residue.seqid.num)] = distance
-
-    if len(distances) == 0:
+                ligand_ids.append((chain.name, residue.seqid.num))
+                centroids.append(np.mean(np.array([atom.pos.tolist() for atom in residue]), axis=0))
+
+    return ligand_ids, np.array(centroids).reshape((-1, 3))
+
+
+def _get_closest_ligand(ligand_ids, centroids, coord):
+    if len(ligand_ids) == 0:
         return None, None
 
-    return min(distances, key=lambda x: distances[x])
+    distances = np.sqrt(np.sum(np.square(centroids - np.array(coord)), axis=1))
+    return ligand_ids[int(np.argmin(distances))]
+
+
+def get_closest_lig(structure, coord):
+    return _get_closest_ligand(*_get_ligand_centroids(structure), coord)
 
 
 from ligand_neighbourhood_alignment import dt
@@ -81,28 +82,25 @@ def _get_ligand_binding_events_from_structure(
     pdb_path: Path,
     xmap_path: Path,
     dtag: str,
+    ligands=None,
 ):
-    structure = gemmi.read_structure(str(pdb_path))
+    # The ligands may already have been found, as (chain, residue number) IDs and centroids
+    if ligands is None:
+        ligands = _get_ligand_centroids(gemmi.read_structure(str(pdb_path)))
     event_id = 0
 
     lbes = {}
 
-    for model in structure:
-        for chain in model:
-            for residue in chain.get_ligands():
-
-                if residue.name == "DMS":
-                    continue
-
-                lbe = dt.LigandBindingEvent(
-                    id=str(event_id),
-                    dtag=str(dtag),
-                    chain=str(chain.name),
-                    residue=str(residue.seqid.num),
-                    xmap=str(xmap_path),
-                )
-                event_id += 1
-                lbes[(str(dtag), str(chain.name), str(residue.seqid.num))] = lbe
+    for chain, residue_num in ligands[0]:
+        lbe = dt.LigandBindingEvent(
+            id=str(event_id),
+            dtag=str(dtag),
+            chain=str(chain),
+            residue=str(residue_num),
+            xmap=str(xmap_path),
+        )
+        event_id += 1
+        lbes[(str(dtag), str(chain), str(residue_num))] = lbe
 
     return lbes
 
@@ -161,53 +159,65 @@ def get_ligand_binding_events_from_panddas(pandda_event_csvs, pdb_path, dtag):
     return LigandBindingEvents(ligand_ids=lids, ligand_binding_events=lbes)
 
 
-def _get_ligand_binding_events_from_panddas(pandda_event_csvs, pdb_path, dtag):
-    structure = gemmi.read_structure(str(pdb_path))
-
-    ligand_binding_events = {}
-    # Iterate the events, and if a match add a ligand binding event
-    for pandda_path, event_table in pandda_event_csvs.items():
-        processed_datasets_dir = Path(pandda_path) / constants.PANDDA_PROCESSED_DATASETS_DIR
-
-        for idx, row in event_table.iterrows():
-            _dtag = row["dtag"]
-            event_id = row["event_idx"]
-            x = row["x"]
-            y = row["y"]
-            z = row["z"]
-            bdc = row["1-BDC"]
-            ligand_confidence = row["Ligand Confidence"]
+def _read_pandda_event_table(event_table_path):
+    return pd.read_csv(event_table_path, usecols=constants.PANDDA_EVENT_TABLE_COLUMNS)
 
-            # logger.debug(f"Processing {dtag} {event_id}")
 
-            if ligand_confidence not in ["High", "Medium"]:
-                # logger.debug("No high confidence ligand!")
-                continue
+def _get_pandda_events(pandda_event_csvs):
+    # The events with a high or medium confidence ligand in each PanDDA's event table, grouped by dtag in table order
+    pandda_events = {}
+    for pandda_path, event_table in pandda_event_csvs.items():
+        event_table = event_table[event_table["Ligand Confidence"].isin(["High", "Medium"])]
+        for _dtag, event_id, x, y, z, bdc in zip(
+                event_table["dtag"].tolist(),
+                event_table["event_idx"].tolist(),
+                event_table["x"].tolist(),
+                event_table["y"].tolist(),
+                event_table["z"].tolist(),
+                event_table["1-BDC"].tolist(),
+        ):
+            if _dtag not in pandda_events:
+                pandda_events[_dtag] = []
+            pandda_events[_dtag].append((pandda_path, event_id, x, y, z, bdc))
+
+    return pandda_events
+
+
+def _get_ligand_binding_events_from_panddas(pandda_events, pdb_path, dtag, ligands=None):
+    # Datasets without events are not read at all, and the ligands may already have been found
+    if dtag not in pandda_events:
+        return {}
+
+    if ligands is None:
+        ligands = _get_ligand_centroids(gemmi.read_structure(str(pdb_path)))
+    ligand_ids, centroids = ligands
 
-            if dtag != _dtag:
-                continue
+    ligand_binding_events = {}
+    # Iterate the dataset's events, adding a ligand binding event for each
+    for pandda_path, event_id, x, y, z, bdc in pandda_events[dtag]:
+        processed_datasets_dir = Path(pandda_path) / constants.PANDDA_PROCESSED_DATASETS_DIR
 
-            # Get the structure
-            processed_dataset_dir = processed_datasets_dir / dtag
+        # Get the structure
+        processed_dataset_dir = processed_datasets_dir / dtag
 
-            # Identify the closest ligand to the event
-            chain, residue_num = get_closest_lig(structure, (x, y, z))
+        # Identify the closest ligand to the event
+        chain, residue_num = _get_closest_ligand(ligand_ids, centroids, (x, y, z))
 
-            if not residue_num:
-                continue
+        if not residue_num:
+            continue
 
-            # Get the event map
-            xmap_path = processed_dataset_dir / constants.PANDDA_EVENT_MAP_TEMPLATE.format(
-                dtag=dtag, event_id=event_id, bdc=bdc
-            )
-            lbe = dt.LigandBindingEvent(
-                id=str(event_id),
-                dtag=str(dtag),
-                chain=str(chain),
-                residue=str(residue_num),
-                xmap=str(xmap_path),
-            )
-            ligand_binding_events[(str(dtag), str(chain), str(residue_num))] = lbe
+        # Get the event map
+        xmap_path = processed_dataset_dir / constants.PANDDA_EVENT_MAP_TEMPLATE.format(
+            dtag=dtag, event_id=event_id, bdc=bdc
+        )
+        lbe = dt.LigandBindingEvent(
+            id=str(event_id),
+            dtag=str(dtag),
+            chain=str(chain),
+            residue=str(residue_num),
+            xmap=str(xmap_path),
+        )
+        ligand_binding_events[(str(dtag), str(chain), str(residue_num))] = lbe
 
     return ligand_binding_events
 
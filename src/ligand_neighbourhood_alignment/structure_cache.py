@@ -0,0 +1,235 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import gemmi
+import numpy as np
+import yaml
+from loguru import logger
+
+from ligand_neighbourhood_alignment import constants
+
+
+def _get_corrected_cell(structure: gemmi.Structure):
+    # Structures without a real cell get a box around their atoms
+    if structure.cell.a != 1.0:
+        return None
+
+    poss = []
+    for model in structure:
+        for chain in model:
+            for residue in chain:
+                for atom in residue:
+                    pos = atom.pos
+                    poss.append((pos.x, pos.y, pos.z))
+    pos_array = np.array(poss)
+
+    cell_lengths = np.max(pos_array, axis=0) - np.min(pos_array, axis=0)
+
+    return [float(cell_lengths[0]), float(cell_lengths[1]), float(cell_lengths[2]), 90.0, 90.0, 90.0]
+
+
+class StructureCache:
+    # What is known about each structure file from earlier reads, keyed by its path and checked against its size and
+    # modification time, and optionally a hash of its contents. This is the corrected cell for structures without a
+    # real one, so the correction is only worked out once per file
+    def __init__(self, path=None, use_hash: bool = False):
+        self.path = path
+        self.use_hash = use_hash
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        # The fingerprints taken this run, so that each file is only hashed once while it is unchanged
+        self._fingerprints = {}
+
+        if (path is not None) and Path(path).exists():
+            with open(path, "r") as f:
+                dic = yaml.safe_load(f)
+            if dic:
+                self.entries = dic
+
+    def get_fingerprint(self, pdb):
+        key = str(Path(pdb).resolve())
+        stat = os.stat(pdb)
+        fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        if self.use_hash:
+            known = self._fingerprints.get(key)
+            if (known is not None) and all(known[name] == value for name, value in fingerprint.items()):
+                return known
+            with open(pdb, "rb") as f:
+                fingerprint["hash"] = hashlib.sha256(f.read()).hexdigest()
+        self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def read(self, pdb, correct_cell: bool = True):
+        # Every read checks the file against the cache, so a stage that keeps the file's own cell still records the
+        # corrected cell for the stages that do not
+        structure = gemmi.read_structure(str(pdb))
+
+        key = str(Path(pdb).resolve())
+        fingerprint = self.get_fingerprint(pdb)
+        entry = self.entries.get(key)
+        if (entry is not None) and all(entry.get(name) == value for name, value in fingerprint.items()):
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = dict(fingerprint, cell=_get_corrected_cell(structure))
+            self.entries[key] = entry
+            self._dirty = True
+
+        if correct_cell and (entry["cell"] is not None):
+            structure.cell = gemmi.UnitCell(*entry["cell"])
+
+        return structure
+
+    def get_subset(self, pdbs):
+        # A cache with only the entries of the given files, to send to a worker process
+        subset = StructureCache(use_hash=self.use_hash)
+        for pdb in pdbs:
+            key = str(Path(pdb).resolve())
+            if key in self.entries:
+                subset.entries[key] = self.entries[key]
+            if key in self._fingerprints:
+                subset._fingerprints[key] = self._fingerprints[key]
+        return subset
+
+    def update(self, other):
+        # Take on the entries and counts of another cache, for example one used in a worker process
+        for key, entry in other.entries.items():
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                self._dirty = True
+        self._fingerprints.update(other._fingerprints)
+        self.hits += other.hits
+        self.misses += other.misses
+
+    def save(self):
+        if (self.path is None) or (not self._dirty):
+            return
+        with open(self.path, "w") as f:
+            yaml.safe_dump(self.entries, f)
+        self._dirty = False
+        logger.info(f"Structure cache: {self.hits} hits, {self.misses} misses")
+
+
+def _get_structure_bytes(structure: gemmi.Structure):
+    # An estimate from the atom count, since gemmi does not report the memory it holds
+    return sum(model.count_atom_sites() for model in structure) * constants.STRUCTURE_BYTES_PER_ATOM
+
+
+class StructureRegistry(Mapping):
+    # The datasets' structures by dtag, read on first access and evicted least recently used first once they take up
+    # more than max_bytes. Callers only read the structures (cloning them before changing them), so an evicted
+    # structure is simply read again if it is needed later. Structures about to be used can be read ahead in a
+    # background thread with prefetch
+    def __init__(
+            self,
+            datasets,
+            structure_cache: StructureCache | None = None,
+            max_bytes: int = constants.STRUCTURE_REGISTRY_BYTES,
+            num_prefetch: int = constants.STRUCTURE_REGISTRY_PREFETCH,
+    ):
+        self.datasets = datasets
+        self.structure_cache = structure_cache if structure_cache is not None else StructureCache()
+        self.max_bytes = max_bytes
+        self.num_prefetch = num_prefetch
+        self.reads = 0
+        self.num_bytes = 0
+        self._structures = OrderedDict()
+        self._bytes = {}
+        self._futures = {}
+        self._order = []
+        self._order_indexes = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __getitem__(self, dtag):
+        with self._lock:
+            if dtag in self._structures:
+                self._structures.move_to_end(dtag)
+                structure = self._structures[dtag]
+            else:
+                structure = None
+            future = self._futures.get(dtag)
+
+        if structure is None:
+            if future is not None:
+                future.result()
+            with self._lock:
+                structure = self._structures.get(dtag)
+                if structure is not None:
+                    self._structures.move_to_end(dtag)
+            if structure is None:
+                structure = self._read(dtag)
+
+        self._prefetch_after(dtag)
+        return structure
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __contains__(self, dtag):
+        return dtag in self.datasets
+
+    def _read(self, dtag):
+        structure = self.structure_cache.read(self.datasets[dtag].pdb)
+        with self._lock:
+            self.reads += 1
+            if dtag in self._structures:
+                self.num_bytes -= self._bytes[dtag]
+            self._structures[dtag] = structure
+            self._bytes[dtag] = _get_structure_bytes(structure)
+            self.num_bytes += self._bytes[dtag]
+            # Always keep the structure just read, even if it is over the budget by itself
+            while (self.num_bytes > self.max_bytes) and (len(self._structures) > 1):
+                evicted_dtag, _ = self._structures.popitem(last=False)
+                self.num_bytes -= self._bytes.pop(evicted_dtag)
+        return structure
+
+    def _prefetch_read(self, dtag):
+        try:
+            with self._lock:
+                # Reading ahead should not push out structures that are in use
+                if (dtag in self._structures) or (self.num_bytes >= self.max_bytes):
+                    return
+            self._read(dtag)
+        except Exception as e:
+            # Any error is raised again when the structure is actually asked for
+            logger.debug(f"Failed to prefetch structure of {dtag}: {e}")
+        finally:
+            with self._lock:
+                del self._futures[dtag]
+
+    def _submit_prefetch(self, dtags):
+        with self._lock:
+            for dtag in dtags:
+                if (dtag in self._structures) or (dtag in self._futures):
+                    continue
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1)
+                self._futures[dtag] = self._executor.submit(self._prefetch_read, dtag)
+
+    def _prefetch_after(self, dtag):
+        if dtag not in self._order_indexes:
+            return
+        index = self._order_indexes[dtag]
+        self._submit_prefetch(self._order[index + 1: index + 1 + self.num_prefetch])
+
+    def prefetch(self, dtags):
+        # Set the order the structures are about to be used in, and start reading the first of them
+        self._order = [dtag for dtag in dtags if dtag in self.datasets]
+        self._order_indexes = {dtag: index for index, dtag in enumerate(self._order)}
+        self._submit_prefetch(self._order[: self.num_prefetch])
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
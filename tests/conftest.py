@@ -2,10 +2,12 @@ import os
 from pathlib import Path
 import shutil
 
+import gemmi
+import numpy as np
 import yaml
 import pytest
 
-from ligand_neighbourhood_alignment import dt
+from ligand_neighbourhood_alignment import cli, dt, get_alignability
 
 
 @pytest.fixture(scope="session")
@@ -79,3 +81,87 @@ def xtalforms(constants, assemblies_file):
         _xtalforms[xtalform_id] = dt.XtalForm.from_dict(xtalform_info)
 
     return _xtalforms
+
+
+@pytest.fixture(scope="session")
+def datasets(pdb_paths):
+    _datasets = {}
+    for dtag in ["Mpro-i0130", "Mpro-IBM0078", "Mpro-IBM0058", "Mpro-x0107", "Mpro-IBM0045"]:
+        st = gemmi.read_structure(str(pdb_paths[dtag]))
+        ligand_binding_events = {}
+        for chain in st[0]:
+            for residue in chain:
+                if residue.name in ["LIG", "DMS"]:
+                    lbe_id = (dtag, chain.name, str(residue.seqid.num))
+                    ligand_binding_events[lbe_id] = dt.LigandBindingEvent(
+                        "1", dtag, chain.name, str(residue.seqid.num), None
+                    )
+        _datasets[dtag] = dt.Dataset(dtag, str(pdb_paths[dtag]), None, None, ligand_binding_events)
+
+    return _datasets
+
+
+@pytest.fixture(scope="session")
+def ligand_neighbourhoods(datasets, assemblies, xtalforms):
+    _ligand_neighbourhoods = {}
+    for dtag, dataset in datasets.items():
+        _ligand_neighbourhoods.update(cli._get_neighbourhoods(dataset, xtalforms["xtalform1"], assemblies, "1"))
+
+    return _ligand_neighbourhoods
+
+
+@pytest.fixture(scope="session")
+def ligand_neighbourhood_transforms(ligand_neighbourhoods):
+    _ligand_neighbourhood_transforms = {}
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        _ligand_neighbourhood_transforms, list(ligand_neighbourhoods), ligand_neighbourhoods, {}
+    )
+    return _ligand_neighbourhood_transforms
+
+
+@pytest.fixture(scope="session")
+def xmap_path(pdb_paths, tmp_path_factory):
+    # A map calculated from the model, standing in for an event map
+    st = gemmi.read_structure(str(pdb_paths["Mpro-i0130"]))
+    st.setup_entities()
+    density_calculator = gemmi.DensityCalculatorX()
+    density_calculator.d_min = 2.0
+    density_calculator.grid.setup_from(st)
+    density_calculator.put_model_density_on_grid(st[0])
+
+    path = tmp_path_factory.mktemp("xmaps") / "Mpro-i0130.ccp4"
+    ccp4 = gemmi.Ccp4Map()
+    ccp4.grid = density_calculator.grid
+    ccp4.update_ccp4_header()
+    ccp4.write_ccp4_map(str(path))
+    return path
+
+
+@pytest.fixture(scope="session")
+def mtz_path(pdb_paths, tmp_path_factory):
+    # Structure factors calculated from the model, standing in for refinement map coefficients
+    st = gemmi.read_structure(str(pdb_paths["Mpro-i0130"]))
+    st.setup_entities()
+    density_calculator = gemmi.DensityCalculatorX()
+    density_calculator.d_min = 2.5
+    density_calculator.grid.setup_from(st)
+    density_calculator.put_model_density_on_grid(st[0])
+    asu_data = gemmi.transform_map_to_f_phi(density_calculator.grid).prepare_asu_data(dmin=2.5)
+
+    mtz = gemmi.Mtz(with_base=True)
+    mtz.spacegroup = st.find_spacegroup()
+    mtz.set_cell_for_all(st.cell)
+    mtz.add_dataset("model")
+    for f_label, phi_label in [("FWT", "PHWT"), ("DELFWT", "PHDELWT")]:
+        mtz.add_column(f_label, "F")
+        mtz.add_column(phi_label, "P")
+    data = np.zeros((len(asu_data.miller_array), 7), dtype=np.float32)
+    data[:, :3] = asu_data.miller_array
+    data[:, 3] = data[:, 5] = np.abs(asu_data.value_array)
+    data[:, 4] = data[:, 6] = np.angle(asu_data.value_array, deg=True)
+    data[:, 5] *= 0.5
+    mtz.set_data(data)
+
+    path = tmp_path_factory.mktemp("mtzs") / "Mpro-i0130.mtz"
+    mtz.write_to_file(str(path))
+    return path
@@ -4,8 +4,21 @@ import pytest
 import yaml
 from rich import print as rprint
 import gemmi
+import networkx as nx
+import numpy as np
 
-from ligand_neighbourhood_alignment import alignment_heirarchy
+from ligand_neighbourhood_alignment import (
+    align_xmaps,
+    alignment_heirarchy,
+    cli,
+    discovery_cache,
+    dt,
+    generate_aligned_structures,
+    generate_sites_from_components,
+    get_alignability,
+    get_ligand_neighbourhoods,
+    structure_cache,
+)
 
 
 def test_derive_alignment_heirarchy(
@@ -43,6 +56,22 @@ def test_structure_to_landmarks(
     rprint(landmarks)
 
 
+def test_get_transformed_chain(pdb_paths):
+    st = gemmi.read_structure(str(pdb_paths['Mpro-i0130']))
+    for triplet in ["x,y,z", "-x,y+1/2,-z", "-x+1,y,-z+1"]:
+        op = alignment_heirarchy._get_op(triplet)
+        assert alignment_heirarchy._get_op(triplet) is op
+        transformed_chain = alignment_heirarchy._get_transformed_chain(st[0]["A"], st.cell, op)
+
+        # Applying the operator atom by atom gives the same positions
+        for residue, transformed_residue in zip(st[0]["A"], transformed_chain):
+            for atom, transformed_atom in zip(residue, transformed_residue):
+                atom_frac = st.cell.fractionalize(atom.pos)
+                new_pos_frac = op.apply_to_xyz([atom_frac.x, atom_frac.y, atom_frac.z])
+                new_pos_orth = st.cell.orthogonalize(gemmi.Fractional(*new_pos_frac))
+                assert transformed_atom.pos.dist(new_pos_orth) < 1e-9
+
+
 def test_calculate_assembly_transform(
         pdb_paths,
         assemblies
@@ -229,3 +258,989 @@ def test_get_structure_chain_to_assembly_transform(
 #         a.run()
 #
 #     assert "5rgs" in [x.name for x in (Path(upload_3_dir) / "aligned_files").glob("*")]
+
+
+def test_incremental_ligand_neighbourhood_transforms(
+        ligand_neighbourhoods,
+):
+    ligand_ids = list(ligand_neighbourhoods)
+
+    # Match everything against everything with the per-ligand update
+    full_transforms = {}
+    for lid in ligand_ids:
+        get_alignability._update_ligand_neighbourhood_transforms(
+            full_transforms, lid, ligand_neighbourhoods, None
+        )
+    full_transforms = {key: value for key, value in full_transforms.items() if key[0] != key[1]}
+
+    # Match the first datasets, then add the rest incrementally
+    num_existing = len(ligand_ids) // 2
+    existing_neighbourhoods = {lid: ligand_neighbourhoods[lid] for lid in ligand_ids[:num_existing]}
+    incremental_transforms = {}
+    ca_index = {}
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        incremental_transforms, ligand_ids[:num_existing], existing_neighbourhoods, ca_index
+    )
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        incremental_transforms, ligand_ids[num_existing:], ligand_neighbourhoods, ca_index
+    )
+
+    assert len(full_transforms) > 0
+    assert set(incremental_transforms) == set(full_transforms)
+    for key, transform in full_transforms.items():
+        assert incremental_transforms[key].to_dict() == transform.to_dict()
+
+    # The incrementally updated CA index should match one built in a single pass
+    full_ca_index = {}
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        {}, [], ligand_neighbourhoods, full_ca_index, full_rematch=True
+    )
+    assert ca_index == full_ca_index
+
+
+def test_neighbourhood_store(ligand_neighbourhoods, tmp_path):
+    # The YAML of older runs, for a few neighbourhoods since it is slow to parse
+    ligand_neighbourhoods = {lid: ligand_neighbourhoods[lid] for lid in list(ligand_neighbourhoods)[::4]}
+    ligand_neighbourhoods_yaml = tmp_path / "neighbourhoods.yaml"
+    with open(ligand_neighbourhoods_yaml, "w") as f:
+        yaml.safe_dump(
+            {"/".join(lid): neighbourhood.to_dict() for lid, neighbourhood in ligand_neighbourhoods.items()}, f
+        )
+    expected = cli._load_ligand_neighbourhoods(tmp_path / "neighbourhoods.npz")
+    assert not isinstance(expected, dt.NeighbourhoodStore)
+
+    # Migrating gives the same neighbourhoods in the same order, made only when accessed
+    assert cli._migrate_ligand_neighbourhoods(
+        ligand_neighbourhoods_yaml, tmp_path / "neighbourhoods.npz"
+    ) == len(ligand_neighbourhoods)
+    store = cli._load_ligand_neighbourhoods(tmp_path / "neighbourhoods.npz")
+    assert isinstance(store, dt.NeighbourhoodStore)
+    assert len(store._neighbourhoods) == 0
+    assert list(store) == list(expected)
+    assert all(store[lid].to_dict() == neighbourhood.to_dict() for lid, neighbourhood in expected.items())
+    assert len(store.arrays["images"]) < len(store.arrays["image_indexes"])
+
+    # Added neighbourhoods are saved alongside those still stored
+    new_lid = ("Mpro-x0000", "A", "1", "1")
+    store = cli._load_ligand_neighbourhoods(tmp_path / "neighbourhoods.npz")
+    store[new_lid] = expected[list(expected)[0]]
+    del store[list(expected)[1]]
+    store.to_npz(tmp_path / "updated.npz")
+    updated = dt.NeighbourhoodStore.from_npz(tmp_path / "updated.npz")
+    assert list(updated) == sorted(list(expected)[:1] + list(expected)[2:] + [new_lid], key=lambda _x: "/".join(_x))
+    assert updated[new_lid].to_dict() == expected[list(expected)[0]].to_dict()
+    assert all(updated[lid].to_dict() == expected[lid].to_dict() for lid in list(expected)[2:])
+
+
+def test_transform_store(ligand_neighbourhoods, ligand_neighbourhood_transforms, tmp_path):
+    # One direction of each pair is stored and the other derived, giving the same transforms as matching did
+    store = dt.TransformStore.from_transforms(ligand_neighbourhood_transforms)
+    assert len(store.pairs) * 2 == len(ligand_neighbourhood_transforms)
+    assert list(store) == list(ligand_neighbourhood_transforms)
+    assert all(
+        store[key].to_dict() == transform.to_dict() for key, transform in ligand_neighbourhood_transforms.items()
+    )
+
+    store.save(tmp_path / "neighbourhood_transforms.bin")
+    loaded = cli._load_ligand_neighbourhood_transforms(tmp_path / "neighbourhood_transforms.bin")
+    assert list(loaded) == list(store)
+    assert all(loaded[key].to_dict() == store[key].to_dict() for key in store)
+
+    # New pairs and replaced ones are appended to the file they were read from
+    new_lid = ("Mpro-x0000", "A", "1", "1")
+    key = list(ligand_neighbourhood_transforms)[0]
+    transform = dt.Transform([1.0, 2.0, 3.0], np.eye(3).tolist())
+    loaded[(new_lid, key[0])] = transform
+    loaded[key] = transform
+    size = (tmp_path / "neighbourhood_transforms.bin").stat().st_size
+    loaded.save(tmp_path / "neighbourhood_transforms.bin")
+    record_size = dt.TransformStore.record_dtype.itemsize
+    assert (tmp_path / "neighbourhood_transforms.bin").stat().st_size == size + 2 * record_size
+    updated = dt.TransformStore.from_file(tmp_path / "neighbourhood_transforms.bin")
+    assert len(updated) == len(ligand_neighbourhood_transforms) + 2
+    assert list(updated)[:len(ligand_neighbourhood_transforms)] == list(ligand_neighbourhood_transforms)
+    assert updated[key].to_dict() == transform.to_dict()
+    assert updated[(key[0], new_lid)].vec == [-1.0, -2.0, -3.0]
+    assert (new_lid, key[1]) not in updated
+
+    # Setting every pair again, in either direction, adds nothing to the file
+    size = (tmp_path / "neighbourhood_transforms.bin").stat().st_size
+    for key in list(updated):
+        updated[key] = updated[key]
+    updated.save(tmp_path / "neighbourhood_transforms.bin")
+    assert (tmp_path / "neighbourhood_transforms.bin").stat().st_size == size
+
+    # The file is rewritten with only the live rows once superseded ones outnumber them, or after a deletion
+    keys = list(updated)
+    for _ in range(2):
+        for j, key in enumerate(keys[::2]):
+            updated[key] = dt.Transform([float(j), _, 0.0], np.eye(3).tolist())
+    updated.save(tmp_path / "neighbourhood_transforms.bin")
+    num_pairs = len(updated.pairs)
+    assert len(updated._pair_rows) == num_pairs
+    del updated[keys[1]]
+    assert keys[0] not in updated
+    updated.save(tmp_path / "neighbourhood_transforms.bin")
+    compacted = dt.TransformStore.from_file(tmp_path / "neighbourhood_transforms.bin")
+    assert (tmp_path / "neighbourhood_transforms.bin").stat().st_size == (num_pairs - 1) * record_size
+    assert list(compacted) == list(updated) == keys[2:]
+    assert all(compacted[key].to_dict() == updated[key].to_dict() for key in compacted)
+
+
+def test_match_cas(
+        ligand_neighbourhoods,
+):
+    num_matches = 0
+    for ligand_1_neighbourhood in ligand_neighbourhoods.values():
+        for ligand_2_neighbourhood in ligand_neighbourhoods.values():
+            ca_match, transform, inverse_transform = get_alignability._match_cas(
+                ligand_1_neighbourhood, ligand_2_neighbourhood
+            )
+
+            # Compare against gemmi's superposition of the same CAs
+            residues_1, positions_1 = ligand_1_neighbourhood.ca_array
+            residues_2, positions_2 = ligand_2_neighbourhood.ca_array
+            indexes_1, indexes_2 = get_alignability._get_shared_ca_indexes(residues_1, residues_2)
+            assert np.all(residues_1[indexes_1] == residues_2[indexes_2])
+            if len(indexes_1) < 9:
+                assert not ca_match
+                continue
+            sup = gemmi.superpose_positions(
+                [gemmi.Position(*pos) for pos in positions_1[indexes_1]],
+                [gemmi.Position(*pos) for pos in positions_2[indexes_2]],
+            )
+            assert ca_match == (sup.rmsd < 1.0)
+            if ca_match:
+                num_matches += 1
+                assert np.allclose(transform.mat, sup.transform.mat.tolist(), atol=1e-6)
+                assert np.allclose(transform.vec, sup.transform.vec.tolist(), atol=1e-6)
+                assert np.allclose(inverse_transform.mat, sup.transform.inverse().mat.tolist(), atol=1e-6)
+                assert np.allclose(inverse_transform.vec, sup.transform.inverse().vec.tolist(), atol=1e-6)
+
+    assert num_matches > len(ligand_neighbourhoods)
+
+
+def test_parallel_ligand_neighbourhood_transforms(
+        ligand_neighbourhoods,
+):
+    serial_transforms = {}
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        serial_transforms, list(ligand_neighbourhoods), ligand_neighbourhoods, {}
+    )
+    parallel_transforms = {}
+    get_alignability._update_ligand_neighbourhood_transforms_incremental(
+        parallel_transforms, list(ligand_neighbourhoods), ligand_neighbourhoods, {}, num_workers=2
+    )
+
+    # Same matches, inserted in the same order, with identical values
+    assert list(parallel_transforms) == list(serial_transforms)
+    assert yaml.safe_dump({str(key): value.to_dict() for key, value in parallel_transforms.items()}) == yaml.safe_dump(
+        {str(key): value.to_dict() for key, value in serial_transforms.items()}
+    )
+
+
+def test_parallel_neighbourhoods(
+        datasets,
+        assemblies,
+        xtalforms,
+        ligand_neighbourhoods,
+):
+    new_datasets = {dtag: datasets[dtag] for dtag in ["Mpro-x0107", "Mpro-i0130"]}
+    new_datasets["Mpro-missing"] = dt.Dataset("Mpro-missing", "data/Mpro-missing.pdb", None, None, {})
+    dataset_assignments = {dtag: "xtalform1" for dtag in new_datasets}
+
+    dataset_neighbourhoods, failures = cli._get_new_neighbourhoods(
+        new_datasets, xtalforms, dataset_assignments, assemblies, "1", num_workers=2
+    )
+
+    assert list(dataset_neighbourhoods) == ["Mpro-x0107", "Mpro-i0130"]
+    assert list(failures) == ["Mpro-missing"]
+    for dtag, neighbourhoods in dataset_neighbourhoods.items():
+        assert list(neighbourhoods) == [lid for lid in ligand_neighbourhoods if lid[0] == dtag]
+        for lid, neighbourhood in neighbourhoods.items():
+            assert neighbourhood.to_dict() == ligand_neighbourhoods[lid].to_dict()
+
+
+def _get_ligand_neighbourhood_per_mark(structure, ns, fragment, max_dist):
+    # Reference for the batched version: each mark is resolved and moved to its image one at a time
+    residue_neighbours = []
+    atom_images = {}
+    for atom in fragment:
+        for neighbour in ns.find_neighbors(atom, min_dist=0.01, max_dist=max_dist):
+            cra = neighbour.to_cra(structure[0])
+            atom_id = (str(cra.chain.name), str(cra.residue.seqid.num), str(cra.atom.name))
+            nearest_image = structure.cell.find_nearest_pbc_image(atom.pos, cra.atom.pos, neighbour.image_idx)
+            fpos = structure.cell.fractionalize(cra.atom.pos)
+            ftransform = ns.get_image_transformation(neighbour.image_idx)
+            atom_images[atom_id] = ftransform
+            fpos_trans = ftransform.apply(fpos)
+            fpos_trans.x = fpos_trans.x + nearest_image.pbc_shift[0]
+            fpos_trans.y = fpos_trans.y + nearest_image.pbc_shift[1]
+            fpos_trans.z = fpos_trans.z + nearest_image.pbc_shift[2]
+            residue_neighbours.append((structure.cell.orthogonalize(fpos_trans), cra))
+
+    neighbourhood_atoms = []
+    for atoms in get_ligand_neighbourhoods.get_model_and_artefact_atoms(residue_neighbours, structure, fragment):
+        _atoms = {}
+        for pos, cra in atoms:
+            image_transform = atom_images[(str(cra.chain.name), str(cra.residue.seqid.num), str(cra.atom.name))]
+            _atoms[(str(cra.chain.name).split("~")[0], str(cra.residue.seqid.num), str(cra.atom.name))] = dt.Atom(
+                cra.atom.element.name,
+                pos.x,
+                pos.y,
+                pos.z,
+                dt.Transform(image_transform.vec.tolist(), image_transform.mat.tolist()),
+            )
+        neighbourhood_atoms.append(_atoms)
+    return dt.Neighbourhood(*neighbourhood_atoms)
+
+
+def test_get_ligand_neighbourhood(datasets, assemblies, xtalforms):
+    for dtag in ["Mpro-i0130", "Mpro-x0107"]:
+        dataset = datasets[dtag]
+        structure = gemmi.read_structure(dataset.pdb)
+        assembly = cli._generate_assembly(xtalforms["xtalform1"], structure, assemblies, dataset.pdb, dataset)
+        ns = gemmi.NeighborSearch(assembly[0], assembly.cell, 9.0).populate()
+        for lid, fragment in cli._get_structure_fragments(dataset, assembly, "1").items():
+            neighbourhood = get_ligand_neighbourhoods._get_ligand_neighbourhood(assembly, ns, fragment, max_dist=9.0)
+            expected = _get_ligand_neighbourhood_per_mark(assembly, ns, fragment, 9.0)
+            assert neighbourhood.to_dict() == expected.to_dict()
+
+            # Atoms share the transforms of their images
+            images = [atom.image for atom in neighbourhood.atoms.values()]
+            assert len({id(image) for image in images}) == len({str(image.to_dict()) for image in images})
+
+
+def _get_connected_components_all_pairs(alignability_graph, clusters, max_path_length=2):
+    # The all pairs shortest path construction the bounded search replaced
+    path = dict(nx.all_pairs_shortest_path(alignability_graph))
+    path_lengths = {(source, target): len(path[source][target]) for source in path for target in path[source]}
+    H = nx.Graph()
+    H.add_nodes_from(path)
+    H.add_edges_from([pair for pair, path_length in path_lengths.items() if path_length <= max_path_length])
+    degrees = dict(nx.degree(H))
+
+    used = [member for cluster in clusters for member in cluster]
+    replayed = list(clusters)
+    for j, x in enumerate(replayed + sorted(degrees, key=lambda _x: degrees[_x], reverse=True)):
+        if j >= len(replayed):
+            if x in used:
+                continue
+            clusters[x] = []
+        for target in H.nodes:
+            if (target not in used) and (path_lengths.get((x, target), 3) <= 2):
+                used.append(target)
+                clusters[x].append(target)
+    return clusters
+
+
+def test_get_connected_components(ligand_neighbourhoods, ligand_neighbourhood_transforms):
+    alignability_graph = nx.Graph()
+    alignability_graph.add_nodes_from(ligand_neighbourhoods)
+    alignability_graph.add_edges_from(ligand_neighbourhood_transforms)
+    alignability_graph.add_node(("Mpro-x0000", "A", "1", "1"))
+
+    # Fresh clusters, and a replay of old cores including one no longer in the graph
+    old_clusters = {lid: [lid] for lid in list(ligand_neighbourhoods)[::7]}
+    old_clusters[("Mpro-x0001", "A", "1", "1")] = []
+    for clusters in [{}, old_clusters]:
+        for max_path_length in [1, 2, 3]:
+            expected = _get_connected_components_all_pairs(
+                alignability_graph, {key: list(value) for key, value in clusters.items()}, max_path_length
+            )
+            result = cli._get_connected_components(
+                alignability_graph, {key: list(value) for key, value in clusters.items()}, max_path_length
+            )
+            assert list(result.items()) == list(expected.items())
+
+
+def _update_conformer_sites_by_overlap(conformer_sites, connected_component_id, connected_component):
+    # Reference for the indexed version: intersect the component with every site's members
+    matched = False
+    for conformer_site_id, conformer_site in conformer_sites.items():
+        if len(set(connected_component).intersection(set(conformer_site.members))) > 0:
+            matched = True
+            for lid in connected_component:
+                if lid not in conformer_site.members:
+                    conformer_site.members.append(lid)
+    if not matched:
+        conformer_sites["+".join(connected_component_id)] = dt.ConformerSite(
+            [], [], connected_component, connected_component_id
+        )
+
+
+def test_update_conformer_sites():
+    rng = np.random.default_rng(0)
+    ligand_ids = [(f"x{j:04}", "A", "1101", "1") for j in range(200)]
+    neighbourhoods = {lid: dt.Neighbourhood({}, {}) for lid in ligand_ids}
+    structures = {lid[0]: None for lid in ligand_ids}
+    conformer_sites = {}
+    expected = {}
+    conformer_site_index = cli._get_conformer_site_index(conformer_sites)
+    for _ in range(3):
+        # Components overlap earlier sites, each other and, with repeats, themselves
+        connected_components = {}
+        for _ in range(40):
+            members = [ligand_ids[j] for j in rng.integers(0, len(ligand_ids), size=rng.integers(1, 6))]
+            connected_components[members[0]] = members
+        for connected_component_id, connected_component in connected_components.items():
+            cli._update_conformer_sites(
+                conformer_sites, connected_component_id, list(connected_component), neighbourhoods, structures,
+                {}, {}, {}, conformer_site_index,
+            )
+            _update_conformer_sites_by_overlap(expected, connected_component_id, list(connected_component))
+        assert {key: site.to_dict() for key, site in conformer_sites.items()} == {
+            key: site.to_dict() for key, site in expected.items()
+        }
+        assert conformer_site_index == cli._get_conformer_site_index(conformer_sites)
+
+        # The index is rebuilt from the saved sites
+        conformer_sites = {key: dt.ConformerSite.from_dict(site.to_dict()) for key, site in conformer_sites.items()}
+        conformer_site_index = cli._get_conformer_site_index(conformer_sites)
+
+
+def _update_canonical_sites_by_scan(canonical_sites, conformer_site, conformer_site_id, neighbourhoods):
+    # Reference for the indexed version: intersect the residues of every canonical site
+    for canonical_site in canonical_sites.values():
+        if conformer_site_id in canonical_site.conformer_site_ids:
+            return
+    conformer_site_residues = [(residue[1], residue[2]) for residue in conformer_site.residues]
+    for canonical_site in canonical_sites.values():
+        canonical_site_residues = [(residue[1], residue[2]) for residue in canonical_site.residues]
+        if len(set(canonical_site_residues).intersection(set(conformer_site_residues))) >= 0.75 * len(
+                canonical_site_residues):
+            canonical_site.conformer_site_ids.append(conformer_site_id)
+            return
+    centroid_res = cli._get_centroid_res(conformer_site.residues, neighbourhoods[conformer_site.reference_ligand_id])
+    global_reference_dtag = [x for x in canonical_sites.values()][0].global_reference_dtag if len(
+        canonical_sites) > 0 else conformer_site.reference_ligand_id[0]
+    canonical_sites[conformer_site_id] = dt.CanonicalSite(
+        [conformer_site_id],
+        conformer_site.residues,
+        conformer_site_id,
+        global_reference_dtag,
+        (
+            conformer_site.reference_ligand_id[0],
+            centroid_res[0],
+            centroid_res[1],
+            conformer_site.reference_ligand_id[1],
+        ),
+    )
+
+
+def test_update_canonical_sites():
+    rng = np.random.default_rng(0)
+    identity = dt.Transform([0.0, 0.0, 0.0], np.eye(3).tolist())
+    # Residues in both chains, so that canonical sites can list the same residue number and name twice
+    residues = [(chain, str(j), "ALA") for j in range(30) for chain in ["A", "B"]]
+    conformer_sites = {}
+    neighbourhoods = {}
+    for j in range(150):
+        lid = (f"x{j:04}", "A", "1101", "1")
+        start = rng.integers(0, len(residues) - 10)
+        site_residues = [residues[k] for k in range(start, start + rng.integers(2, 10))]
+        conformer_sites["+".join(lid)] = dt.ConformerSite(site_residues, [], [lid], lid)
+        neighbourhoods[lid] = dt.Neighbourhood(
+            {
+                (residue[0], residue[1], "CA"): dt.Atom("C", float(residue[1]), 0.0, 0.0, identity)
+                for residue in site_residues
+            },
+            {},
+        )
+
+    canonical_sites = {}
+    expected = {}
+    canonical_site_index = cli._CanonicalSiteIndex(canonical_sites)
+    for conformer_site_id, conformer_site in conformer_sites.items():
+        cli._update_canonical_sites(
+            canonical_sites, conformer_site, conformer_site_id, neighbourhoods,
+            canonical_site_index=canonical_site_index,
+        )
+        _update_canonical_sites_by_scan(expected, conformer_site, conformer_site_id, neighbourhoods)
+    assert 1 < len(canonical_sites) < len(conformer_sites)
+    assert {key: site.to_dict() for key, site in canonical_sites.items()} == {
+        key: site.to_dict() for key, site in expected.items()
+    }
+
+    # Already assigned conformer sites are skipped, also when the index is built from the canonical sites
+    for conformer_site_id, conformer_site in conformer_sites.items():
+        cli._update_canonical_sites(canonical_sites, conformer_site, conformer_site_id, neighbourhoods)
+    assert {key: site.to_dict() for key, site in canonical_sites.items()} == {
+        key: site.to_dict() for key, site in expected.items()
+    }
+
+
+def _crystalform_incremental_cluster_pairwise(
+        observation_centroid_residues,
+        xtalform_sites,
+        neighbourhoods,
+        cutoff=10.0,
+):
+    # Reference for the array version: distances one pair at a time, rechecking every site on each pass
+    centroid_ca_positions = {
+        observation_id: neighbourhoods[observation_id].atoms[(centroid_res[0], centroid_res[1], 'CA')]
+        for observation_id, centroid_res in observation_centroid_residues.items()
+    }
+    centre_residues_positions = {
+        site_id: centroid_ca_positions[tuple(site_id.split('/'))] for site_id in xtalform_sites
+    }
+    assignments = {site_id: list(xtalform_sites[site_id].members) for site_id in xtalform_sites}
+    assigned_observations = [observation_id for site_id in assignments for observation_id in assignments[site_id]]
+    observations_to_assign = list(centroid_ca_positions)
+    while len(observations_to_assign) > 0:
+        for observation_id in observations_to_assign:
+            for xtalform_site_id, xtalform_site_pos in centre_residues_positions.items():
+                if cli._get_dist(centroid_ca_positions[observation_id], xtalform_site_pos) < cutoff:
+                    assignments[xtalform_site_id].append(observation_id)
+                    assigned_observations.append(observation_id)
+                    break
+        remaining_observations = [_k for _k in observations_to_assign if _k not in assigned_observations]
+        if len(remaining_observations) == 0:
+            break
+        num_near = {
+            observation_id: len([
+                other for other in remaining_observations
+                if (cli._get_dist(centroid_ca_positions[observation_id], centroid_ca_positions[other]) < cutoff)
+                & (observation_id != other)
+            ])
+            for observation_id in remaining_observations
+        }
+        new_centroid_observation_id = min(num_near, key=lambda _x: num_near[_x])
+        centre_residues_positions[new_centroid_observation_id] = centroid_ca_positions[new_centroid_observation_id]
+        assignments[new_centroid_observation_id] = []
+        observations_to_assign = [_k for _k in observations_to_assign if _k not in assigned_observations]
+    return assignments
+
+
+def test_crystalform_incremental_cluster():
+    rng = np.random.default_rng(0)
+    identity = dt.Transform([0.0, 0.0, 0.0], np.eye(3).tolist())
+    for num_observations, num_sites in [(1, 0), (40, 0), (100, 0), (100, 3)]:
+        observation_ids = [(f"x{j:04}", "A", "1101", "1") for j in range(num_observations)]
+        positions = rng.normal(scale=15.0, size=(num_observations, 3))
+        neighbourhoods = {
+            observation_id: dt.Neighbourhood({("A", "41", "CA"): dt.Atom("C", *position.tolist(), identity)}, {})
+            for observation_id, position in zip(observation_ids, positions)
+        }
+        observation_centroid_residues = {observation_id: ("A", "41") for observation_id in observation_ids}
+        xtalform_sites = {
+            "/".join(observation_id): dt.XtalFormSite("xtalform1", "A", "1", [observation_id])
+            for observation_id in observation_ids[:num_sites]
+        }
+
+        assignments = cli._crystalform_incremental_cluster(
+            observation_centroid_residues, xtalform_sites, neighbourhoods
+        )
+
+        assert assignments == _crystalform_incremental_cluster_pairwise(
+            observation_centroid_residues, xtalform_sites, neighbourhoods
+        )
+
+
+def test_update_xtalform_sites_incremental(monkeypatch):
+    rng = np.random.default_rng(0)
+    identity = dt.Transform([0.0, 0.0, 0.0], np.eye(3).tolist())
+    observation_ids = [(f"x{j:04}", "A", "1101", "1") for j in range(60)]
+    neighbourhoods = {
+        observation_id: dt.Neighbourhood(
+            {
+                ("A", str(k), "CA"): dt.Atom("C", *(position + k).tolist(), identity)
+                for k in range(3)
+            },
+            {},
+        )
+        for observation_id, position in zip(observation_ids, rng.normal(scale=15.0, size=(60, 3)))
+    }
+    dataset_assignments = {observation_id[0]: "xtalform1" for observation_id in observation_ids}
+    dataset_assignments["y0000"] = "xtalform2"
+    canonical_site = dt.CanonicalSite(["1"], [], "1", "x0000", ("x0000", "A", "1", "1"))
+    get_centroid_res = cli._get_centroid_res
+    num_centroids = []
+
+    def _get_centroid_res(residues, reference_neighbourhood):
+        num_centroids.append(1)
+        return get_centroid_res(residues, reference_neighbourhood)
+
+    monkeypatch.setattr(cli, "_get_centroid_res", _get_centroid_res)
+
+    # Centroids are only worked out for observations not yet in a site, and survive a round trip through a dict
+    xtalform_sites = {}
+    for num_observations, expected_num_centroids in [(40, 40), (40, 0), (60, 20)]:
+        num_centroids.clear()
+        conformer_sites = {"1": dt.ConformerSite([], [], observation_ids[:num_observations], observation_ids[0])}
+        cli._update_xtalform_sites(
+            xtalform_sites, canonical_site, "1", dataset_assignments, conformer_sites, neighbourhoods
+        )
+        xtalform_sites = {
+            xtalform_site_id: dt.XtalFormSite.from_dict(xtalform_site.to_dict())
+            for xtalform_site_id, xtalform_site in xtalform_sites.items()
+        }
+        assert len(num_centroids) == expected_num_centroids
+        assert {
+            member for xtalform_site in xtalform_sites.values() for member in xtalform_site.member_centroids
+        } == set(observation_ids[:num_observations])
+        for xtalform_site in xtalform_sites.values():
+            assert xtalform_site.xtalform_id == "xtalform1"
+            for member in xtalform_site.members:
+                assert xtalform_site.member_centroids[member] == cli._get_observation_centroid(neighbourhoods[member])
+
+
+def test_get_xtalform_site_index():
+    rng = np.random.default_rng(0)
+    ligand_ids = [(f"x{j:04}", "A", "1101", "1") for j in range(50)]
+    xtalform_sites = {
+        str(j): dt.XtalFormSite(
+            f"xtalform{rng.integers(0, 2)}",
+            "A",
+            str(rng.integers(0, 3)),
+            [ligand_ids[k] for k in rng.integers(0, len(ligand_ids), size=5)],
+        )
+        for j in range(30)
+    }
+
+    xtalform_site_index = generate_sites_from_components._get_xtalform_site_index(xtalform_sites)
+
+    # The same site as scanning all of them, keeping the last match
+    for xtalform_id in ["xtalform0", "xtalform1"]:
+        for canonical_site_id in ["0", "1", "2"]:
+            for lid in ligand_ids:
+                expected = None
+                for xtalform_site in xtalform_sites.values():
+                    if (xtalform_site.xtalform_id == xtalform_id) & (
+                            xtalform_site.canonical_site_id == canonical_site_id) & (lid in xtalform_site.members):
+                        expected = xtalform_site
+                assert xtalform_site_index.get((xtalform_id, canonical_site_id, lid)) is expected
+                if expected is None:
+                    with pytest.raises(KeyError, match="No xtalform site"):
+                        generate_sites_from_components._get_xtalform_site(
+                            xtalform_site_index, xtalform_id, canonical_site_id, lid
+                        )
+                else:
+                    assert generate_sites_from_components._get_xtalform_site(
+                        xtalform_site_index, xtalform_id, canonical_site_id, lid
+                    ) is expected
+
+
+def test_ligand_site_transforms(ligand_neighbourhoods, ligand_neighbourhood_transforms):
+    alignability_graph = nx.Graph()
+    alignability_graph.add_nodes_from(ligand_neighbourhoods)
+    alignability_graph.add_edges_from(ligand_neighbourhood_transforms)
+    identity = {"vec": [0.0, 0.0, 0.0], "mat": np.eye(3).tolist()}
+    reference_ligand_id = ("Mpro-i0130", "A", "1005", "1")
+    ligand_site_transforms = align_xmaps.LigandSiteTransforms(
+        alignability_graph,
+        ligand_neighbourhood_transforms,
+        {(reference_ligand_id[0], "A"): identity},
+        {"dimer": identity},
+        {"xtalform1": dt.XtalForm(None, {"dimer": dt.XtalFormAssembly("dimer", ["A", "B"], ["x,y,z", "x,y,z"])})},
+        {reference_ligand_id[0]: "xtalform1"},
+    )
+
+    # Every reachable ligand resolves to the transform composed along a shortest path to the reference
+    for lid in nx.node_connected_component(alignability_graph, reference_ligand_id):
+        transform = ligand_site_transforms.get(lid, reference_ligand_id, "A")
+        assert ligand_site_transforms.get(lid, reference_ligand_id, "A") is transform
+        expected = align_xmaps._get_ligand_to_site_transform(
+            alignability_graph, ligand_neighbourhood_transforms, lid, reference_ligand_id, identity, identity
+        )
+        assert np.allclose(transform.mat.tolist(), expected.mat.tolist(), rtol=0.0, atol=1e-10)
+        assert np.allclose(transform.vec.tolist(), expected.vec.tolist(), rtol=0.0, atol=1e-10)
+
+    alignability_graph.add_node(("Mpro-x0000", "A", "1", "1"))
+    with pytest.raises(nx.NetworkXNoPath):
+        ligand_site_transforms.get(("Mpro-x0000", "A", "1", "1"), reference_ligand_id, "A")
+
+
+def test_write_aligned_xmaps(
+        pdb_paths,
+        ligand_neighbourhoods,
+        ligand_neighbourhood_transforms,
+        xmap_path,
+        tmp_path,
+):
+    alignability_graph = nx.Graph()
+    alignability_graph.add_nodes_from(ligand_neighbourhoods)
+    alignability_graph.add_edges_from(ligand_neighbourhood_transforms)
+    identity = {"vec": [0.0, 0.0, 0.0], "mat": np.eye(3).tolist()}
+    moving_ligand_id = ("Mpro-i0130", "A", "1005", "1")
+    reference_ligand_id = [key[0] for key in ligand_neighbourhood_transforms if key[1] == moving_ligand_id][0]
+    reference_xmap = align_xmaps.read_xmap(xmap_path)
+    aligned_res = gemmi.read_structure(str(pdb_paths["Mpro-i0130"]))[0]["A"]["1005"][0]
+
+    align_xmaps.__align_xmap(
+        ligand_neighbourhoods[moving_ligand_id],
+        alignability_graph,
+        ligand_neighbourhood_transforms,
+        reference_xmap,
+        reference_ligand_id,
+        moving_ligand_id,
+        align_xmaps.read_xmap(xmap_path),
+        None,
+        None,
+        None,
+        tmp_path / "expected.ccp4",
+        tmp_path / "expected_crystallographic.ccp4",
+        aligned_res,
+        identity,
+        identity,
+    )
+
+    # Precompute the job in the parent and write it from a worker, alongside a job whose map is missing
+    running_transform = align_xmaps._get_ligand_to_site_transform(
+        alignability_graph, ligand_neighbourhood_transforms, moving_ligand_id, reference_ligand_id, identity, identity
+    )
+    jobs = []
+    for name, path in [("aligned", xmap_path), ("missing", tmp_path / "missing.ccp4")]:
+        jobs.append(
+            align_xmaps.AlignedXmapJob(
+                "event",
+                str(path),
+                dt.Transform(running_transform.vec.tolist(), running_transform.mat.tolist()),
+                align_xmaps._get_interpolation_range(
+                    ligand_neighbourhoods[moving_ligand_id], running_transform, reference_xmap
+                ),
+                str(pdb_paths["Mpro-i0130"]),
+                "A",
+                "1005",
+                str(tmp_path / f"{name}.ccp4"),
+                str(tmp_path / f"{name}_crystallographic.ccp4"),
+            )
+        )
+    summary = align_xmaps._write_aligned_xmaps(
+        {"Mpro-i0130": jobs}, align_xmaps.GridTemplate.from_grid(reference_xmap), num_workers=2
+    )
+
+    assert summary["written"] == [str(tmp_path / "aligned.ccp4")]
+    assert list(summary["failed"]) == [str(tmp_path / "missing.ccp4")]
+    assert (tmp_path / "aligned.ccp4").read_bytes() == (tmp_path / "expected.ccp4").read_bytes()
+    assert (tmp_path / "aligned_crystallographic.ccp4").read_bytes() == (
+        tmp_path / "expected_crystallographic.ccp4"
+    ).read_bytes()
+
+
+def test_write_aligned_xmap_without_full_cell(
+        pdb_paths,
+        ligand_neighbourhoods,
+        ligand_neighbourhood_transforms,
+        xmap_path,
+        tmp_path,
+):
+    alignability_graph = nx.Graph()
+    alignability_graph.add_nodes_from(ligand_neighbourhoods)
+    alignability_graph.add_edges_from(ligand_neighbourhood_transforms)
+    identity = {"vec": [0.0, 0.0, 0.0], "mat": np.eye(3).tolist()}
+    moving_ligand_id = ("Mpro-i0130", "A", "1005", "1")
+    reference_ligand_id = [key[0] for key in ligand_neighbourhood_transforms if key[1] == moving_ligand_id][0]
+    reference_xmap = align_xmaps.read_xmap(xmap_path)
+    xmap = align_xmaps.read_xmap(xmap_path)
+    aligned_res = gemmi.read_structure(str(pdb_paths["Mpro-i0130"]))[0]["A"]["1005"][0]
+    running_transform = align_xmaps._get_ligand_to_site_transform(
+        alignability_graph, ligand_neighbourhood_transforms, moving_ligand_id, reference_ligand_id, identity, identity
+    )
+    interpolation_range = align_xmaps._get_interpolation_range(
+        ligand_neighbourhoods[moving_ligand_id], running_transform, reference_xmap
+    )
+
+    # The maps interpolated onto the full reference cell first
+    new_xmap = align_xmaps.interpolate_range(reference_xmap, xmap, interpolation_range, running_transform.inverse())
+    align_xmaps._write_xmap_from_ccp4(align_xmaps.resample_xmap(new_xmap, aligned_res), tmp_path / "expected.ccp4")
+    align_xmaps._write_cut_xmap(new_xmap, aligned_res, tmp_path / "expected_crystallographic.ccp4")
+
+    align_xmaps._write_aligned_xmap(
+        align_xmaps.GridTemplate.from_grid(reference_xmap),
+        xmap,
+        interpolation_range,
+        running_transform,
+        tmp_path / "aligned.ccp4",
+        tmp_path / "aligned_crystallographic.ccp4",
+        aligned_res,
+    )
+
+    # The crystallographic map holds the same grid points, and the ligand frame map differs only by the second
+    # interpolation
+    for suffix in ["_crystallographic", ""]:
+        expected = gemmi.read_ccp4_map(str(tmp_path / f"expected{suffix}.ccp4"))
+        aligned = gemmi.read_ccp4_map(str(tmp_path / f"aligned{suffix}.ccp4"))
+        for word in [1, 2, 3, 5, 6, 7, 8, 9, 10, 17, 18, 19, 50, 51, 52]:
+            assert aligned.header_i32(word) == expected.header_i32(word)
+        assert aligned.grid.unit_cell == expected.grid.unit_cell
+        expected_array = np.array(expected.grid, copy=False)
+        aligned_array = np.array(aligned.grid, copy=False)
+        if suffix:
+            assert np.array_equal(aligned_array, expected_array)
+        else:
+            assert np.corrcoef(aligned_array.ravel(), expected_array.ravel())[0, 1] > 0.99
+
+
+def test_xmap_provider(mtz_path, xmap_path, monkeypatch):
+    mtz_reads = []
+    read_mtz_file = gemmi.read_mtz_file
+
+    def _read_mtz_file(path):
+        mtz_reads.append(path)
+        return read_mtz_file(path)
+
+    # Both maps of an MTZ come from a single read and are then served from memory
+    xmap_provider = align_xmaps.XmapProvider()
+    monkeypatch.setattr(gemmi, "read_mtz_file", _read_mtz_file)
+    for map_type in ["Fo-Fc", "2Fo-Fc", "Fo-Fc"]:
+        expected = np.array(align_xmaps.read_xmap_from_mtz(mtz_path, map_type), copy=False)
+        assert np.array_equal(np.array(xmap_provider.get(mtz_path, map_type), copy=False), expected)
+    assert len(mtz_reads) == 4
+    assert xmap_provider.get(xmap_path, "event") is xmap_provider.get(xmap_path, "event")
+
+    # The least recently used maps are dropped once over budget
+    xmap_provider = align_xmaps.XmapProvider(max_bytes=1)
+    xmap = xmap_provider.get(mtz_path, "2Fo-Fc")
+    assert xmap_provider.get(xmap_path, "event") is not None
+    assert xmap_provider.get(mtz_path, "2Fo-Fc") is not xmap
+    assert len(mtz_reads) == 6
+
+
+def test_structure_cache(pdb_paths, tmp_path):
+    # A structure without a cell is given one around its atoms, which is remembered for as long as the file is unchanged
+    pdb = tmp_path / "no_cell.pdb"
+    lines = Path(pdb_paths["Mpro-i0130"]).read_text().splitlines(keepends=True)
+    pdb.write_text("".join(line for line in lines if not line.startswith("CRYST1")))
+    cache_path = tmp_path / "structure_cache.yaml"
+
+    cache = structure_cache.StructureCache(cache_path)
+    structure = cache.read(pdb)
+    cache.save()
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert structure.cell.a != 1.0
+
+    cache = structure_cache.StructureCache(cache_path)
+    cached_structure = cache.read(pdb)
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert cached_structure.cell.parameters == structure.cell.parameters
+
+    with open(pdb, "a") as f:
+        f.write("\n")
+    cache.read(pdb)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    structure = cache.read(pdb_paths["Mpro-i0130"])
+    assert structure.cell.parameters == gemmi.read_structure(str(pdb_paths["Mpro-i0130"])).cell.parameters
+
+    # Reads that keep the file's own cell still record the corrected one
+    cache = structure_cache.StructureCache()
+    assert cache.read(pdb, correct_cell=False).cell.a == 1.0
+    assert cache.read(pdb).cell.parameters == cached_structure.cell.parameters
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Files are only hashed again when their size or modification time changes
+    cache = structure_cache.StructureCache(use_hash=True)
+    fingerprint = cache.get_fingerprint(pdb)
+    assert "hash" in fingerprint
+    assert cache.get_fingerprint(pdb) is fingerprint
+    with open(pdb, "a") as f:
+        f.write("\n")
+    assert cache.get_fingerprint(pdb)["hash"] != fingerprint["hash"]
+
+
+def test_structure_registry(datasets):
+    dtags = list(datasets)
+    expected = {dtag: gemmi.read_structure(datasets[dtag].pdb).make_pdb_string() for dtag in dtags}
+    # Room for about two of the structures at a time
+    max_bytes = 2 * structure_cache._get_structure_bytes(gemmi.read_structure(datasets[dtags[0]].pdb))
+    structures = structure_cache.StructureRegistry(datasets, max_bytes=max_bytes, num_prefetch=0)
+
+    assert list(structures) == dtags
+    assert structures.reads == 0
+    for dtag in dtags:
+        assert structures[dtag].make_pdb_string() == expected[dtag]
+        assert structures.num_bytes <= max_bytes
+    assert structures.reads == len(dtags)
+
+    # The most recently used structure is kept, and evicted ones are read again
+    structures[dtags[-1]]
+    assert structures.reads == len(dtags)
+    assert structures[dtags[0]].make_pdb_string() == expected[dtags[0]]
+    assert structures.reads == len(dtags) + 1
+
+    # Structures about to be used are read ahead
+    structures = structure_cache.StructureRegistry(datasets, num_prefetch=2)
+    structures.prefetch(dtags)
+    for dtag, structure in structures.items():
+        assert structure.make_pdb_string() == expected[dtag]
+    structures.close()
+    assert structures.reads == len(dtags)
+
+
+def test_get_datasets_from_panddas(pdb_paths, tmp_path):
+    model_building_dir = tmp_path / "model_building"
+    for dtag in ["Mpro-i0130", "Mpro-x0107", "Mpro-no-events"]:
+        (model_building_dir / dtag).mkdir(parents=True)
+        (model_building_dir / dtag / "refine.pdb").write_text(
+            Path(pdb_paths[dtag if dtag != "Mpro-no-events" else "Mpro-IBM0045"]).read_text()
+        )
+    pandda_dir = tmp_path / "pandda"
+    (pandda_dir / "analyses").mkdir(parents=True)
+    (pandda_dir / "analyses" / "pandda_inspect_events.csv").write_text(
+        "dtag,event_idx,x,y,z,1-BDC,Ligand Confidence,Comment\n"
+        "Mpro-i0130,1,9.0,0.0,21.0,0.25,High,\n"
+        "Mpro-x0107,1,50.0,50.0,50.0,0.3,Low,\n"
+        "Mpro-x0107,2,7.0,0.0,20.0,0.35,Medium,\n"
+        "Mpro-missing,1,7.0,0.0,20.0,0.35,High,\n"
+    )
+    source_data_model = dt.SourceDataModel.from_fs_model(
+        dt.FSModel.from_dir(tmp_path), [str(model_building_dir)], ["model_building"], [str(pandda_dir)]
+    )
+
+    datasets, reference_datasets, new_datasets = source_data_model.get_datasets()
+
+    assert sorted(datasets) == ["Mpro-i0130", "Mpro-x0107"]
+    assert sorted(new_datasets) == ["Mpro-i0130", "Mpro-x0107"]
+    assert len(reference_datasets) == 0
+    assert list(datasets["Mpro-i0130"].ligand_binding_events) == [("Mpro-i0130", "A", "1005")]
+    lbe = datasets["Mpro-x0107"].ligand_binding_events[("Mpro-x0107", "A", "1101")]
+    assert lbe.id == "2"
+    assert lbe.xmap == str(
+        pandda_dir / "processed_datasets" / "Mpro-x0107" / "Mpro-x0107-event_2_1-BDC_0.35_map.native.ccp4"
+    )
+
+    # Unchanged directories and structures are not looked at again
+    cache_path = tmp_path / "discovery_cache.yaml"
+    cache = discovery_cache.DiscoveryCache(cache_path)
+    source_data_model.get_datasets(cache)
+    cache.save()
+    assert (cache.dirs_listed, cache.dirs_cached, cache.pdbs_read, cache.pdbs_cached) == (3, 0, 2, 0)
+    (model_building_dir / "Mpro-x0107" / "refine.mtz").write_text("")
+    cache = discovery_cache.DiscoveryCache(cache_path)
+    cached_datasets, _, _ = source_data_model.get_datasets(cache)
+    assert (cache.dirs_listed, cache.dirs_cached, cache.pdbs_read, cache.pdbs_cached) == (1, 2, 0, 2)
+    for dtag, dataset in datasets.items():
+        assert {key: vars(lbe) for key, lbe in cached_datasets[dtag].ligand_binding_events.items()} == {
+            key: vars(lbe) for key, lbe in dataset.ligand_binding_events.items()
+        }
+
+
+def test_write_aligned_structures(
+        datasets,
+        xtalforms,
+        ligand_neighbourhoods,
+        ligand_neighbourhood_transforms,
+        tmp_path,
+):
+    alignability_graph = nx.Graph()
+    alignability_graph.add_nodes_from(ligand_neighbourhoods)
+    alignability_graph.add_edges_from(ligand_neighbourhood_transforms)
+    identity = {"vec": [0.0, 0.0, 0.0], "mat": np.eye(3).tolist()}
+    dtag = "Mpro-i0130"
+    dataset_ligand_ids = [lid for lid in ligand_neighbourhoods if lid[0] == dtag]
+    xtalform_sites = {"A": dt.XtalFormSite("xtalform1", "A", "1", list(ligand_neighbourhoods))}
+    structures = cli._get_structures({dtag: datasets[dtag]})
+
+    jobs = []
+    for moving_ligand_id in dataset_ligand_ids:
+        reference_ligand_id = [key[0] for key in ligand_neighbourhood_transforms if key[1] == moving_ligand_id][0]
+        generate_aligned_structures._align_structure(
+            structures[dtag].clone(),
+            moving_ligand_id,
+            reference_ligand_id,
+            ligand_neighbourhoods[moving_ligand_id],
+            dataset_ligand_ids,
+            alignability_graph,
+            ligand_neighbourhood_transforms,
+            None,
+            None,
+            None,
+            xtalforms["xtalform1"],
+            tmp_path / f"expected_{moving_ligand_id[2]}.pdb",
+            None,
+            identity,
+            identity,
+            xtalform_sites,
+        )
+        running_transform = align_xmaps._get_ligand_to_site_transform(
+            alignability_graph, ligand_neighbourhood_transforms, moving_ligand_id, reference_ligand_id, identity,
+            identity
+        )
+        jobs.append(
+            generate_aligned_structures.AlignedStructureJob(
+                moving_ligand_id,
+                dt.Transform(running_transform.vec.tolist(), running_transform.mat.tolist()),
+                ligand_neighbourhoods[moving_ligand_id],
+                dataset_ligand_ids,
+                xtalforms["xtalform1"],
+                xtalform_sites,
+                str(tmp_path / f"{moving_ligand_id[2]}.pdb"),
+            )
+        )
+    # A ligand that is not in the structure fails without stopping the others
+    jobs.insert(1, generate_aligned_structures.AlignedStructureJob(
+        (dtag, "A", "9999", "1"), jobs[0].transform, jobs[0].neighbourhood, dataset_ligand_ids,
+        xtalforms["xtalform1"], xtalform_sites, str(tmp_path / "missing.pdb")
+    ))
+
+    cache = structure_cache.StructureCache()
+    summary = cli._write_aligned_structures(
+        {dtag: jobs}, datasets, structures, num_workers=2, structure_cache=cache
+    )
+
+    # What the worker found is merged back into the cache
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert list(cache.entries) == [str(Path(datasets[dtag].pdb).resolve())]
+    assert list(summary["failed"]) == [str(tmp_path / "missing.pdb")]
+    assert summary["written"] == [str(tmp_path / f"{lid[2]}.pdb") for lid in dataset_ligand_ids]
+    for lid in dataset_ligand_ids:
+        assert (tmp_path / f"{lid[2]}.pdb").read_text() == (tmp_path / f"expected_{lid[2]}.pdb").read_text()
+
+
+def test_cli_update(pdb_paths, mtz_path, tmp_path):
+    datasource_dir = tmp_path / "manual"
+    for dtag in ["Mpro-IBM0045", "Mpro-IBM0078", "Mpro-x0107"]:
+        (datasource_dir / dtag).mkdir(parents=True)
+        (datasource_dir / dtag / f"{dtag}.pdb").write_text(Path(pdb_paths[dtag]).read_text())
+        (datasource_dir / dtag / f"{dtag}.mtz").write_bytes(Path(mtz_path).read_bytes())
+    assemblies_yaml = tmp_path / "assemblies.yaml"
+    with open(assemblies_yaml, "w") as f:
+        yaml.safe_dump(
+            {
+                "assemblies": {
+                    "dimer": {"reference": "Mpro-IBM0045", "biomol": "A,B", "chains": "A,A(-x,y,-z)"},
+                },
+                "crystalforms": {
+                    "xtalform1": {
+                        "reference": "Mpro-IBM0045",
+                        "assemblies": {1: {"assembly": "dimer", "chains": "A,A(-x,y,-z)"}},
+                    },
+                },
+            },
+            f,
+        )
+    output_dir = tmp_path / "upload"
+    output_dir.mkdir()
+    options_json = tmp_path / "options.json"
+    options_json.write_text(
+        cli.Options(
+            source_dir=str(output_dir),
+            output_dir=str(output_dir),
+            datasources=[str(datasource_dir)],
+            datasource_types=["manual"],
+            panddas=[],
+            assemblies_json=str(assemblies_yaml),
+            xtalforms_json=str(assemblies_yaml),
+        ).json()
+    )
+
+    cli.CLI().update(str(options_json))
+
+    fs_model = dt.FSModel.from_dir(output_dir)
+    assert sorted(fs_model.alignments) == ["Mpro-IBM0045", "Mpro-IBM0078", "Mpro-x0107"]
+    for dtag, dataset_alignments in fs_model.alignments.items():
+        for chain, chain_alignments in dataset_alignments.items():
+            for residue, residue_alignments in chain_alignments.items():
+                for version, ligand_neighbourhood_output in residue_alignments.items():
+                    assert version == "1"
+                    for aligned_structure in ligand_neighbourhood_output.aligned_structures.values():
+                        assert (output_dir / aligned_structure).exists()
+    assembly_landmarks = cli._load_assembly_landmarks(fs_model.assembly_landmarks)
+    assembly_transforms = cli._load_assembly_transforms(fs_model.assembly_transforms)
+    assert list(assembly_landmarks) == list(assembly_transforms) == ["dimer"]
+
+    # Running again picks up the stored assembly landmarks and transforms
+    cli.CLI().update(str(options_json))
+    assert cli._load_assembly_landmarks(fs_model.assembly_landmarks) == assembly_landmarks
+    assert cli._load_assembly_transforms(fs_model.assembly_transforms) == assembly_transforms